@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Boundary Benchmark
+==================
+
+Per-call cost of checking points against polygon borders (see
+snowdonia.boundary) with the grid index of Boundary.contains(), against
+checking them against every edge (ray casting), as the number of vertices
+grows. The borders are a winding ring around the town center, with a hole in it
+(about 50 km and 5 km from it), and the points are anywhere within 60 km of the
+center. Also reports how long indexing takes, and the in_range() circle for
+comparison. Run from the repo's root:
+::
+    $ python benchmarks/boundary.py
+"""
+import os
+import sys
+import timeit
+from math import degrees, radians, sin, cos, pi
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from snowdonia.boundary import Boundary, edges_of
+from snowdonia.geo import snowdonia_center, snowdonia_radius, in_range
+from geofence import points_around_center, per_call
+
+VERTICES = [100, 1000, 10000, 100000]
+
+
+def ring(random, km, vertices):
+    """A ring of vertices, winding between 80% and 100% of km from the center,
+    and jagged by about the length of an edge, like a real border."""
+    lat_center, long_center = (degrees(c) for c in snowdonia_center)
+    jitter = 2 * pi / vertices
+    points = []
+    for i in range(vertices):
+        t = 2 * pi * i / vertices
+        r = (0.9 + 0.05 * sin(5 * t) + 0.05 * sin(13 * t)) * \
+            random.uniform(1 - jitter, 1 + jitter) * km / 111.3
+        points.append((long_center + r * cos(t) / cos(radians(lat_center)),
+                       lat_center + r * sin(t)))
+    return points + points[:1]
+
+
+def ray_casting(polygons):
+    """Checks a point against every edge of the polygons."""
+    edges = edges_of(polygons)
+    def contains(latitude, longitude):
+        inside = False
+        for x1, y1, x2, y2 in edges:
+            if (y1 > latitude) != (y2 > latitude) and \
+               longitude < x1 + (latitude - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+    return contains
+
+
+def main():
+    random = Random(20161222)
+    points = points_around_center(random, 0, snowdonia_radius * 1.2)
+    print('in_range (circle): %.2f us' % per_call(in_range, points))
+    print('%-9s %8s %10s %12s %12s' % ('vertices', 'cells', 'index ms',
+                                       'grid us', 'ray cast us'))
+    for vertices in VERTICES:
+        polygons = [[ring(random, snowdonia_radius, vertices),
+                     ring(random, snowdonia_radius / 10, max(3, vertices // 10))]]
+        elapsed = min(timeit.repeat(lambda: Boundary(polygons), number=1, repeat=3))
+        boundary = Boundary(polygons)
+        grid = per_call(boundary.contains, points)
+        # Ray casting gets slow quickly: time it on fewer points
+        ray = per_call(ray_casting(polygons), points[:max(10, 1000000 // vertices)])
+        print('%-9d %8d %10.1f %12.2f %12.2f' % (vertices, boundary.cells ** 2,
+                                                 elapsed * 1000, grid, ray))
+
+
+if __name__ == '__main__':
+    main()
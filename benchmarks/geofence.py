@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Geofence Benchmark
+==================
+
+Per-call cost of in_range() (tiered geofence) against running Vincenty's formula
+for every point, for points inside the city, far away from it, and close to its
+border. Run from the repo's root:
+::
+    $ python benchmarks/geofence.py
+"""
+import os
+import sys
+import timeit
+from math import radians, degrees, sqrt, sin, cos, pi
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from snowdonia.geo import snowdonia_center, snowdonia_radius, distance_from_center, in_range
+
+POINTS = 10000
+
+
+def points_around_center(random, min_km, max_km):
+    """Random points whose distance from the center is (roughly) between min_km
+    and max_km, uniformly distributed over the ring's area."""
+    lat_center, long_center = (degrees(c) for c in snowdonia_center)
+    points = []
+    for _ in range(POINTS):
+        r = sqrt(random.uniform((min_km / max_km) ** 2, 1)) * max_km / 111.3
+        t = random.uniform(0, 2 * pi)
+        points.append((lat_center + r * sin(t),
+                       long_center + r * cos(t) / cos(radians(lat_center))))
+    return points
+
+
+def far_points(random):
+    """Random points anywhere on Earth."""
+    return [(random.uniform(-89, 89), random.uniform(-180, 180))
+            for _ in range(POINTS)]
+
+
+def vincenty_in_range(latitude, longitude):
+    """The check in_range() replaces: Vincenty for every point."""
+    return distance_from_center(latitude, longitude) <= snowdonia_radius
+
+
+def per_call(check, points):
+    """Best per-call time (in microseconds) of check over the points."""
+    def run():
+        for latitude, longitude in points:
+            check(latitude, longitude)
+    return min(timeit.repeat(run, number=1, repeat=5)) / len(points) * 1e6
+
+
+def main():
+    random = Random(20161222)
+    sets = [
+        ('inside', points_around_center(random, 0, snowdonia_radius)),
+        ('border', points_around_center(random, snowdonia_radius - 1,
+                                        snowdonia_radius + 1)),
+        ('far', far_points(random)),
+    ]
+    print('%-8s %12s %12s %8s' % ('points', 'vincenty us', 'in_range us', 'speedup'))
+    for name, points in sets:
+        points = [p for p in points if distance_from_center(*p) is not None]
+        before = per_call(vincenty_in_range, points)
+        after = per_call(in_range, points)
+        print('%-8s %12.2f %12.2f %7.1fx' % (name, before, after, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""
+Wire Format Benchmark
+=====================
+
+Per-emission cost of reading a batch of emissions sent as JSON (the form
+fields, with DD-MM-YYYY hh:mm:ss timestamps), msgpack and fixed-width records
+(see snowdonia.wire), from the raw body to the (latitude, longitude, timestamp,
+heading) tuples the endpoints validate, along with the size of each body. Run
+from the repo's root:
+::
+    $ python benchmarks/parsing.py
+"""
+import json
+import os
+import sys
+import timeit
+import uuid
+from datetime import datetime, timedelta
+from random import Random
+
+import msgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from snowdonia import read_emission
+from snowdonia import wire
+from snowdonia.geo import snowdonia_radius
+from geofence import points_around_center
+
+SIZE = 1000
+
+
+def per_emission(run):
+    """Best per-emission time (in microseconds) of run over a batch."""
+    return min(timeit.repeat(run, number=10, repeat=5)) / 10 / SIZE * 1e6
+
+
+def main():
+    random = Random(20161222)
+    points = points_around_center(random, 0, snowdonia_radius)[:SIZE]
+    start = datetime(2016, 12, 22)
+    emissions = [dict(vehicle_id=uuid.UUID(int=random.getrandbits(128)).hex,
+                      type=random.choice(wire.TYPES[1:]), latitude=lat,
+                      longitude=long, heading=random.randint(0, 359),
+                      timestamp=start + timedelta(seconds=i))
+                 for i, (lat, long) in enumerate(points)]
+    as_text = [dict(e, timestamp=e['timestamp'].strftime('%d-%m-%Y %H:%M:%S'))
+               for e in emissions]
+    as_epoch = [dict(e, timestamp=int((e['timestamp'] - wire.EPOCH).total_seconds()))
+                for e in emissions]
+
+    bodies = [
+        ('json', json.dumps(as_text).encode('utf-8'),
+         lambda body: [read_emission(e) for e in json.loads(body.decode('utf-8'))]),
+        ('msgpack', msgpack.packb(as_epoch),
+         lambda body: [read_emission(e) for e in
+                       wire.decode_emissions(wire.MSGPACK[0], body)]),
+        ('records', b''.join(wire.encode_emission(
+             e['latitude'], e['longitude'], e['timestamp'], e['heading'],
+             e['type'], e['vehicle_id']) for e in emissions),
+         lambda body: [read_emission(e) for e in
+                       wire.decode_emissions(wire.RECORD, body)]),
+    ]
+    print('%-8s %12s %14s' % ('format', 'us/emission', 'bytes/emission'))
+    for name, body, read in bodies:
+        print('%-8s %12.2f %14.1f' % (name, per_emission(lambda: read(body)),
+                                      len(body) / float(SIZE)))
+
+
+if __name__ == '__main__':
+    main()
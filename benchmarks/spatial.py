@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Spatial Index Benchmark
+=======================
+
+Per-query cost of finding the vehicles within 500m of a point, and the 5 nearest
+vehicles, with the grid index (see snowdonia.spatial) against calculating the
+distance to every vehicle, for fleets of 1000 and 100k vehicles spread over the
+city. Run from the repo's root:
+::
+    $ python benchmarks/spatial.py
+"""
+import heapq
+import os
+import sys
+import timeit
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from snowdonia.geo import snowdonia_radius, distance_between
+from snowdonia.spatial import GridIndex
+from geofence import points_around_center
+
+FLEETS = [1000, 100000]
+QUERIES = 20
+RADIUS = 0.5
+K = 5
+
+
+def brute_within(points, latitude, longitude, radius):
+    """Vehicles within radius, checking them all."""
+    found = [(key, distance_between(latitude, longitude, lat, long))
+             for key, (lat, long) in points.items()]
+    return sorted((p for p in found if p[1] <= radius), key=lambda p: p[1])
+
+
+def brute_nearest(points, latitude, longitude, k):
+    """The k nearest vehicles, checking them all."""
+    return heapq.nsmallest(k, ((key, distance_between(latitude, longitude, lat, long))
+                               for key, (lat, long) in points.items()),
+                           key=lambda p: p[1])
+
+
+def per_query(run, queries):
+    """Best per-query time (in ms) of run over the queries."""
+    def all_queries():
+        for latitude, longitude in queries:
+            run(latitude, longitude)
+    return min(timeit.repeat(all_queries, number=1, repeat=3)) / len(queries) * 1e3
+
+
+def main():
+    random = Random(20161222)
+    print('%-8s %-8s %12s %12s %8s' % ('fleet', 'query', 'brute ms', 'grid ms',
+                                       'speedup'))
+    for fleet in FLEETS:
+        points = {}
+        while len(points) < fleet:
+            for point in points_around_center(random, 0, snowdonia_radius):
+                points[len(points)] = point
+                if len(points) == fleet:
+                    break
+        index = GridIndex()
+        for key, (lat, long) in points.items():
+            index.update(key, lat, long)
+        queries = points_around_center(random, 0, snowdonia_radius)[:QUERIES]
+        for name, brute, grid in [
+                ('500m', lambda lat, long: brute_within(points, lat, long, RADIUS),
+                         lambda lat, long: index.within(lat, long, RADIUS)),
+                ('5-nn', lambda lat, long: brute_nearest(points, lat, long, K),
+                         lambda lat, long: index.nearest(lat, long, K))]:
+            before = per_query(brute, queries)
+            after = per_query(grid, queries)
+            print('%-8d %-8s %12.3f %12.3f %7.0fx' % (fleet, name, before, after,
+                                                      before / after))
+
+
+if __name__ == '__main__':
+    main()
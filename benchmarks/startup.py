@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+"""
+Startup Benchmark
+=================
+
+How long a freshly started worker takes to import snowdonia and create its app
+(see snowdonia.create_app()), and how fast it serves its first emissions, with
+WARM_UP off and on, against a database of its own (a temporary SQLite database
+by default, or e.g. a local PostgreSQL one with --database) with --vehicles
+registered vehicles. Run from the repo's root:
+::
+    $ python benchmarks/startup.py
+
+For both, it reports the time it took to import snowdonia (which creates
+snowdonia.app), the part of it create_app() took (snowdonia_startup_seconds),
+the latency of the first request, and the mean latency of the first --requests
+requests (every one of them for a vehicle the worker hasn't seen yet) and of the
+same requests once the worker has seen their vehicles (its steady state).
+
+The app reads its settings when it's imported, so every run is a process of its
+own.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+
+def write_settings(database, warm_up):
+    """Points SNOWDONIA_SETTINGS to settings with the database and WARM_UP."""
+    settings = os.path.join(tempfile.mkdtemp(), 'settings.py')
+    with open(settings, 'w') as f:
+        f.write('SQLALCHEMY_DATABASE_URI = %r\nDEBUG = False\nWARM_UP = %r\n'
+                % (database, warm_up))
+    os.environ['SNOWDONIA_SETTINGS'] = settings
+
+
+def fleet(args):
+    """The ids and types of the registered vehicles."""
+    random = Random(20161222)
+    return [(uuid.UUID(int=random.getrandbits(128), version=4).hex,
+             random.choice(['taxi', 'bus', 'tram', 'train']))
+            for _ in range(args.vehicles)]
+
+
+def register(args):
+    """Creates the tables and registers the vehicles."""
+    write_settings(args.database, False)
+    import snowdonia
+    with snowdonia.app.app_context():
+        snowdonia.db.drop_all()
+        snowdonia.db.create_all()
+        snowdonia.db.session.execute(snowdonia.Vehicle.__table__.insert(),
+            [dict(id=vID, type=vType) for vID, vType in fleet(args)])
+        snowdonia.db.session.commit()
+    return {}
+
+
+def serve(args, warm_up):
+    """Imports snowdonia, and times its first requests."""
+    write_settings(args.database, warm_up)
+    started = time.perf_counter()
+    import snowdonia
+    imported = time.perf_counter() - started
+    client = snowdonia.app.test_client()
+    vehicles = fleet(args)[:args.requests]
+
+    def emit(second):
+        latencies = []
+        for vID, vType in vehicles:
+            request_started = time.perf_counter()
+            client.put('/api/v1/emission/' + vID, data=dict(
+                type=vType, latitude=53.067723, longitude=-4.07495, heading=1,
+                timestamp='22-12-2016 00:%02d:%02d' % (second // 60, second % 60)))
+            latencies.append(time.perf_counter() - request_started)
+        return latencies
+
+    first = emit(0)
+    steady = emit(20)
+    return dict(import_ms=imported * 1000,
+                startup_ms=snowdonia.startup_seconds * 1000,
+                first_request_ms=first[0] * 1000,
+                first_requests_ms=sum(first) / len(first) * 1000,
+                steady_ms=sum(steady) / len(steady) * 1000)
+
+
+STEPS = dict(register=register, cold=lambda args: serve(args, False),
+             warm=lambda args: serve(args, True))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Times the startup of a worker.')
+    parser.add_argument('--database', help='database URI (default: temporary '
+                        'SQLite; its tables are dropped)')
+    parser.add_argument('--vehicles', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=100,
+                        help='requests timed, each for another vehicle')
+    parser.add_argument('--step', choices=sorted(STEPS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.step:
+        print(json.dumps(STEPS[args.step](args)))
+        return
+
+    database = args.database or \
+        'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'startup.db')
+    print('%-8s %10s %11s %14s %15s %10s' % ('warm up', 'import ms', 'startup ms',
+                                             'first req ms', 'first %d ms' %
+                                             args.requests, 'steady ms'))
+    for step in ('register', 'cold', 'warm'):
+        output = subprocess.check_output([sys.executable, __file__, '--step', step,
+            '--database', database, '--vehicles', str(args.vehicles),
+            '--requests', str(args.requests)])
+        times = json.loads(output.decode().strip().splitlines()[-1])
+        if step == 'register':
+            continue
+        print('%-8s %10.1f %11.1f %14.2f %15.2f %10.2f' % (
+            'on' if step == 'warm' else 'off', times['import_ms'],
+            times['startup_ms'], times['first_request_ms'],
+            times['first_requests_ms'], times['steady_ms']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+Benchmark Suite
+===============
+
+Reproducible micro-benchmarks of the validation and ingest path, to catch
+performance regressions: distance_from_center(), valid_point() and
+valid_vehicle() in isolation, and the single and batch emission endpoints end
+to end through Flask's test client, against a database of their own (a
+temporary SQLite database by default, or e.g. a local PostgreSQL one with
+--database).
+
+Every benchmark reports its throughput (ops/sec) and the p50/p99 latency of one
+operation (in microseconds), from the best of --repeat runs (3 by default).
+Inputs are generated from fixed seeds, and every benchmark is warmed up before
+it's measured. Every run of the endpoint benchmarks sends emissions (vehicles
+and timestamps) that were never sent before, so none of them are answered as
+duplicates.
+
+Save a baseline (as JSON), then compare later runs against it; the suite exits
+with status 1 if any benchmark's throughput dropped by more than --threshold
+(15% by default) compared to the baseline:
+::
+    $ python benchmarks/suite.py --save benchmarks/baseline.json
+    $ python benchmarks/suite.py --compare benchmarks/baseline.json
+
+Baselines are only comparable on the same machine (and database).
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from itertools import count as counter
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+SAMPLES = 2000
+"""Timed samples per benchmark, after WARM_UP untimed ones."""
+WARM_UP = 200
+
+
+def measure(run, inputs, group=1, warm_up=WARM_UP):
+    """Runs run(input) over the inputs, the first warm_up of them untimed, timing
+    groups of group calls (for calls too fast to time one by one). Returns the
+    ops/sec and the p50/p99 latency of one call in microseconds."""
+    for value in inputs[:warm_up]:
+        run(value)
+    inputs = inputs[warm_up:]
+    latencies = []
+    started = time.perf_counter()
+    for start in range(0, len(inputs) - group + 1, group):
+        group_started = time.perf_counter()
+        for value in inputs[start:start + group]:
+            run(value)
+        latencies.append((time.perf_counter() - group_started) / group)
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    return dict(ops_per_sec=round(len(latencies) * group / elapsed, 1),
+                p50_us=round(percentile(latencies, 50) * 1e6, 2),
+                p99_us=round(percentile(latencies, 99) * 1e6, 2))
+
+
+def percentile(values, p):
+    """The p-th percentile of sorted values (nearest rank)."""
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def benchmarks(snowdonia):
+    """The benchmarks, as (name, run, inputs, group, warm_up) tuples, where
+    inputs() returns the inputs of one run."""
+    from snowdonia.geo import snowdonia_radius, distance_from_center
+    from geofence import points_around_center
+    random = Random(20161222)
+    count = WARM_UP + SAMPLES
+    points = points_around_center(random, 0, snowdonia_radius * 1.2)
+    points = (points * (count // len(points) + 1))[:count]
+    point_inputs = [(lat, long, random.randint(0, 359)) for lat, long in points]
+    vehicle_inputs = [(uuid.UUID(int=random.getrandbits(128), version=4).hex,
+                       random.choice(snowdonia.valid_types)) for _ in range(count)]
+
+    # The endpoints get random points in the city (ones outside of it would
+    # mostly be answered with 403, as their vehicles have left the city) of a
+    # fleet of registered vehicles
+    client = snowdonia.app.test_client()
+    fleet = vehicle_inputs[:100]
+    start = datetime(2016, 12, random.randint(1, 28))
+    city_points = [(lat, long, random.randint(0, 359)) for lat, long in
+                   points_around_center(random, 0, snowdonia_radius * 0.9)]
+    seconds = counter()
+
+    def new_emissions(count):
+        """count emissions that were never sent before, a second apart."""
+        emissions = []
+        for _ in range(count):
+            second = next(seconds)
+            vID, vType = fleet[second % len(fleet)]
+            lat, long, heading = city_points[second % len(city_points)]
+            emissions.append(dict(vehicle_id=vID, type=vType, latitude=lat,
+                                  longitude=long, heading=heading,
+                                  timestamp=(start + timedelta(seconds=second))
+                                            .strftime('%d-%m-%Y %H:%M:%S')))
+        return emissions
+
+    def new_batches():
+        emissions = new_emissions(count * 10)
+        return [json.dumps(emissions[i:i + 100])
+                for i in range(0, len(emissions), 100)]
+
+    def emit(emission):
+        client.put('/api/v1/emission/' + emission['vehicle_id'], data=emission)
+
+    def emit_batch(batch):
+        client.put('/api/v1/emissions', data=batch, content_type='application/json')
+
+    return [
+        ('distance_from_center', lambda p: distance_from_center(p[0], p[1]),
+         lambda: point_inputs, 50, WARM_UP),
+        ('valid_point', lambda p: snowdonia.valid_point(*p), lambda: point_inputs,
+         50, WARM_UP),
+        ('valid_vehicle', lambda v: snowdonia.valid_vehicle(*v),
+         lambda: vehicle_inputs, 50, WARM_UP),
+        ('register_emission', emit, lambda: new_emissions(count), 1, WARM_UP),
+        ('register_emissions_100', emit_batch, new_batches, 1, WARM_UP // 10),
+    ]
+
+
+def compare(results, baseline, threshold):
+    """The benchmarks whose throughput dropped by more than threshold (a
+    fraction) compared to the baseline, as (name, baseline ops/sec, ops/sec)."""
+    return [(name, baseline[name]['ops_per_sec'], result['ops_per_sec'])
+            for name, result in sorted(results.items()) if name in baseline
+            and result['ops_per_sec'] < baseline[name]['ops_per_sec'] * (1 - threshold)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the ingest path.')
+    parser.add_argument('--database', help='database URI (default: temporary SQLite)')
+    parser.add_argument('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare with a baseline')
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help='throughput drop that fails the comparison (0.15 = 15%%)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs of every benchmark (the best one counts)')
+    parser.add_argument('--only', nargs='*', help='names of the benchmarks to run')
+    args = parser.parse_args()
+
+    # The app reads its settings when it's imported
+    directory = tempfile.mkdtemp()
+    settings = os.path.join(directory, 'settings.py')
+    database = args.database or 'sqlite:///' + os.path.join(directory, 'bench.db')
+    with open(settings, 'w') as f:
+        f.write('SQLALCHEMY_DATABASE_URI = %r\nDEBUG = False\n' % database)
+    os.environ['SNOWDONIA_SETTINGS'] = settings
+    import snowdonia
+    with snowdonia.app.app_context():
+        snowdonia.db.create_all()
+
+    results = {}
+    print('%-24s %12s %10s %10s' % ('benchmark', 'ops/sec', 'p50 us', 'p99 us'))
+    for name, run, inputs, group, warm_up in benchmarks(snowdonia):
+        if args.only and name not in args.only:
+            continue
+        results[name] = max((measure(run, inputs(), group, warm_up)
+                             for _ in range(args.repeat)),
+                            key=lambda result: result['ops_per_sec'])
+        print('%-24s %12.1f %10.2f %10.2f' % (name, results[name]['ops_per_sec'],
+                                               results[name]['p50_us'],
+                                               results[name]['p99_us']))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, before, after in regressions:
+            print('REGRESSION %s: %.1f -> %.1f ops/sec (%.0f%%)' % (
+                name, before, after, (after / before - 1) * 100))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
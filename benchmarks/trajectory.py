@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Trajectory Compression Benchmark
+================================
+
+Rows kept, the largest reconstruction error, and the per-emission cost of
+compressing trajectories (see snowdonia.trajectory) with either method, for a
+day's worth of emissions (one every 20 seconds) of a few vehicles, at a few
+tolerances. Run from the repo's root:
+::
+    $ python benchmarks/trajectory.py
+
+Two kinds of traces are compressed:
+
+- locust: the points the load tests emit (see stress_tests/vehicles.py), random
+  anywhere in the city with random headings. Nothing is predictable, so this is
+  the worst case.
+- routes: vehicles driving along routes, in straight runs of a few minutes
+  between turns, at their type's speed, stopping now and then (e.g. at bus
+  stops), with a few meters of GPS noise.
+
+The rows/day column is what the emissions table grows by with the 1000 vehicles
+the API is sized for (4.32M rows a day without compression).
+"""
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+from math import radians, degrees, sin, cos
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from snowdonia import trajectory
+from snowdonia.geo import snowdonia_radius
+from geofence import points_around_center
+
+VEHICLES = 20
+EMISSIONS = 4320
+"""Emissions per vehicle: a day's worth, one every 20 seconds."""
+TOLERANCES = [10, 25, 50]
+SPEEDS = dict(taxi=12.0, bus=8.0, tram=6.0, train=25.0)
+"""Cruising speed of every type of vehicle, in m/s."""
+
+
+def locust_trace(random, start):
+    """Random points anywhere in the city, like the load tests emit."""
+    points = points_around_center(random, 0, snowdonia_radius)[:EMISSIONS]
+    return [(start + timedelta(seconds=20 * i), lat, long, random.randint(0, 359))
+            for i, (lat, long) in enumerate(points)]
+
+
+def route_trace(random, start, vType):
+    """A vehicle driving straight for a few minutes, then turning, stopping for
+    a while now and then, with GPS noise of a few meters."""
+    lat, long = points_around_center(random, 0, snowdonia_radius / 2)[0]
+    heading = random.uniform(0, 360)
+    straight = stopped = 0
+    points = []
+    for i in range(EMISSIONS):
+        noise = [random.gauss(0, 3) / trajectory.EARTH_RADIUS for _ in range(2)]
+        points.append((start + timedelta(seconds=20 * i),
+                       lat + degrees(noise[0]),
+                       long + degrees(noise[1] / cos(radians(lat))),
+                       int(heading) % 360))
+        if stopped:
+            stopped -= 1
+            continue
+        if straight <= 0:
+            heading = (heading + random.choice([-90, -45, 45, 90])) % 360
+            straight = random.randint(6, 30)
+            if random.random() < 0.3:
+                stopped = random.randint(1, 4)
+        straight -= 1
+        distance = SPEEDS[vType] * random.uniform(0.9, 1.1) * 20 / trajectory.EARTH_RADIUS
+        lat += degrees(distance * cos(radians(heading)))
+        long += degrees(distance * sin(radians(heading)) / cos(radians(lat)))
+    return points
+
+
+def main():
+    random = Random(20161222)
+    start = datetime(2016, 12, 22)
+    traces = [
+        ('locust', [locust_trace(random, start) for _ in range(VEHICLES)]),
+        ('routes', [route_trace(random, start, list(SPEEDS)[i % len(SPEEDS)])
+                    for i in range(VEHICLES)]),
+    ]
+    print('%-7s %-16s %9s %8s %11s %12s %13s' % (
+        'trace', 'method', 'tolerance', 'kept %', 'rows/day', 'max error m',
+        'us/emission'))
+    for name, vehicles in traces:
+        for method in trajectory.METHODS:
+            for tolerance in TOLERANCES:
+                kept = [trajectory.compress(points, tolerance, method)
+                        for points in vehicles]
+                fraction = sum(map(len, kept)) / float(VEHICLES * EMISSIONS)
+                error = max(trajectory.max_error(points, k, method)
+                            for points, k in zip(vehicles, kept))
+                elapsed = min(timeit.repeat(lambda: trajectory.compress(
+                    vehicles[0], tolerance, method), number=1, repeat=3))
+                print('%-7s %-16s %9d %8.1f %11d %12.1f %13.2f' % (
+                    name, method, tolerance, fraction * 100,
+                    fraction * 1000 * EMISSIONS, error,
+                    elapsed / EMISSIONS * 1e6))
+
+
+if __name__ == '__main__':
+    main()
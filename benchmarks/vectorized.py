@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Vectorized Validation Benchmark
+===============================
+
+Per-point cost of validating a batch of points with valid_points() (NumPy)
+against calling valid_point() in a Python loop, for several batch sizes. Run
+from the repo's root:
+::
+    $ python benchmarks/vectorized.py
+"""
+import os
+import sys
+import timeit
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from snowdonia import valid_point
+from snowdonia.geo import snowdonia_radius
+from snowdonia.vectorized import valid_points
+from geofence import points_around_center
+
+SIZES = [10, 100, 1000, 10000]
+
+
+def per_point(run, size):
+    """Best per-point time (in microseconds) of run over a batch of size points."""
+    return min(timeit.repeat(run, number=1, repeat=5)) / size * 1e6
+
+
+def main():
+    random = Random(20161222)
+    print('%-8s %12s %12s %8s' % ('batch', 'loop us', 'numpy us', 'speedup'))
+    for size in SIZES:
+        points = points_around_center(random, 0, snowdonia_radius + 5)[:size]
+        latitudes = [p[0] for p in points]
+        longitudes = [p[1] for p in points]
+        headings = [random.randint(0, 359) for _ in points]
+        loop = per_point(lambda: [valid_point(*p) for p in
+                                  zip(latitudes, longitudes, headings)], size)
+        numpy = per_point(lambda: valid_points(latitudes, longitudes, headings), size)
+        print('%-8d %12.2f %12.2f %7.1fx' % (size, loop, numpy, loop / numpy))
+
+
+if __name__ == '__main__':
+    main()
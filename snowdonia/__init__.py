@@ -21,41 +21,135 @@ The request should be of type PUT, and the data that are expected by the API are
 - **heading**: an angle between 0 (True North) and 359 that indicates where the vehicle's heading.
 
 Please note that this API is only for public vehicles in Snowdonia, so any co-ordinates outside of 
-Snowdonia's 50km radius will yield an error. See snowdonia.register_emission(vehicleID) below for details.
+Snowdonia's 50km radius (or its borders, if they're configured, see snowdonia.boundary) will yield an error. See snowdonia.register_emission(vehicleID) below for details.
+
+Gateways that aggregate several emitters can send many emissions (for many vehicles)
+in one request instead:
+::
+    /api/v1/emissions
+
+The request should be of type PUT, with a JSON array of emissions as its body. Every
+emission carries the fields above plus a **vehicle_id**. See
+snowdonia.register_emissions() below for details.
+
+Emitters on slow or metered links can send the same fields as msgpack or as
+fixed-width binary records instead, picked by the request's Content-Type. See
+snowdonia.wire below for the formats.
+
+They can also send them as UDP datagrams, to the server started by the udp
+command. See snowdonia.udp below for details.
+
+gunicorn snowdonia:app serves snowdonia.app, which is created (by create_app())
+when it's first used, or when snowdonia is imported with WARM_UP on. Tests and
+tools can create apps of their own with create_app(), which also warms workers
+up with WARM_UP on (see warm_up()).
 
 """
-from flask import Flask, request, render_template
+from flask import Flask, Blueprint, Response, current_app, request, \
+                  render_template, jsonify, stream_with_context
+from flask.cli import with_appcontext
+from flask.config import Config
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
-from math import radians, sqrt, sin, cos, atan, tan, pi, atan2
+from sqlalchemy import event, exc, func, and_, tuple_
+from sqlalchemy.dialects import postgresql
+from datetime import datetime, timedelta
+import asyncio
+import atexit
+import click
+import functools
+import hashlib
+import json
+import multiprocessing
 import re
 import os
+import signal
+import threading
+import time
+import weakref
+from .admission import AdmissionControl
+from .buffer import EmissionBuffer
+from .cache import LRUCache, RecentKeys
+from .vectorized import valid_points
+from .spatial import GridIndex
+from .heatmap import HeatmapCounter
+from .writers import ShardRouter
+from .compact import VehicleUUID, VehicleType
+from . import partitions, export, wire, udp, geo, trajectory, heatmap, writers, \
+              compact, boundary
+from .metrics import Metrics, ITERATION_BUCKETS
+from .geo import snowdonia_center, snowdonia_radius, distance_from_center, \
+                 distance_between, haversine_from_center, in_range
+
+settings = Config(os.path.dirname(os.path.abspath(__file__)))
+settings.from_pyfile('config.py')
+settings.from_envvar('SNOWDONIA_SETTINGS', silent=True)
+"""The settings in config.py, overridden by the ones in the file SNOWDONIA_SETTINGS
+points to, read once, when snowdonia is imported. The apps create_app() creates
+start from them. The ones that shape the tables and the state of the worker
+(COMPACT_SCHEMA, EMISSIONS_PARTITION, BOUNDARY, METRICS, WRITE_BEHIND, WRITERS,
+the sizes of the caches and the settings of admission control) are only ever
+read from here."""
+db = SQLAlchemy()
+api = Blueprint('api', __name__)
+"""The API's routes, registered on the apps create_app() creates."""
+commands = []
+"""The CLI commands (see command()), added to the apps create_app() creates."""
 
-app = Flask(__name__)
-app.config.from_pyfile('config.py')
-db = SQLAlchemy(app)
+def command(name):
+    """Declares the function as the CLI command name, run in an app context."""
+    def declare(f):
+        cli_command = click.command(name)(with_appcontext(f))
+        commands.append(cli_command)
+        return cli_command
+    return declare
+
+partitioned = settings.get('EMISSIONS_PARTITION') in partitions.INTERVALS
+"""Whether emissions are stored in day/week partitions (see snowdonia.partitions)."""
+compact_schema = settings.get('COMPACT_SCHEMA', False)
+"""Whether tables use the compact schema (see snowdonia.compact)."""
+worker_metrics = Metrics(settings.get('METRICS', False),
+                         settings.get('METRICS_DIR'),
+                         settings.get('METRICS_FLUSH_INTERVAL', 5))
+"""Metrics of this worker (see snowdonia.metrics)."""
+worker_metrics.counter('snowdonia_emissions_total', 'Emissions registered, by result.')
+worker_metrics.histogram('snowdonia_vincenty_iterations',
+                  'Iterations Vincenty\'s formula took to converge.',
+                  ITERATION_BUCKETS)
+if worker_metrics.enabled:
+    geo.on_vincenty = lambda iterations: \
+        worker_metrics.observe('snowdonia_vincenty_iterations', iterations)
 
 valid_types = ['taxi', 'bus', 'tram', 'train']
-"""Valid types of vehicles in Snowdonia."""
-snowdonia_center = (radians(53.068889), radians(-4.075556))
-"""(lat, long) radian co-ordinates for the town center. Fun fact: This points
-to the Snowdonia region in Wales."""
+"""Valid types of vehicles in Snowdonia. With COMPACT_SCHEMA on, types are
+stored as their index in the list, so new types go at its end."""
+
+VehicleID = VehicleUUID() if compact_schema else db.String(32)
+"""Column type of vehicle UUIDs."""
 
 class Vehicle(db.Model):
     """Database model for vehicles. Contains:
 
     - id (str, UUID4)
     - type (str): taxi, tram, bus, or train
+
+    With COMPACT_SCHEMA on, the primary key is key (int, auto-incremented)
+    instead of id, which emissions reference (see snowdonia.compact).
     """
     __tablename__ = 'vehicles'
-    id = db.Column(db.String(32), primary_key=True)
-    type = db.Column(db.String)
+    if compact_schema:
+        key = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    id = db.Column(VehicleID, primary_key=not compact_schema, unique=compact_schema,
+                   nullable=False)
+    type = db.Column(VehicleType(valid_types) if compact_schema else db.String)
     emissions = db.relationship('Emission', backref='vehicle', lazy='dynamic')
 
     def __init__(self, id, type):
         self.id = id
         self.type = type
 
+emission_vehicle_column = 'vehicle_key' if compact_schema else 'vehicle_id'
+"""The column of emissions that references their vehicle."""
+
 class Emission(db.Model):
     """Database model for emissions. Contains:
     
@@ -65,132 +159,1217 @@ class Emission(db.Model):
     - longitude (float from -180 to 180)
     - timestamp (DateTime)
     - heading (int, angle, from 0 - True North - to 359)
+
+    Emissions are unique (and indexed) by (vehicle_id, timestamp), so an emission
+    that is sent twice is only registered once. If they're partitioned by
+    timestamp, the timestamp is part of the primary key too, since PostgreSQL
+    needs the partition key in it.
+
+    With COMPACT_SCHEMA on, vehicle_key (foreign key referencing the key in
+    vehicles) replaces vehicle_id, and the coordinates and heading take less
+    space (see snowdonia.compact). An emission is still created with the
+    vehicle's id then, which raises ValueError if the vehicle isn't registered
+    (or added to the session).
     """
     __tablename__ = 'emissions'
-    id = db.Column(db.Integer, primary_key=True)
-    vehicle_id = db.Column(db.String(32), db.ForeignKey('vehicles.id'))
-    latitude = db.Column(db.Float)
-    longitude = db.Column(db.Float)
-    timestamp = db.Column(db.DateTime)
-    heading = db.Column(db.Integer)
+    __table_args__ = (
+        db.UniqueConstraint(emission_vehicle_column, 'timestamp',
+                            name='uq_emissions_%s_timestamp' % emission_vehicle_column),
+        dict(info=dict(partition_by='RANGE (timestamp)') if partitioned else {}),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    if compact_schema:
+        vehicle_key = db.Column(db.Integer, db.ForeignKey('vehicles.key'))
+    else:
+        vehicle_id = db.Column(db.String(32), db.ForeignKey('vehicles.id'))
+    latitude = db.Column(db.Float(precision=24) if compact_schema else db.Float)
+    longitude = db.Column(db.Float(precision=24) if compact_schema else db.Float)
+    timestamp = db.Column(db.DateTime, primary_key=partitioned)
+    heading = db.Column(db.SmallInteger if compact_schema else db.Integer)
 
     def __init__(self, vehicle_id, latitude, longitude, timestamp, heading):
-        self.vehicle_id = vehicle_id
+        if compact_schema:
+            keys = vehicle_keys_of(db.session, [vehicle_id])
+            if vehicle_id not in keys:
+                db.session.flush() # the vehicle may have just been added
+                keys = vehicle_keys_of(db.session, [vehicle_id])
+            if vehicle_id not in keys:
+                raise ValueError('Vehicle %s is not registered.' % vehicle_id)
+            self.vehicle_key = keys[vehicle_id]
+        else:
+            self.vehicle_id = vehicle_id
         self.latitude = latitude
         self.longitude = longitude
         self.timestamp = timestamp
         self.heading = heading
 
+emission_vehicle = getattr(Emission, emission_vehicle_column)
+emission_vehicles = (Vehicle.key if compact_schema else Vehicle.id) == emission_vehicle
+"""Joins emissions with their vehicles."""
+
+class VehiclePosition(db.Model):
+    """Database model for the last known position of every vehicle, kept up to
+    date as emissions are registered, so that the current position of the whole
+    fleet can be read without going through its emissions. Contains:
+
+    - vehicle_id (foreign key referencing the UUID in vehicles)
+    - latitude, longitude, timestamp and heading of its newest emission
+    """
+    __tablename__ = 'vehicle_positions'
+    vehicle_id = db.Column(VehicleID, db.ForeignKey('vehicles.id'),
+                           primary_key=True)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    timestamp = db.Column(db.DateTime)
+    heading = db.Column(db.Integer)
+
+class VehicleHour(db.Model):
+    """Database model for the hourly rollups of the emissions of every vehicle,
+    kept up to date as emissions are registered (with ROLLUPS on), so that fleet
+    statistics can be read without going through the emissions. Contains:
+
+    - vehicle_id (foreign key referencing the UUID in vehicles)
+    - hour (DateTime): start of the hour
+    - emissions (int): emissions of the vehicle in that hour
+    - distance (float): kms the vehicle travelled in straight lines between
+      consecutive emissions, counted in the hour of the later one
+    """
+    __tablename__ = 'vehicle_hours'
+    __table_args__ = (db.Index('ix_vehicle_hours_hour', 'hour'),)
+    vehicle_id = db.Column(VehicleID, db.ForeignKey('vehicles.id'),
+                           primary_key=True)
+    hour = db.Column(db.DateTime, primary_key=True)
+    emissions = db.Column(db.Integer)
+    distance = db.Column(db.Float)
+
+class HeatCell(db.Model):
+    """Database model for the heatmap (see snowdonia.heatmap): the number of
+    emissions in every cell of the grid, per time bucket. Contains:
+
+    - level (int): the zoom of the cells, as tiles (tile zoom + CELL_BITS)
+    - x, y (int): the cell, as a tile of that zoom
+    - bucket (DateTime): start of the time bucket
+    - emissions (int)
+    """
+    __tablename__ = 'heat_cells'
+    level = db.Column(db.SmallInteger, primary_key=True, autoincrement=False)
+    x = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    y = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    emissions = db.Column(db.Integer)
+
+class TrajectorySegment(db.Model):
+    """Database model for the stretches of trajectories whose emissions were
+    compressed (see snowdonia.trajectory), so that they can be reconstructed.
+    Contains:
+
+    - vehicle_id (foreign key referencing the UUID in vehicles)
+    - start, end (DateTime): timestamps of the first and last emissions of the
+      stretch, which are always kept
+    - method (str): dead_reckoning or douglas_peucker
+    - tolerance (float): how far (in meters) from a dropped emission its
+      reconstruction can be
+    - emissions, kept (int): emissions in the stretch, before and after it was
+      compressed
+    """
+    __tablename__ = 'trajectory_segments'
+    vehicle_id = db.Column(VehicleID, db.ForeignKey('vehicles.id'),
+                           primary_key=True)
+    start = db.Column(db.DateTime, primary_key=True)
+    end = db.Column(db.DateTime)
+    method = db.Column(db.String(16))
+    tolerance = db.Column(db.Float)
+    emissions = db.Column(db.Integer)
+    kept = db.Column(db.Integer)
+
+class ExitedVehicle(db.Model):
+    """Database model for the vehicles that left the city: once a vehicle has
+    emitted from outside of the town borders, its emissions are disregarded
+    (with EXITED_VEHICLES on), until it's re-admitted with the readmit command.
+    Contains:
+
+    - vehicle_id (foreign key referencing the UUID in vehicles)
+    - latitude, longitude and timestamp of its first emission outside of the
+      borders
+    """
+    __tablename__ = 'exited_vehicles'
+    vehicle_id = db.Column(VehicleID, db.ForeignKey('vehicles.id'),
+                           primary_key=True)
+    latitude = db.Column(db.Float)
+    longitude = db.Column(db.Float)
+    timestamp = db.Column(db.DateTime)
+
+@event.listens_for(Emission.__table__, 'after_create')
+def create_emission_partitions(table, connection, **kw):
+    """Creates the first partitions of a newly created partitioned emissions table."""
+    if partitioned and connection.dialect.name == 'postgresql':
+        partitions.create_partitions(connection, table.name,
+                                     current_app.config['EMISSIONS_PARTITION'],
+                                     current_app.config.get('EMISSIONS_PARTITIONS_AHEAD', 3))
+
+@command('partitions')
+def maintain_partitions():
+    """Creates the upcoming emissions partitions, and drops the ones older than
+    EMISSIONS_RETENTION_DAYS (if set). Meant to run daily, see snowdonia.partitions."""
+    if not partitioned:
+        print('Emissions are not partitioned (see EMISSIONS_PARTITION).')
+        return
+    interval = current_app.config['EMISSIONS_PARTITION']
+    retention_days = current_app.config.get('EMISSIONS_RETENTION_DAYS')
+    with db.engine.begin() as connection:
+        created = partitions.create_partitions(connection, Emission.__tablename__,
+                    interval, current_app.config.get('EMISSIONS_PARTITIONS_AHEAD', 3))
+        dropped = partitions.drop_partitions(connection, Emission.__tablename__,
+                    interval, retention_days) if retention_days else []
+    print('Partitions up to %s exist. Dropped: %s' % (created[-1],
+                                                      ', '.join(dropped) or 'none'))
+
+@command('compact')
+def compact_tables():
+    """Migrates the tables to the compact schema, on PostgreSQL. Run it with
+    COMPACT_SCHEMA on, while the app is stopped, see snowdonia.compact."""
+    if not compact_schema:
+        print('Turn COMPACT_SCHEMA on first (see snowdonia.compact).')
+        return
+    if db.engine.dialect.name != 'postgresql' or partitioned:
+        print('Only unpartitioned tables on PostgreSQL can be migrated.')
+        return
+    with db.engine.begin() as connection:
+        if compact.migrated(connection):
+            print('The tables already are in the compact schema.')
+            return
+        before = compact.table_sizes(connection, Emission.__tablename__)
+        copied = compact.migrate(connection, Emission.__table__, valid_types,
+                                 [model.__tablename__ for model in
+                                  (VehiclePosition, VehicleHour, TrajectorySegment,
+                                   ExitedVehicle)])
+    with db.engine.connect() as connection:
+        after = compact.table_sizes(connection, Emission.__tablename__)
+    print('Migrated %d emission(s).' % copied)
+    for name, sizes in (('Before', before), ('After', after)):
+        print('%s: %d bytes per row (%d stored), %d index bytes per row.' % (
+            name, sizes['table_bytes_per_row'] or 0, sizes['row_bytes'],
+            sizes['index_bytes_per_row'] or 0))
+
+def insert_ignore(table):
+    """An INSERT into the table that skips rows whose key already exists instead
+    of failing (ON CONFLICT DO NOTHING), so that two workers registering the same
+    new vehicle at the same time don't make one of the requests fail, and an
+    emission that is sent twice is only registered once."""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return table.insert().prefix_with('OR IGNORE')
+    if dialect == 'mysql':
+        return table.insert().prefix_with('IGNORE')
+    return table.insert()
+
+recent_emissions = RecentKeys(settings.get('DEDUP_CACHE_SIZE', 100000),
+                              settings.get('DEDUP_WINDOW', 600))
+"""(vehicle_id, timestamp) of the emissions this worker committed in the last
+DEDUP_WINDOW seconds, so that retries of an emission are answered as duplicates
+without touching the database."""
+
+def emission_key(row):
+    """What identifies an emission: its vehicle and timestamp."""
+    return row['vehicle_id'], row['timestamp']
+
+def remember_emissions(rows):
+    """Adds the emission rows, once they're committed, to recent_emissions."""
+    for row in rows:
+        recent_emissions.add(emission_key(row))
+
+vehicle_keys = LRUCache(settings.get('VEHICLE_CACHE_SIZE', 10000))
+"""Keys of the vehicles this worker registered emissions of, by id, with
+COMPACT_SCHEMA on. A vehicle's key never changes."""
+
+def vehicle_keys_of(connection, ids):
+    """The keys (with COMPACT_SCHEMA on) of the vehicles with the given ids, as
+    a dict, looking up the ones that aren't in vehicle_keys in the connection's
+    (or session's) transaction. Vehicles that aren't registered are left out."""
+    keys = dict((vID, vehicle_keys.get(vID)) for vID in ids if vID in vehicle_keys)
+    unknown = dict((vID.lower(), vID) for vID in ids if vID not in keys)
+    if unknown:
+        table = Vehicle.__table__
+        for row in connection.execute(table.select().where(
+                table.c.id.in_(list(unknown)))):
+            vehicle_keys.set(unknown[row.id], row.key)
+            keys[unknown[row.id]] = row.key
+    return keys
+
+def of_vehicle(vID):
+    """Filters emissions down to the ones of a vehicle."""
+    if compact_schema:
+        return Emission.vehicle_key == vehicle_keys_of(db.session, [vID]).get(vID)
+    return Emission.vehicle_id == vID
+
+def emission_values(connection, rows):
+    """The column values of emission rows: the rows themselves, or with
+    COMPACT_SCHEMA on, the rows with the keys of their vehicles instead of
+    their ids."""
+    if not compact_schema:
+        return rows
+    keys = vehicle_keys_of(connection, set(row['vehicle_id'] for row in rows))
+    values = []
+    for row in rows:
+        value = dict(row)
+        value['vehicle_key'] = keys[value.pop('vehicle_id')]
+        values.append(value)
+    return values
+
+def insert_emissions(connection, rows):
+    """Inserts the emission rows (dicts of Emission column values) in the
+    connection's (or session's) transaction, skipping the ones that are already
+    registered (same vehicle and timestamp). Returns the rows that were inserted.
+    """
+    table = Emission.__table__
+    vehicle = table.c[emission_vehicle_column]
+    values = emission_values(connection, rows)
+    keys = [(value[vehicle.name], value['timestamp']) for value in values]
+    if db.engine.dialect.name == 'postgresql':
+        inserted = set(tuple(key) for key in connection.execute(
+            insert_ignore(table).values(values).returning(vehicle, table.c.timestamp)))
+        new, seen = [], set()
+        for row, key in zip(rows, keys):
+            if key in inserted and key not in seen: # the first of its duplicates
+                new.append(row)
+                seen.add(key)
+        return new
+    existing = set((getattr(row, vehicle.name), row.timestamp)
+                   for row in connection.execute(table.select().where(
+                       tuple_(vehicle, table.c.timestamp).in_(keys))))
+    new, new_values, seen = [], [], set()
+    for row, value, key in zip(rows, values, keys):
+        if key not in existing and key not in seen:
+            new.append(row)
+            new_values.append(value)
+            seen.add(key)
+    if new:
+        connection.execute(insert_ignore(table).values(new_values))
+    return new
+
+latest_positions = LRUCache(settings.get('VEHICLE_CACHE_SIZE', 10000))
+"""Timestamp of the newest position this worker committed for each vehicle, so
+that it doesn't even try to write positions that are older."""
+
+def update_positions(connection, rows):
+    """Moves the vehicles of the emission rows (dicts of Emission column values)
+    to their new positions in vehicle_positions, in the connection's (or
+    session's) transaction. A vehicle's position only moves forward in time: an
+    emission older than the vehicle's position is ignored, which is checked by
+    the database too, since other workers write positions as well.
+
+    Returns the rows that moved their vehicles (as far as this worker knows),
+    for index_positions() once they're committed.
+    """
+    newest = {}
+    for row in rows:
+        vID = row['vehicle_id']
+        current = newest[vID]['timestamp'] if vID in newest \
+                  else latest_positions.get(vID)
+        if current is None or row['timestamp'] > current:
+            newest[vID] = row
+    if not newest:
+        return []
+    table = VehiclePosition.__table__
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(list(newest.values()))
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c.vehicle_id],
+            set_=dict((column, getattr(statement.excluded, column)) for column in
+                      ('latitude', 'longitude', 'timestamp', 'heading')),
+            where=table.c.timestamp < statement.excluded.timestamp))
+    else:
+        for vID, row in newest.items():
+            updated = connection.execute(table.update().values(row).where(
+                and_(table.c.vehicle_id == vID, table.c.timestamp < row['timestamp'])))
+            if updated.rowcount == 0:
+                connection.execute(insert_ignore(table).values(row))
+    return list(newest.values())
+
+vehicle_index = GridIndex(settings.get('SPATIAL_INDEX_CELL_SIZE', 1.0))
+"""Spatial index of the current positions of vehicles (see snowdonia.spatial),
+with their types as values. It's updated as this worker registers emissions, and
+reloaded from vehicle_positions every SPATIAL_INDEX_REFRESH seconds to pick up
+the ones registered by other workers."""
+_vehicle_index_loaded = 0
+
+def index_positions(rows):
+    """Moves the vehicles of the emission rows (as returned by update_positions),
+    once they're committed, in vehicle_index and latest_positions, unless they're
+    older than the positions this worker knows of."""
+    for row in rows:
+        current = latest_positions.get(row['vehicle_id'])
+        if current is not None and row['timestamp'] <= current:
+            continue
+        latest_positions.set(row['vehicle_id'], row['timestamp'])
+        point = vehicle_index.get(row['vehicle_id'])
+        vType = known_vehicles.get(row['vehicle_id'],
+                                   point[2] if point is not None else None)
+        vehicle_index.update(row['vehicle_id'], row['latitude'], row['longitude'],
+                             vType)
+
+def hour_of(timestamp):
+    """The start of the hour that timestamp is in."""
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+def increment(connection, table, keys, rows):
+    """Adds the rows (dicts of column values) to the table, in the connection's
+    (or session's) transaction: rows whose keys (column names) are already in
+    the table have their other columns added to the existing ones, and the
+    others are inserted. Rows are written in the order of their keys, so that
+    concurrent transactions lock them in the same order."""
+    if not rows:
+        return
+    rows = sorted(rows, key=lambda row: tuple(row[key] for key in keys))
+    columns = [column for column in rows[0] if column not in keys]
+    if db.engine.dialect.name == 'postgresql':
+        statement = postgresql.insert(table).values(rows)
+        connection.execute(statement.on_conflict_do_update(
+            index_elements=[table.c[key] for key in keys],
+            set_=dict((column, table.c[column] + getattr(statement.excluded, column))
+                      for column in columns)))
+        return
+    for row in rows:
+        updated = connection.execute(table.update().values(dict(
+            (column, table.c[column] + row[column]) for column in columns)).where(
+            and_(*[table.c[key] == row[key] for key in keys])))
+        if updated.rowcount == 0:
+            connection.execute(table.insert().values(row))
+
+def add_vehicle_hours(connection, totals):
+    """Adds the {(vehicle_id, hour): [emissions, distance]} totals to
+    vehicle_hours, in the connection's (or session's) transaction."""
+    increment(connection, VehicleHour.__table__, ('vehicle_id', 'hour'),
+              [dict(vehicle_id=vID, hour=hour, emissions=emissions, distance=distance)
+               for (vID, hour), (emissions, distance) in totals.items()])
+
+def update_rollups(connection, rows):
+    """Adds the emission rows that were just inserted (in the connection's, or
+    session's, transaction) to vehicle_hours. Every emission is counted in its
+    hour, along with the distance from the vehicle's previous emission, as found
+    in vehicle_positions, so this has to run before update_positions(). On
+    PostgreSQL, the positions are locked until the transaction ends, so that
+    concurrent emissions of a vehicle are measured one after the other.
+
+    An emission older than its vehicle's position arrived out of order, and is
+    counted without a distance (the distance between the emissions around it
+    was counted already). Rebuilding the rollups (see the rollups command)
+    counts it exactly.
+    """
+    if not rows:
+        return
+    table = VehiclePosition.__table__
+    query = table.select().where(table.c.vehicle_id.in_(
+                set(row['vehicle_id'] for row in rows)))
+    if db.engine.dialect.name == 'postgresql':
+        query = query.with_for_update()
+    previous = dict((row.vehicle_id, dict(timestamp=row.timestamp,
+                                          latitude=row.latitude,
+                                          longitude=row.longitude))
+                    for row in connection.execute(query))
+    totals = {}
+    for row in sorted(rows, key=lambda row: row['timestamp']):
+        vID = row['vehicle_id']
+        total = totals.setdefault((vID, hour_of(row['timestamp'])), [0, 0.0])
+        total[0] += 1
+        last = previous.get(vID)
+        if last is None or row['timestamp'] > last['timestamp']:
+            if last is not None:
+                total[1] += distance_between(last['latitude'], last['longitude'],
+                                             row['latitude'], row['longitude']) or 0
+            previous[vID] = row
+    add_vehicle_hours(connection, totals)
+
+def track_emissions(connection, rows):
+    """Keeps what's derived from the emission rows that were just inserted up
+    to date, in the connection's (or session's) transaction: the rollups (with
+    ROLLUPS on), then the vehicles' positions. Returns the rows that moved their
+    vehicles (see update_positions()). The heatmap is counted once they're
+    committed (see count_heat())."""
+    if current_app.config.get('ROLLUPS', False):
+        update_rollups(connection, rows)
+    return update_positions(connection, rows)
+
+def current_heat_counter():
+    """Heatmap counts of the emissions the current app registered in this worker
+    since it last added them to heat_cells (see snowdonia.heatmap), or None if
+    HEATMAP is off."""
+    return current_app.extensions['snowdonia']['heat_counter']
+
+_heatmap_flusher_lock = threading.Lock()
+
+def count_heat(rows):
+    """Counts the emission rows, once they're committed, in the current app's
+    heat counter (if HEATMAP is on), starting its heatmap flusher in this worker
+    if it isn't running yet."""
+    heat_counter = current_heat_counter()
+    if heat_counter is None or not rows:
+        return
+    start_heatmap_flusher(current_app._get_current_object())
+    for row in rows:
+        heat_counter.add(row['latitude'], row['longitude'], row['timestamp'])
+
+def start_heatmap_flusher(app):
+    """Starts the thread that adds the counts of the app's heat counter to
+    heat_cells every HEATMAP_FLUSH_INTERVAL seconds, outside of requests, unless
+    it's running in this process already. Threads don't survive a fork, so every
+    worker starts its own."""
+    state = app.extensions['snowdonia']
+    if state['heatmap_flusher_pid'] == os.getpid():
+        return
+    with _heatmap_flusher_lock:
+        if state['heatmap_flusher_pid'] == os.getpid():
+            return
+        thread = threading.Thread(target=run_heatmap_flusher,
+                                  args=(weakref.ref(app),), name='heatmap-flusher')
+        thread.daemon = True
+        thread.start()
+        state['heatmap_flusher_pid'] = os.getpid()
+
+def run_heatmap_flusher(app_ref):
+    """Heatmap flusher loop, see start_heatmap_flusher(). It stops once the app
+    is gone."""
+    interval = app_ref().config.get('HEATMAP_FLUSH_INTERVAL', 5)
+    while True:
+        time.sleep(interval)
+        app = app_ref()
+        if app is None:
+            return
+        flush_heatmap(app)
+        del app # so that it can go away while this sleeps
+
+def add_heat_cells(connection, counts):
+    """Adds the counts (as returned by HeatmapCounter.drain()) to heat_cells, in
+    the connection's (or session's) transaction."""
+    increment(connection, HeatCell.__table__, ('level', 'x', 'y', 'bucket'),
+              [dict(level=level, x=x, y=y, bucket=bucket, emissions=count)
+               for (level, x, y, bucket), count in counts.items()])
+
+def flush_heatmap(app=None):
+    """Adds the counts of the app's heat counter (the current app's if none is
+    given) to heat_cells, in a transaction of its own. Counts that can't be
+    written are kept for the next time."""
+    if app is None:
+        app = current_app._get_current_object()
+    heat_counter = app.extensions['snowdonia']['heat_counter']
+    if heat_counter is None:
+        return
+    counts = heat_counter.drain()
+    if not counts:
+        return
+    try:
+        with app.app_context():
+            with db.engine.begin() as connection:
+                add_heat_cells(connection, counts)
+    except Exception:
+        app.logger.exception('Could not write %d heatmap cell(s)', len(counts))
+        heat_counter.merge(counts)
+
+def flush_heatmaps():
+    """Flushes the heat counters of all the apps (see flush_heatmap()), when the
+    worker exits."""
+    for heat_app in list(apps):
+        flush_heatmap(heat_app)
+
+atexit.register(flush_heatmaps)
+
+def emissions_committed(rows):
+    """Keeps the caches of this worker (recent_emissions, latest_positions and
+    vehicle_index) and the current app's heat counter up to date with the emission rows that were
+    written once they're committed. Used by the write-behind buffer and the
+    writers, after every write."""
+    remember_emissions(rows)
+    index_positions(rows)
+    count_heat(rows)
+
+def load_vehicle_index():
+    """Reloads vehicle_index from vehicle_positions if it's been more than
+    SPATIAL_INDEX_REFRESH seconds since it was last loaded."""
+    global _vehicle_index_loaded
+    if time.time() - _vehicle_index_loaded < \
+       current_app.config.get('SPATIAL_INDEX_REFRESH', 10):
+        return
+    query = db.session.query(VehiclePosition.vehicle_id, VehiclePosition.latitude,
+                             VehiclePosition.longitude, Vehicle.type) \
+              .join(Vehicle, Vehicle.id == VehiclePosition.vehicle_id)
+    for vID, latitude, longitude, vType in query:
+        vehicle_index.update(vID, latitude, longitude, vType)
+    _vehicle_index_loaded = time.time()
+
+@command('positions')
+def rebuild_positions():
+    """Rebuilds vehicle_positions from the newest emission of every vehicle, e.g.
+    for emissions registered before positions were kept."""
+    newest = db.session.query(emission_vehicle.label('vehicle'),
+                              func.max(Emission.timestamp).label('timestamp')) \
+                .group_by(emission_vehicle).subquery()
+    query = db.session.query(Emission, Vehicle.id) \
+              .join(Vehicle, emission_vehicles) \
+              .join(newest, and_(emission_vehicle == newest.c.vehicle,
+                                 Emission.timestamp == newest.c.timestamp))
+    latest_positions.clear()
+    count = 0
+    for emission, vID in query.yield_per(1000):
+        update_positions(db.session, [dict(vehicle_id=vID,
+            latitude=emission.latitude, longitude=emission.longitude,
+            timestamp=emission.timestamp, heading=emission.heading)])
+        count += 1
+    db.session.commit()
+    print('Positions of %d vehicle(s) rebuilt.' % count)
+
+def roll_up(start=None, end=None):
+    """Rebuilds vehicle_hours from the emissions, from the hour start is in
+    (inclusive) to the hour end is in (exclusive), if given. Emissions are read
+    in order with a server-side cursor, and the first one of every vehicle is
+    measured from the vehicle's last emission before start. Returns the number
+    of emissions rolled up."""
+    start = hour_of(start) if start is not None else None
+    end = hour_of(end) if end is not None else None
+    delete = VehicleHour.__table__.delete()
+    query = db.session.query(Vehicle.id.label('vehicle_id'),
+                             emission_vehicle.label('vehicle'), Emission.timestamp,
+                             Emission.latitude, Emission.longitude) \
+              .join(Vehicle, emission_vehicles)
+    if start is not None:
+        delete = delete.where(VehicleHour.hour >= start)
+        query = query.filter(Emission.timestamp >= start)
+    if end is not None:
+        delete = delete.where(VehicleHour.hour < end)
+        query = query.filter(Emission.timestamp < end)
+    db.session.execute(delete)
+    totals, count, last = {}, 0, None
+    for row in query.order_by(emission_vehicle, Emission.timestamp).yield_per(10000):
+        if last is None or last.vehicle != row.vehicle:
+            last = None if start is None else \
+                   db.session.query(emission_vehicle.label('vehicle'),
+                                    Emission.latitude, Emission.longitude) \
+                     .filter(emission_vehicle == row.vehicle,
+                             Emission.timestamp < start) \
+                     .order_by(Emission.timestamp.desc()).first()
+        total = totals.setdefault((row.vehicle_id, hour_of(row.timestamp)), [0, 0.0])
+        total[0] += 1
+        if last is not None:
+            total[1] += distance_between(last.latitude, last.longitude,
+                                         row.latitude, row.longitude) or 0
+        last = row
+        count += 1
+        if len(totals) >= 1000:
+            add_vehicle_hours(db.session, totals)
+            totals = {}
+    add_vehicle_hours(db.session, totals)
+    db.session.commit()
+    return count
+
+@command('rollups')
+@click.option('--from', 'start', help='DD-MM-YYYY hh:mm:ss (its hour is inclusive)')
+@click.option('--to', 'end', help='DD-MM-YYYY hh:mm:ss (its hour is exclusive)')
+def rebuild_rollups(start, end):
+    """Rebuilds the hourly rollups (from/to the given times) from the emissions,
+    e.g. to backfill them for emissions registered before they were kept, or
+    while ROLLUPS was off. Rollups are kept as emissions are registered, so
+    they count the emissions that compression dropped since; rebuilding them
+    doesn't."""
+    start = datetime.strptime(start, '%d-%m-%Y %H:%M:%S') if start else None
+    end = datetime.strptime(end, '%d-%m-%Y %H:%M:%S') if end else None
+    print('Rolled up %d emission(s).' % roll_up(start, end))
+
+def rebuild_heat_cells(start=None, end=None):
+    """Rebuilds heat_cells from the emissions, from the time bucket start is in
+    (inclusive) to the one end is in (exclusive), if given. Emissions are read
+    with a server-side cursor, and their counts written every 100k cells.
+    Returns the number of emissions counted."""
+    counter = HeatmapCounter(current_app.config.get('HEATMAP_MIN_ZOOM', 8),
+                             current_app.config.get('HEATMAP_MAX_ZOOM', 14),
+                             current_app.config.get('HEATMAP_BUCKET', 3600))
+    delete = HeatCell.__table__.delete()
+    query = db.session.query(Emission.latitude, Emission.longitude,
+                             Emission.timestamp)
+    if start is not None:
+        start = heatmap.bucket_of(start, counter.bucket)
+        delete = delete.where(HeatCell.bucket >= start)
+        query = query.filter(Emission.timestamp >= start)
+    if end is not None:
+        end = heatmap.bucket_of(end, counter.bucket)
+        delete = delete.where(HeatCell.bucket < end)
+        query = query.filter(Emission.timestamp < end)
+    db.session.execute(delete)
+    count = 0
+    for latitude, longitude, timestamp in query.yield_per(10000):
+        counter.add(latitude, longitude, timestamp)
+        count += 1
+        if len(counter) >= 100000:
+            add_heat_cells(db.session, counter.drain())
+    add_heat_cells(db.session, counter.drain())
+    db.session.commit()
+    tile_cache.clear()
+    return count
+
+@command('heatmap')
+@click.option('--from', 'start', help='DD-MM-YYYY hh:mm:ss (its time bucket is inclusive)')
+@click.option('--to', 'end', help='DD-MM-YYYY hh:mm:ss (its time bucket is exclusive)')
+def rebuild_heatmap(start, end):
+    """Rebuilds the heatmap counts (from/to the given times) from the emissions,
+    e.g. to backfill them, or after a worker was killed. Workers cache the
+    tiles of time windows that ended more than a day ago until they're evicted,
+    so restart them after rebuilding those. See snowdonia.heatmap."""
+    start = datetime.strptime(start, '%d-%m-%Y %H:%M:%S') if start else None
+    end = datetime.strptime(end, '%d-%m-%Y %H:%M:%S') if end else None
+    print('Counted %d emission(s).' % rebuild_heat_cells(start, end))
+
+def compress_trajectories(before, method, tolerance, max_gap):
+    """Compresses the emissions of every vehicle that are older than before and
+    newer than the last segment it already had compressed (see
+    snowdonia.trajectory), one vehicle per transaction. Segments of fewer than 3
+    emissions are left as they are, and picked up again by the next run. Returns
+    the (vehicles, emissions, kept) that were compressed."""
+    compressed = dict(db.session.query(TrajectorySegment.vehicle_id,
+                                       func.max(TrajectorySegment.end))
+                                .group_by(TrajectorySegment.vehicle_id))
+    table = Emission.__table__
+    vehicles = emissions = kept_emissions = 0
+    for (vID,) in db.session.query(Vehicle.id).all():
+        query = db.session.query(Emission.timestamp, Emission.latitude,
+                                 Emission.longitude, Emission.heading) \
+                  .filter(of_vehicle(vID), Emission.timestamp < before)
+        if vID in compressed:
+            query = query.filter(Emission.timestamp > compressed[vID])
+        points = [tuple(row) for row in query.order_by(Emission.timestamp)]
+        segments = [segment for segment in trajectory.split(points, max_gap)
+                    if len(segment) > 2]
+        for segment in segments:
+            kept = trajectory.compress(segment, tolerance, method)
+            keep = set(kept)
+            dropped = [point[0] for point in segment if point not in keep]
+            for start in range(0, len(dropped), 1000):
+                db.session.execute(table.delete().where(and_(
+                    of_vehicle(vID),
+                    table.c.timestamp.in_(dropped[start:start + 1000]))))
+            db.session.add(TrajectorySegment(vehicle_id=vID, start=segment[0][0],
+                end=segment[-1][0], method=method, tolerance=tolerance,
+                emissions=len(segment), kept=len(kept)))
+            emissions += len(segment)
+            kept_emissions += len(kept)
+        if segments:
+            db.session.commit()
+            vehicles += 1
+    return vehicles, emissions, kept_emissions
+
+@command('compress')
+@click.option('--before', help='DD-MM-YYYY hh:mm:ss (default: '
+              'TRAJECTORY_COMPRESSION_AFTER seconds ago)')
+def compress_emissions(before):
+    """Compresses the trajectories of the vehicles up to before, with the
+    TRAJECTORY_COMPRESSION method. Meant to run regularly, see
+    snowdonia.trajectory."""
+    method = current_app.config.get('TRAJECTORY_COMPRESSION')
+    if method is None:
+        print('Trajectories are not compressed (see TRAJECTORY_COMPRESSION).')
+        return
+    if before:
+        before = datetime.strptime(before, '%d-%m-%Y %H:%M:%S')
+    else:
+        before = datetime.utcnow() - timedelta(
+            seconds=current_app.config.get('TRAJECTORY_COMPRESSION_AFTER', 3600))
+    vehicles, emissions, kept = compress_trajectories(before, method,
+        current_app.config.get('TRAJECTORY_TOLERANCE', 25),
+        current_app.config.get('TRAJECTORY_MAX_GAP', 120))
+    print('Compressed %d emission(s) of %d vehicle(s) into %d.' % (
+        emissions, vehicles, kept))
+    emissions, kept = db.session.query(func.sum(TrajectorySegment.emissions),
+                                       func.sum(TrajectorySegment.kept)).one()
+    if emissions:
+        print('All in all, %d emission(s) are stored as %d (%.1f%% fewer rows).' % (
+            emissions, kept, 100.0 * (emissions - kept) / emissions))
+
+def export_rows(start=None, end=None):
+    """The emissions from start (inclusive) to end (exclusive), joined with their
+    vehicles' types, as tuples in the order of snowdonia.export.COLUMNS. Rows are
+    read with a server-side cursor, so they can be exported as they come."""
+    query = db.session.query(Emission.id, Vehicle.id, Vehicle.type,
+                             Emission.latitude, Emission.longitude,
+                             Emission.heading, Emission.timestamp) \
+              .join(Vehicle, emission_vehicles)
+    if start is not None:
+        query = query.filter(Emission.timestamp >= start)
+    if end is not None:
+        query = query.filter(Emission.timestamp < end)
+    return (tuple(row) for row in query.yield_per(10000))
+
+@command('export')
+@click.option('--from', 'start', help='DD-MM-YYYY hh:mm:ss (inclusive)')
+@click.option('--to', 'end', help='DD-MM-YYYY hh:mm:ss (exclusive)')
+@click.option('--format', 'format', default='csv',
+              type=click.Choice(sorted(export.FORMATS)))
+@click.argument('output', type=click.File('wb'))
+def export_emissions(start, end, format, output):
+    """Exports the emissions (from/to the given times) to OUTPUT, see
+    snowdonia.export."""
+    if not export.available(format):
+        raise click.UsageError('Exporting to %s needs pyarrow.' % format)
+    start = datetime.strptime(start, '%d-%m-%Y %H:%M:%S') if start else None
+    end = datetime.strptime(end, '%d-%m-%Y %H:%M:%S') if end else None
+    for data in export.WRITERS[format](export_rows(start, end)):
+        output.write(data)
+
+def new_emission_buffer(app):
+    """A write-behind buffer for the app's emissions, configured by its
+    WRITE_BEHIND_* settings, that keeps vehicle positions up to date as it
+    writes."""
+    return EmissionBuffer(app, db, Emission.__table__,
+                batch_size=app.config.get('WRITE_BEHIND_BATCH_SIZE', 500),
+                interval=app.config.get('WRITE_BEHIND_INTERVAL', 0.2),
+                max_size=app.config.get('WRITE_BEHIND_MAX_SIZE', 10000),
+                after_write=track_emissions, write=insert_emissions,
+                after_commit=emissions_committed)
+
+def current_emission_buffer():
+    """The write-behind buffer of the current app in this worker (see
+    snowdonia.buffer), the router that sends emissions to the writers of their
+    shards with WRITERS on (see snowdonia.writers), or None if emissions are
+    committed by the requests that receive them."""
+    return current_app.extensions['snowdonia']['emission_buffer']
+
+def write_emissions(rows):
+    """Writes emission rows (skipping the ones already registered), and tracks
+    them, in a transaction of its own, with the current app. Used when a writer
+    can't take them."""
+    with db.engine.begin() as connection:
+        written = insert_emissions(connection, rows)
+        track_emissions(connection, written)
+    emissions_committed(written)
+
+def run_writer(app, shard):
+    """Writes the emissions of a shard, received from the API's workers, until
+    it's terminated or interrupted, with the app. The body of every writer
+    process."""
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    with app.app_context():
+        db.engine.dispose() # the parent's connections can't be shared
+    try:
+        writers.serve(writers.socket_path(
+                          app.config.get('WRITERS_SOCKET_DIR', '/tmp/snowdonia-writers'),
+                          shard),
+                      new_emission_buffer(app), running=lambda: not stopping)
+    except KeyboardInterrupt:
+        pass
+
+@command('writers')
+def start_writers():
+    """Runs the WRITERS writer processes (see snowdonia.writers) until
+    interrupted."""
+    count = current_app.config.get('WRITERS')
+    if not count:
+        print('Sharded writers are off (see WRITERS).')
+        return
+    directory = current_app.config.get('WRITERS_SOCKET_DIR', '/tmp/snowdonia-writers')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    app = current_app._get_current_object()
+    processes = [multiprocessing.Process(target=run_writer, args=(app, shard),
+                                         name='writer-%d' % shard)
+                 for shard in range(count)]
+    for process in processes:
+        process.start()
+    print('Started %d writer(s), listening in %s.' % (count, directory))
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+
+POOL_GAUGES = dict(size='Connections the pool keeps open.',
+                   checkedin='Idle connections in the pool.',
+                   checkedout='Connections in use.',
+                   overflow='Connections opened beyond the pool\'s size.')
+for _name, _help in POOL_GAUGES.items():
+    worker_metrics.gauge('snowdonia_db_pool_' + _name, _help)
+BUFFER_GAUGES = ('depth', 'enqueued', 'flushed', 'failed', 'retried',
+                 'written_synchronously')
+for _name in BUFFER_GAUGES:
+    worker_metrics.gauge('snowdonia_buffer_' + _name, 'Write-behind buffer: ' + _name + '.')
+
+def pool_gauges():
+    """Gauges of the database connection pool (not every pool has them all)."""
+    pool = db.engine.pool
+    return [('snowdonia_db_pool_' + name, {}, getattr(pool, name)())
+            for name in POOL_GAUGES if hasattr(pool, name)]
+
+def buffer_gauges():
+    """Gauges of the current app's write-behind buffer, if there is one."""
+    emission_buffer = current_emission_buffer()
+    if emission_buffer is None:
+        return []
+    stats = emission_buffer.stats()
+    return [('snowdonia_buffer_' + name, {}, stats[name]) for name in BUFFER_GAUGES
+            if name in stats]
+
+admission_control = AdmissionControl(settings.get('ADMISSION_MAX_IN_FLIGHT', 0),
+                                     settings.get('ADMISSION_WAIT', 0),
+                                     settings.get('ADMISSION_LATENCY_THRESHOLD'),
+                                     settings.get('ADMISSION_OPEN_SECONDS', 5))
+"""Admission control of the emission endpoints in this worker (see
+snowdonia.admission)."""
+ADMISSION_GAUGES = ('in_flight', 'admitted', 'shed_busy', 'shed_open', 'opened',
+                    'db_failures', 'db_latency', 'circuit_open')
+for _name in ADMISSION_GAUGES:
+    worker_metrics.gauge('snowdonia_admission_' + _name, 'Admission control: ' + _name + '.')
+
+def admission_gauges():
+    """Gauges of the admission control."""
+    stats = admission_control.stats()
+    return [('snowdonia_admission_' + name, {}, stats[name]) for name in ADMISSION_GAUGES]
+
+worker_metrics.gauge('snowdonia_startup_seconds',
+                     'Time it took to create (and warm up) the app.')
+startup_seconds = None
+"""How long creating (and warming up) the app took, in seconds, see
+create_app()."""
+
+def startup_gauges():
+    """Gauge of the time the app took to start."""
+    if startup_seconds is None:
+        return []
+    return [('snowdonia_startup_seconds', {}, round(startup_seconds, 6))]
+
+worker_metrics.collectors.extend([pool_gauges, buffer_gauges, admission_gauges,
+                                  startup_gauges])
+
+def unavailable(message):
+    """A 503 response telling the client when to retry."""
+    return message, 503, {'Retry-After': str(admission_control.retry_after())}
+
+def batch_unavailable(count):
+    """The 503 response to a batch of count emissions when the database failed,
+    which admission_control is told about."""
+    db.session.rollback()
+    admission_control.failure()
+    worker_metrics.inc('snowdonia_emissions_total', count, result='unavailable')
+    return unavailable('Database unavailable, retry later.')
+
+def admission_controlled(view):
+    """Sheds the requests of the view that admission_control doesn't admit, with 503."""
+    @functools.wraps(view)
+    def admitted_view(*args, **kwargs):
+        shed = admission_control.admit()
+        if shed is not None:
+            return unavailable('Too busy, retry later.' if shed == 'busy' else
+                               'Database unavailable, retry later.')
+        try:
+            return view(*args, **kwargs)
+        finally:
+            admission_control.release()
+    return admitted_view
+
+known_vehicles = LRUCache(settings.get('VEHICLE_CACHE_SIZE', 10000))
+"""Types of the vehicles this worker knows are registered, by id, so that it only
+queries the vehicles table for ids it hasn't seen yet. Vehicles are never
+unregistered, so an id in the cache is never stale."""
+_warm_vehicle_cache = settings.get('VEHICLE_CACHE_WARM_UP', False)
+
+def warm_vehicle_cache():
+    """Loads the registered vehicles (as many as fit) into known_vehicles."""
+    for row in db.session.query(Vehicle.id, Vehicle.type) \
+                         .limit(known_vehicles.max_size):
+        known_vehicles.set(row.id, row.type)
+
+def vehicle_registered(vID):
+    """Checks whether the vehicle is registered, looking it up in the database
+    only if it isn't in known_vehicles. With VEHICLE_CACHE_WARM_UP on, the first
+    check in every worker warms the cache up first."""
+    global _warm_vehicle_cache
+    if _warm_vehicle_cache:
+        _warm_vehicle_cache = False
+        warm_vehicle_cache()
+    if vID in known_vehicles:
+        return True
+    row = db.session.query(Vehicle.type).filter_by(id=vID).first()
+    if row is None:
+        return False
+    known_vehicles.set(vID, row.type)
+    return True
+
+uuid4hex = re.compile(r'[0-9a-f]{12}4[0-9a-f]{3}[89ab][0-9a-f]{15}\Z', re.I)
+"""UUID4s, as 32 characters of hex."""
+
 def valid_vehicle(vID, vType):
     """Checks:
     
     - Vehicle ID is a valid UUID4
     - Vehicle type is a valid type (train, tram, taxi, or bus)
     """
-    uuid4hex = re.compile('[0-9a-f]{12}4[0-9a-f]{3}[89ab][0-9a-f]{15}\Z', re.I)
     match = uuid4hex.match(vID)
     return match is not None and vType in valid_types
 
+city_boundary = boundary.load(settings['BOUNDARY']) \
+                if settings.get('BOUNDARY') else None
+"""The polygons of the town borders (see snowdonia.boundary), or None for the
+circle of snowdonia_radius around snowdonia_center."""
+
 def valid_point(lat_val, long_val, heading):
     """Checks:
 
     - Latitude is between -90 and 90
     - Longitude is between -180 and 180
     - Heading is between 0 and 359
-    - Point is within the town borders (less than 50km from town center)
+    - Point is within the town borders (less than 50km from town center, or in
+      city_boundary, with BOUNDARY set)
     """
     lat_valid = lat_val >= -90 and lat_val <= 90
     long_valid = long_val >= -180 and long_val<= 180
     heading_valid = heading >= 0 and heading <= 359
-    in_city = in_range(lat_val, long_val) if lat_valid and long_valid else False
+    if not (lat_valid and long_valid):
+        in_city = False
+    elif city_boundary is None:
+        in_city = in_range(lat_val, long_val)
+    else:
+        in_city = city_boundary.contains(lat_val, long_val)
     return in_city and heading_valid
 
+def left_city(lat_val, long_val, heading):
+    """Whether an emission that isn't valid_point() is only invalid because its
+    point is outside of the town borders, i.e. its vehicle left the city."""
+    return -90 <= lat_val <= 90 and -180 <= long_val <= 180 and 0 <= heading <= 359
+
+exited_vehicles = set()
+"""Ids of the vehicles that left the city (see ExitedVehicle), so that their
+emissions are rejected before they're even read. It's added to as this worker
+records exits, and reloaded from exited_vehicles every EXITED_VEHICLES_REFRESH
+seconds to pick up the exits recorded, and the vehicles re-admitted, elsewhere."""
+_exited_vehicles_loaded = 0
+
+def load_exited_vehicles():
+    """Reloads exited_vehicles if it's been more than EXITED_VEHICLES_REFRESH
+    seconds since it was last loaded."""
+    global exited_vehicles, _exited_vehicles_loaded
+    if time.time() - _exited_vehicles_loaded < \
+       current_app.config.get('EXITED_VEHICLES_REFRESH', 10):
+        return
+    exited_vehicles = set(row.vehicle_id for row in
+                          db.session.query(ExitedVehicle.vehicle_id))
+    _exited_vehicles_loaded = time.time()
+
+def vehicle_exited(vID):
+    """Checks whether the vehicle left the city (always False with
+    EXITED_VEHICLES off)."""
+    if not current_app.config.get('EXITED_VEHICLES', True):
+        return False
+    load_exited_vehicles()
+    return vID in exited_vehicles
+
+def record_exits(connection, rows):
+    """Records that the vehicles of the emission rows (registered vehicles, with
+    their first emission outside of the town borders) left the city, in the
+    connection's (or session's) transaction. Vehicles that already left are left
+    as they are."""
+    connection.execute(insert_ignore(ExitedVehicle.__table__).values(
+        [dict(vehicle_id=row['vehicle_id'], latitude=row['latitude'],
+              longitude=row['longitude'], timestamp=row['timestamp'])
+         for row in rows]))
+
+def batch_exits(parsed, points_valid, known):
+    """The first emission outside of the town borders of every vehicle of a
+    batch (parsed as (index, vehicle_id, latitude, longitude, timestamp,
+    heading) tuples, with points_valid telling which points are valid), by
+    vehicle id. Only vehicles that were in the city can leave it: the ones in
+    known (registered before the batch), and the ones with an emission in the
+    city before that one."""
+    if not current_app.config.get('EXITED_VEHICLES', True):
+        return {}
+    exits = {}
+    for (index, vID, latitude, longitude, timestamp, heading), point_valid \
+            in zip(parsed, points_valid):
+        if not point_valid and left_city(latitude, longitude, heading) and \
+           (vID not in exits or timestamp < exits[vID]['timestamp']):
+            exits[vID] = dict(vehicle_id=vID, latitude=latitude,
+                              longitude=longitude, timestamp=timestamp)
+    entered = set(vID for (index, vID, latitude, longitude, timestamp, heading),
+                  point_valid in zip(parsed, points_valid) if point_valid
+                  and vID in exits and timestamp < exits[vID]['timestamp'])
+    return dict((vID, row) for vID, row in exits.items()
+                if vID in known or vID in entered)
 
-def distance_from_center(latitude, longitude): 
-    """Calculates the distance between the provided point and the town center
-    by using Vincenty's formula that calculates the distance between
-    two points on a spheroid, given:
-
-    - Radius of the Earth (min and max) as well as its flattening.
-    - Latitude and longitude of both the point & the center in radians.
-
-    Even though there exists the Haversine formula that calculates the distance
-    between two points on a sphere, and it is less computationally expensive
-    than Vincenty (no iterations), the Haversine formula, when calculating distances
-    on the Earth, can have an error up to 0.55%, though generally below 0.3%, 
-    so Vincenty provides greater accuracy that is actually needed in this situation,
-    where exactly where vehicles were is valuable data.
-
-    More on how Vincenty's formula works:
-    https://en.wikipedia.org/wiki/Vincenty's_formulae
-    """
-    lat_rad, long_rad = radians(latitude), radians(longitude)
-    lat_center, long_center = snowdonia_center
-    a = 6378137 # earth radius at equator in m
-    b = 6356752.3142 # earth smallest radius in m
-    f = 1/298.257223563  # flattening of the Earth - all WGS-84 ellipsiod
-    L = long_rad - long_center
-    U1 = atan((1 - f) * tan(lat_rad))
-    U2 = atan((1 - f) * tan(lat_center))
-    sin_U1 = sin(U1)
-    cos_U1 = cos(U1)
-    sin_U2 = sin(U2)
-    cos_U2 = cos(U2)
-    lambda1 = L
-    lambdaP = 2*pi
-    iter_limit = 20
-
-    while abs(lambda1 - lambdaP) > 1e-12 and iter_limit > 0:
-        sin_lambda1 = sin(lambda1)
-        cos_lambda1 = cos(lambda1)
-        sin_sigma = sqrt((cos_U2 * sin_lambda1) * (cos_U2 * sin_lambda1) +\
-                    (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lambda1) *\
-                    (cos_U1 * sin_U2 - sin_U1 *cos_U2 * cos_lambda1))
-        if sin_sigma == 0:
-            return 0
-        cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lambda1
-        sigma = atan2(sin_sigma, cos_sigma)
-        sin_alpha = cos_U1 * cos_U2 * sin_lambda1 / sin_sigma
-        cos2_alpha = 1 - sin_alpha * sin_alpha
-        cos2_sigma_m = cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha \
-                    if cos2_alpha != 0 else 0
-        C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
-        lambdaP = lambda1
-        lambda1 = L + (1 - C) * f * sin_alpha *\
-                (sigma +\
-                 C * sin_sigma *\
-                 (cos2_sigma_m + C * cos_sigma *\
-                 (-1 + 2 * cos2_sigma_m * cos2_sigma_m))\
-                )
-        iter_limit -= 1
-
-    if iter_limit==0:
-        return None # failed to converge
-
-    u_2 = cos2_alpha * (a * a - b * b) / (b * b)
-    A = 1 + u_2 / 16384 *(4096 + u_2 * (-768 + u_2 * (320 - 175 * u_2)))
-    B = u_2 / 1024 * (256 + u_2 * (-128 + u_2 * (74 - 47 * u_2)))
-    delta_sigma = B * sin_sigma * (cos2_sigma_m + B / 4 *\
-                                  (cos_sigma * (-1 + 2 *\
-                                   cos2_sigma_m*cos2_sigma_m)-\
-                                   B / 6 * cos2_sigma_m *\
-                                   (-3 + 4 * sin_sigma * sin_sigma) *\
-                                   (-3+4*cos2_sigma_m*cos2_sigma_m))\
-                                  )
-    s = b*A*(sigma-delta_sigma)
-    return s/1000
-
-
-def in_range(latitude, longitude):
-    """Determins if distance from center is <= 50, Snowdonia's radius in kms."""
-    return distance_from_center(latitude, longitude) <= 50
-
-@app.route('/')
+def readmit(ids):
+    """Re-admits the vehicles with the given ids, so that their emissions are
+    registered again. Returns how many of them had left the city. Other workers
+    notice within EXITED_VEHICLES_REFRESH seconds."""
+    readmitted = db.session.query(ExitedVehicle) \
+                   .filter(ExitedVehicle.vehicle_id.in_(ids)) \
+                   .delete(synchronize_session=False)
+    db.session.commit()
+    exited_vehicles.difference_update(ids)
+    return readmitted
+
+@command('readmit')
+@click.argument('vehicle_ids', nargs=-1, required=True)
+def readmit_vehicles(vehicle_ids):
+    """Re-admits vehicles (by UUID) that left the city, see ExitedVehicle."""
+    print('Re-admitted %d vehicle(s).' % readmit(vehicle_ids))
+
+def read_emission(data):
+    """Reads an emission's fields out of a request form or a JSON object and
+    converts them to their types. Returns (latitude, longitude, timestamp, heading).
+
+    The timestamp may already be a datetime (as decoded by snowdonia.wire).
+
+    Raises ValueError if a value is badly formatted and KeyError if it is missing.
+    """
+    latitude = float(data['latitude'])
+    longitude = float(data['longitude'])
+    timestamp = data['timestamp']
+    if not isinstance(timestamp, datetime):
+        timestamp = datetime.strptime(timestamp, '%d-%m-%Y %H:%M:%S')
+    heading = int(data['heading'])
+    return latitude, longitude, timestamp, heading
+
+
+RESULTS = {'Success!': 'success',
+           'Success! (duplicate, already registered)': 'duplicate',
+           'Co-ordinates/heading invalid.': 'invalid_coordinates',
+           'Vehicle ID or vehicle type is invalid.': 'invalid_vehicle',
+           'Invalid value(s) provided.': 'invalid_values',
+           'Vehicle has left the city.': 'exited',
+           'Database unavailable, retry later.': 'unavailable'}
+"""Results of emissions (as counted by snowdonia_emissions_total), by message.
+Any other message is an error."""
+
+def count_result(message):
+    """Counts an emission's result in the metrics."""
+    worker_metrics.inc('snowdonia_emissions_total', result=RESULTS.get(message, 'error'))
+
+def accept_emission(vehicleID, data, buffer=None):
+    """Validates one emission of the vehicle (data as read by read_emission()),
+    registers the vehicle if it's new, and stores the emission, or queues it in
+    buffer if one is given. Returns the (message, status) that
+    register_emission(vehicleID) responds with, so that other transports (see
+    snowdonia.udp) validate emissions exactly like the API does."""
+    message, status = _accept_emission(vehicleID, data, buffer)
+    count_result(message)
+    return message, status
+
+def _accept_emission(vehicleID, data, buffer):
+    try:
+        if vehicle_exited(vehicleID):
+            return 'Vehicle has left the city.', 403
+        # 1. Validate (and record that the vehicle left the city, if its point
+        #    is outside of the borders and it was registered in it)
+        with worker_metrics.stage('parse'):
+            latitude, longitude, timestamp, heading = read_emission(data)
+        with worker_metrics.stage('geofence'):
+            point_valid = valid_point(latitude, longitude, heading)
+        if not point_valid:
+            if current_app.config.get('EXITED_VEHICLES', True) and \
+               left_city(latitude, longitude, heading) and \
+               vehicle_registered(vehicleID):
+                record_exits(db.session, [dict(vehicle_id=vehicleID,
+                    latitude=latitude, longitude=longitude, timestamp=timestamp)])
+                db.session.commit()
+                exited_vehicles.add(vehicleID)
+            return 'Co-ordinates/heading invalid.', 400
+        if (vehicleID, timestamp) in recent_emissions:
+            return 'Success! (duplicate, already registered)', 200
+
+        # 2. Register vehicle if not registered
+        started = time.time()
+        with worker_metrics.stage('vehicle'):
+            registered = vehicle_registered(vehicleID)
+            if not registered:
+                vehicle_type = data['type'].lower()
+                if not valid_vehicle(vehicleID, vehicle_type):
+                    return 'Vehicle ID or vehicle type is invalid.', 400
+                db.session.execute(insert_ignore(Vehicle.__table__).values(
+                    id=vehicleID, type=vehicle_type))
+
+        # 3. Register emission and move the vehicle (or queue them, when
+        #    writing behind)
+        with worker_metrics.stage('write'):
+            row = dict(vehicle_id=vehicleID, latitude=latitude,
+                       longitude=longitude, timestamp=timestamp, heading=heading)
+            moved, duplicate = [], False
+            if buffer is None:
+                duplicate = not insert_emissions(db.session, [row])
+                if not duplicate:
+                    moved = track_emissions(db.session, [row])
+                db.session.commit()
+            elif not registered:
+                db.session.commit() # the vehicle must exist before its emission
+            if not registered:
+                known_vehicles.set(vehicleID, vehicle_type)
+            if buffer is None:
+                recent_emissions.add((vehicleID, timestamp))
+                index_positions(moved)
+                if not duplicate:
+                    count_heat([row])
+            else:
+                buffer.put(row) # remembered once the buffer commits it
+        admission_control.observe(time.time() - started)
+    except ValueError:
+        return 'Invalid value(s) provided.', 400
+    except (exc.OperationalError, exc.TimeoutError):
+        db.session.rollback()
+        admission_control.failure()
+        return 'Database unavailable, retry later.', 503
+    except Exception as ex:
+        db.session.rollback()
+        return 'Error! Did you send the right data fields? ', 400
+    if duplicate:
+        return 'Success! (duplicate, already registered)', 200
+    return 'Success!', 200
+
+@command('udp')
+@click.option('--host', default=None, help='Address to listen on (UDP_HOST).')
+@click.option('--port', type=int, default=None, help='Port to listen on (UDP_PORT).')
+@click.option('--ack/--no-ack', default=None,
+              help='Answer every datagram with an ack (UDP_ACK).')
+def serve_udp(host, port, ack):
+    """Receives emissions over UDP (see snowdonia.udp) until interrupted,
+    printing the server's counters every UDP_STATS_INTERVAL seconds."""
+    app = current_app._get_current_object()
+    buffer = current_emission_buffer() or new_emission_buffer(app)
+
+    def handle(vehicleID, emission):
+        with app.app_context(): # datagrams are handled in their own thread
+            return accept_emission(vehicleID, emission, buffer)
+
+    loop = asyncio.new_event_loop()
+    transport, protocol = udp.serve(handle,
+        host or current_app.config.get('UDP_HOST', '0.0.0.0'),
+        port or current_app.config.get('UDP_PORT', 5005),
+        current_app.config.get('UDP_ACK', False) if ack is None else ack,
+        current_app.config.get('UDP_QUEUE_SIZE', 10000),
+        current_app.config.get('UDP_RECEIVE_BUFFER'), loop)
+    interval = current_app.config.get('UDP_STATS_INTERVAL', 60)
+
+    def report():
+        click.echo(json.dumps(dict(protocol.stats(), buffer=buffer.stats())))
+        loop.call_later(interval, report)
+
+    loop.call_later(interval, report)
+    click.echo('Listening on %s:%d' % transport.get_extra_info('sockname')[:2])
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        protocol.stop()
+        transport.close()
+        loop.close()
+        buffer.stop()
+        click.echo(json.dumps(dict(protocol.stats(), buffer=buffer.stats())))
+
+@api.route('/')
 def home():
     """A brief summary page and the landing page for the app."""
     return render_template('about.html')
 
-@app.route('/api/v1/emission/<vehicleID>', methods=['PUT'])
+@api.route('/api/v1/emission/<vehicleID>', methods=['PUT'])
+@admission_controlled
 def register_emission(vehicleID): 
     """The API endpoint that collects emissions.
     URL:
@@ -205,40 +1384,777 @@ def register_emission(vehicleID):
         - longitude: float betwen -180 and 180
         - timestamp: string of the timestamp in the form: DD-MM-YYYY hh:mm:ss
         - heading: int from 0 to 359
+    - The data can be sent as a form, or as msgpack or a fixed-width record
+      (see snowdonia.wire), with the matching Content-Type.
 
     Responses:
 
     - Success [200]: 'Success!'
+    - Already registered [200]: 'Success! (duplicate, already registered)' when the
+      vehicle already has an emission with that timestamp (e.g. a retry), which
+      is left as it is
     - Co-ordinates or heading invalid/Co-ordinates are too far [400]: 'Co-ordinates/heading invalid'
     - Vehicle ID or vehicle type invalid [400]: 'Vehicle ID or vehicle type is invalid'
     - Invalid data types [400]: 'Invalid value(s) provided'
+    - Vehicle left the city [403]: 'Vehicle has left the city.' for every
+      emission of a vehicle after one outside of the town borders (which is
+      answered as too far), with EXITED_VEHICLES on, until it's re-admitted
+      (see ExitedVehicle). It's checked before the emission is validated.
     - Other exception [400]: 'Unexpected error'
+    - Shed [503], with a Retry-After header (in seconds): 'Too busy, retry
+      later.' when the worker has too many requests in flight, and 'Database
+      unavailable, retry later.' when its circuit is open, or the database
+      failed (see snowdonia.admission)
+
+    With WRITE_BEHIND on, a successful response means the emission was validated
+    and queued in the app's write-behind buffer (see current_emission_buffer()),
+    which commits it shortly after (and retries if it can't). Only the retries
+    of emissions this worker committed (see recent_emissions) are answered as
+    duplicates then; the others are answered with 'Success!', and skipped by the
+    buffer.
     """
     try:
-        # 1. Validate
-        latitude = float(request.form['latitude'])
-        longitude = float(request.form['longitude'])
-        timestamp = datetime.strptime(request.form['timestamp'],\
-                    '%d-%m-%Y %H:%M:%S')
-        heading = int(request.form['heading'])
-        if not valid_point(latitude, longitude, heading):
-            return 'Co-ordinates/heading invalid.', 400
+        with worker_metrics.stage('decode'):
+            if wire.decodes(request.mimetype):
+                data = wire.decode_emission(request.mimetype, request.get_data())
+            else:
+                data = request.form
+    except ValueError:
+        count_result('Invalid value(s) provided.')
+        return 'Invalid value(s) provided.', 400
+    message, status = accept_emission(vehicleID, data, current_emission_buffer())
+    if status == 503:
+        return unavailable(message)
+    return message, status
 
-        # 2. Register vehicle if not registered
-        record = Vehicle.query.filter_by(id=vehicleID).first()
-        if record is None:
-            vehicle_type = request.form['type'].lower()
-            if not valid_vehicle(vehicleID, vehicle_type):
-                return 'Vehicle ID or vehicle type is invalid.', 400
-            vehicle = Vehicle(vehicleID, vehicle_type)
-            db.session.add(vehicle)
-
-        # 3. Register emission
-        emission = Emission(vehicleID, latitude, longitude, timestamp, heading)
-        db.session.add(emission)
-        db.session.commit()
+@api.route('/api/v1/emissions', methods=['PUT'])
+@admission_controlled
+def register_emissions():
+    """The API endpoint that collects emissions in batches, for gateways that
+    aggregate several emitters.
+    URL:
+    ::
+        /api/v1/emissions
+
+    How it works:
+
+    - The body is a JSON array of emissions (at most MAX_BATCH_SIZE of them),
+      each with the same fields as register_emission(vehicleID) plus:
+        - vehicle_id: the UUID4 of the vehicle
+        - type: only needed the first time the vehicle is seen
+    - The body can also be a msgpack array of emissions, or fixed-width batch
+      records (see snowdonia.wire), with the matching Content-Type.
+    - Every emission is validated on its own, exactly like a single emission.
+      With at least VECTORIZED_BATCH_SIZE emissions, their points are validated
+      all at once with snowdonia.vectorized.valid_points(). The emissions of
+      a vehicle after its first one outside of the town borders are rejected
+      like they would be one by one, and its exit recorded with the rest.
+    - Vehicles that aren't in snowdonia.known_vehicles are looked up with one
+      query, the unregistered ones are registered with one INSERT, and all the valid emissions are then inserted
+      with one multi-row INSERT (and the vehicles moved to their newest
+      positions) in a single transaction (or queued in
+      the app's write-behind buffer, with WRITE_BEHIND on).
+
+    Responses:
+
+    - Batch processed [200]: JSON {"results": [...]} with one {"status", "message"}
+      entry per emission, in the order they were sent. Each entry carries the
+      status and message register_emission(vehicleID) would have returned for it.
+    - Body is not a JSON array (or can't be decoded) [400]: 'Expected a JSON
+      array of emissions.'
+    - Too many emissions [413]: 'Too many emissions in one batch.'
+    - Shed [503], with Retry-After: see register_emission(vehicleID)
+    - Other database error [400]: 'Unexpected error'
+    """
+    with worker_metrics.stage('batch_decode'):
+        if wire.decodes(request.mimetype):
+            try:
+                items = wire.decode_emissions(request.mimetype, request.get_data())
+            except ValueError:
+                items = None
+        else:
+            items = request.get_json(force=True, silent=True)
+    if not isinstance(items, list):
+        return 'Expected a JSON array of emissions.', 400
+    if len(items) > current_app.config.get('MAX_BATCH_SIZE', 1000):
+        return 'Too many emissions in one batch.', 413
+    emission_buffer = current_emission_buffer()
+
+    # 1. Find out which of the vehicles are already registered
+    with worker_metrics.stage('batch_lookup'):
+        started = time.time()
+        ids = set(item.get('vehicle_id') for item in items if isinstance(item, dict)
+                  and isinstance(item.get('vehicle_id'), str))
+        known = dict((vID, known_vehicles.get(vID)) for vID in ids
+                     if vID in known_vehicles)
+        unknown = ids.difference(known)
+        try:
+            if unknown:
+                known.update(db.session.query(Vehicle.id, Vehicle.type)
+                                        .filter(Vehicle.id.in_(unknown)))
+        except (exc.OperationalError, exc.TimeoutError):
+            return batch_unavailable(len(items))
+        looked_up = time.time() - started
+
+    with worker_metrics.stage('batch_validate'):
+        # 2. Read every emission, then check all their points (at once, if there
+        #    are enough of them for NumPy to pay off)
+        results, parsed = [None] * len(items), []
+        for index, item in enumerate(items):
+            try:
+                if not isinstance(item['vehicle_id'], str): # e.g. a list
+                    raise TypeError('vehicle_id is not a string')
+                parsed.append((index, item['vehicle_id']) + read_emission(item))
+            except ValueError:
+                results[index] = (400, 'Invalid value(s) provided.')
+            except Exception as ex:
+                results[index] = (400, 'Error! Did you send the right data fields? ')
+        try:
+            for p in parsed:
+                if vehicle_exited(p[1]):
+                    results[p[0]] = (403, 'Vehicle has left the city.')
+        except (exc.OperationalError, exc.TimeoutError):
+            return batch_unavailable(len(items))
+        parsed = [p for p in parsed if results[p[0]] is None]
+        if len(parsed) >= current_app.config.get('VECTORIZED_BATCH_SIZE', 500):
+            points_valid = valid_points([p[2] for p in parsed], [p[3] for p in parsed],
+                                        [p[5] for p in parsed], city_boundary)
+        else:
+            points_valid = [valid_point(p[2], p[3], p[5]) for p in parsed]
+
+        # 3. Check the vehicles that aren't registered yet, and skip the
+        #    emissions that were just registered (or are in the batch twice),
+        #    and the ones after their vehicle left the city
+        exits = batch_exits(parsed, points_valid, known)
+        vehicles, emissions, indexes, keys = {}, [], [], set()
+        for (index, vehicleID, latitude, longitude, timestamp, heading), point_valid \
+                in zip(parsed, points_valid):
+            if not point_valid:
+                results[index] = (400, 'Co-ordinates/heading invalid.')
+                continue
+            if vehicleID in exits and timestamp > exits[vehicleID]['timestamp']:
+                results[index] = (403, 'Vehicle has left the city.')
+                continue
+            if (vehicleID, timestamp) in keys or \
+               (vehicleID, timestamp) in recent_emissions:
+                results[index] = (200, 'Success! (duplicate, already registered)')
+                continue
+            try:
+                if vehicleID not in known and vehicleID not in vehicles:
+                    vehicle_type = items[index]['type'].lower()
+                    if not valid_vehicle(vehicleID, vehicle_type):
+                        results[index] = (400, 'Vehicle ID or vehicle type is invalid.')
+                        continue
+                    vehicles[vehicleID] = vehicle_type
+            except Exception as ex:
+                results[index] = (400, 'Error! Did you send the right data fields? ')
+                continue
+            emissions.append(dict(vehicle_id=vehicleID, latitude=latitude,
+                                  longitude=longitude, timestamp=timestamp,
+                                  heading=heading))
+            indexes.append(index)
+            keys.add((vehicleID, timestamp))
+            results[index] = (200, 'Success!')
+        exits = dict((vID, row) for vID, row in exits.items()
+                     if vID in known or vID in vehicles)
+
+    # 4. Register the new vehicles and all the emissions in one transaction
+    with worker_metrics.stage('batch_write'):
+        started = time.time()
+        try:
+            if vehicles:
+                db.session.execute(insert_ignore(Vehicle.__table__).values(
+                    [dict(id=vID, type=vType) for vID, vType in vehicles.items()]))
+            if exits:
+                record_exits(db.session, list(exits.values()))
+            moved, written = [], []
+            if emissions and emission_buffer is None:
+                written = insert_emissions(db.session, emissions)
+                moved = track_emissions(db.session, written)
+                inserted = set(emission_key(row) for row in written)
+                for index, row in zip(indexes, emissions):
+                    if emission_key(row) not in inserted:
+                        results[index] = (200, 'Success! (duplicate, already registered)')
+            db.session.commit()
+            if emissions and emission_buffer is not None:
+                emission_buffer.extend(emissions)
+        except (exc.OperationalError, exc.TimeoutError):
+            return batch_unavailable(len(items))
+        except Exception as ex:
+            db.session.rollback()
+            worker_metrics.inc('snowdonia_emissions_total', len(items), result='error')
+            return 'Unexpected error', 400
+        known.update(vehicles)
+        for vID, vType in known.items():
+            known_vehicles.set(vID, vType)
+        if emission_buffer is None:
+            for key in keys:
+                recent_emissions.add(key)
+        exited_vehicles.update(exits)
+        index_positions(moved)
+        count_heat(written)
+        admission_control.observe(looked_up + time.time() - started)
+
+    if worker_metrics.enabled:
+        for status, message in results:
+            count_result(message)
+    return jsonify(results=[dict(status=status, message=message)
+                            for status, message in results]), 200
+
+@api.route('/api/v1/buffer', methods=['GET'])
+def buffer_stats():
+    """Counters of the write-behind buffer of the worker serving the request:
+    queue depth, rows enqueued/flushed/failed/retried/written synchronously, and the
+    last and max flush latencies in ms. With WRITERS on, the number of writers
+    and the rows sent to them/written synchronously instead. Responds with 404
+    if both WRITE_BEHIND and WRITERS are off.
+    """
+    emission_buffer = current_emission_buffer()
+    if emission_buffer is None:
+        return 'Write-behind is off.', 404
+    return jsonify(emission_buffer.stats()), 200
+
+@api.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """The metrics of the API (see snowdonia.metrics), in the Prometheus text
+    format. Responds with 404 if METRICS is off."""
+    if not worker_metrics.enabled:
+        return 'Metrics are off.', 404
+    return Response(worker_metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api.route('/api/v1/positions', methods=['GET'])
+def vehicle_positions():
+    """The API endpoint that serves the last known position of every vehicle.
+    URL:
+    ::
+        /api/v1/positions?type=<VEHICLE_TYPE>
+
+    The type is optional, and limits the positions to vehicles of that type.
+    Positions are read from vehicle_positions, so the cost of the request only
+    depends on the size of the fleet, not on how many emissions it sent.
+
+    Responses:
+
+    - Success [200]: JSON {"positions": [...]} with one {"vehicle_id", "type",
+      "latitude", "longitude", "heading", "timestamp"} entry per vehicle, where
+      the timestamp is in the form DD-MM-YYYY hh:mm:ss
+    - Vehicle type invalid [400]: 'Vehicle type is invalid.'
+    """
+    query = db.session.query(VehiclePosition, Vehicle.type) \
+              .join(Vehicle, Vehicle.id == VehiclePosition.vehicle_id)
+    vehicle_type = request.args.get('type')
+    if vehicle_type is not None:
+        if vehicle_type.lower() not in valid_types:
+            return 'Vehicle type is invalid.', 400
+        query = query.filter(Vehicle.type == vehicle_type.lower())
+    return jsonify(positions=[dict(
+        vehicle_id=position.vehicle_id,
+        type=vType,
+        latitude=position.latitude,
+        longitude=position.longitude,
+        heading=position.heading,
+        timestamp=position.timestamp.strftime('%d-%m-%Y %H:%M:%S'),
+    ) for position, vType in query]), 200
+
+@api.route('/api/v1/positions/nearby', methods=['GET'])
+def nearby_vehicles():
+    """The API endpoint that finds the vehicles closest to a point, e.g. a stop.
+    URL:
+    ::
+        /api/v1/positions/nearby?latitude=<LAT>&longitude=<LONG>&radius=<KMS>
+        /api/v1/positions/nearby?latitude=<LAT>&longitude=<LONG>&k=<COUNT>
+
+    With radius, finds the vehicles within radius kms of the point. With k, finds
+    the k vehicles closest to it. Either can be limited to vehicles of one type
+    with type=<VEHICLE_TYPE>. Vehicles are looked up in snowdonia.vehicle_index,
+    so only the ones close to the point have their distance calculated.
+
+    Responses:
+
+    - Success [200]: JSON {"positions": [...]} with one {"vehicle_id", "type",
+      "latitude", "longitude", "distance"} entry per vehicle, closest first,
+      where the distance is in kms
+    - Neither radius nor k, or badly formatted values [400]: 'Invalid value(s) provided.'
+    - Point more than NEARBY_MAX_DISTANCE kms from the town center [400]:
+      'Co-ordinates invalid.'
+    - Vehicle type invalid [400]: 'Vehicle type is invalid.'
+    """
+    try:
+        latitude = float(request.args['latitude'])
+        longitude = float(request.args['longitude'])
+        radius = float(request.args['radius']) if 'radius' in request.args else None
+        k = int(request.args['k']) if 'k' in request.args else None
+        if (radius is None) == (k is None) or (radius or k) <= 0:
+            raise ValueError
+    except (KeyError, ValueError):
+        return 'Invalid value(s) provided.', 400
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or \
+       haversine_from_center(latitude, longitude) > \
+       current_app.config.get('NEARBY_MAX_DISTANCE', 100):
+        return 'Co-ordinates invalid.', 400
+    vehicle_type = request.args.get('type')
+    where = None
+    if vehicle_type is not None:
+        vehicle_type = vehicle_type.lower()
+        if vehicle_type not in valid_types:
+            return 'Vehicle type is invalid.', 400
+        where = lambda vType: vType == vehicle_type
+
+    load_vehicle_index()
+    if radius is not None:
+        found = vehicle_index.within(latitude, longitude, radius, where)
+    else:
+        found = vehicle_index.nearest(latitude, longitude, k, where)
+    positions = []
+    for vID, distance, vType in found:
+        point = vehicle_index.get(vID)
+        positions.append(dict(vehicle_id=vID, type=vType, latitude=point[0],
+                              longitude=point[1], distance=distance))
+    return jsonify(positions=positions), 200
+
+@api.route('/api/v1/vehicles/<vehicleID>/emissions', methods=['GET'])
+def vehicle_emissions(vehicleID):
+    """The API endpoint that streams the emissions of a vehicle (its trajectory),
+    oldest first, as newline-delimited JSON.
+    URL:
+    ::
+        /api/v1/vehicles/<VEHICLE_ID>/emissions?from=<TIMESTAMP>&to=<TIMESTAMP>
+
+    All parameters are optional, and timestamps are in the form DD-MM-YYYY hh:mm:ss:
+
+    - from/to: only emissions from (inclusive) and to (exclusive) those times
+    - limit: at most that many emissions (TRAJECTORY_PAGE_SIZE by default, and
+      at most TRAJECTORY_MAX_PAGE_SIZE)
+    - after_timestamp/after_id: only emissions after that one, to get the next
+      page. Pass the timestamp and id of the last emission of the previous page.
+      Pages are found with the (vehicle_id, timestamp) index (keyset pagination),
+      so later pages are as cheap as the first.
+
+    Rows are read with a server-side cursor and written as they come, so even a
+    month's worth of emissions is served without holding it in memory.
+
+    Responses:
+
+    - Success [200]: one {"id", "latitude", "longitude", "heading", "timestamp"}
+      JSON object per line (Content-Type: application/x-ndjson). If there are
+      limit lines, there might be more in the next page.
+    - Badly formatted values [400]: 'Invalid value(s) provided.'
+    - Vehicle not registered [404]: 'Vehicle not found.'
+    """
+    try:
+        args = request.args
+        start = datetime.strptime(args['from'], '%d-%m-%Y %H:%M:%S') \
+                if 'from' in args else None
+        end = datetime.strptime(args['to'], '%d-%m-%Y %H:%M:%S') \
+              if 'to' in args else None
+        limit = int(args.get('limit', current_app.config.get('TRAJECTORY_PAGE_SIZE', 10000)))
+        if not 0 < limit <= current_app.config.get('TRAJECTORY_MAX_PAGE_SIZE', 100000):
+            raise ValueError
+        after = (datetime.strptime(args['after_timestamp'], '%d-%m-%Y %H:%M:%S'),
+                 int(args['after_id'])) if 'after_timestamp' in args else None
+    except (KeyError, ValueError):
+        return 'Invalid value(s) provided.', 400
+    if not vehicle_registered(vehicleID):
+        return 'Vehicle not found.', 404
+
+    query = db.session.query(Emission.id, Emission.latitude, Emission.longitude,
+                             Emission.heading, Emission.timestamp) \
+              .filter(of_vehicle(vehicleID))
+    if start is not None:
+        query = query.filter(Emission.timestamp >= start)
+    if end is not None:
+        query = query.filter(Emission.timestamp < end)
+    if after is not None:
+        query = query.filter(tuple_(Emission.timestamp, Emission.id) > tuple_(*after))
+    query = query.order_by(Emission.timestamp, Emission.id).limit(limit)
+
+    def generate():
+        for row in query.yield_per(1000):
+            yield json.dumps(dict(id=row.id, latitude=row.latitude,
+                                  longitude=row.longitude, heading=row.heading,
+                                  timestamp=row.timestamp.strftime('%d-%m-%Y %H:%M:%S'))
+                             ) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson'), 200
+
+@api.route('/api/v1/vehicles/<vehicleID>/trajectory', methods=['GET'])
+def vehicle_trajectory(vehicleID):
+    """The API endpoint that streams the trajectory of a vehicle, oldest first,
+    as newline-delimited JSON, reconstructing the stretches whose emissions
+    were compressed (see snowdonia.trajectory).
+    URL:
+    ::
+        /api/v1/vehicles/<VEHICLE_ID>/trajectory?from=<TIMESTAMP>&to=<TIMESTAMP>&interval=<SECONDS>
+
+    All parameters are optional, and timestamps are in the form DD-MM-YYYY hh:mm:ss:
+
+    - from/to: only points from (inclusive) and to (exclusive) those times
+    - interval: seconds between the points reconstructed in between two stored
+      emissions of a compressed stretch (TRAJECTORY_INTERVAL by default)
+
+    Responses:
+
+    - Success [200]: one {"latitude", "longitude", "heading", "timestamp",
+      "reconstructed", "tolerance"} JSON object per line (Content-Type:
+      application/x-ndjson). Stored emissions aren't reconstructed, and have no
+      tolerance. Reconstructed points come with the tolerance (in meters) of
+      their stretch: the emissions that were dropped from it are within that
+      distance of where it puts them.
+    - Badly formatted values [400]: 'Invalid value(s) provided.'
+    - Vehicle not registered [404]: 'Vehicle not found.'
+    """
+    try:
+        args = request.args
+        start = datetime.strptime(args['from'], '%d-%m-%Y %H:%M:%S') \
+                if 'from' in args else None
+        end = datetime.strptime(args['to'], '%d-%m-%Y %H:%M:%S') \
+              if 'to' in args else None
+        interval = float(args.get('interval', current_app.config.get('TRAJECTORY_INTERVAL', 20)))
+        if not interval > 0:
+            raise ValueError
     except ValueError:
         return 'Invalid value(s) provided.', 400
-    except Exception as ex:
-        return 'Error! Did you send the right data fields? ', 400
-    return 'Success!', 200
\ No newline at end of file
+    if not vehicle_registered(vehicleID):
+        return 'Vehicle not found.', 404
+
+    # Stretches that overlap the window are read whole, to be reconstructed
+    segments = db.session.query(TrajectorySegment.start, TrajectorySegment.end,
+                                TrajectorySegment.method, TrajectorySegment.tolerance) \
+                 .filter(TrajectorySegment.vehicle_id == vehicleID)
+    if start is not None:
+        segments = segments.filter(TrajectorySegment.end >= start)
+    if end is not None:
+        segments = segments.filter(TrajectorySegment.start < end)
+    segments = segments.order_by(TrajectorySegment.start).all()
+    query = db.session.query(Emission.timestamp, Emission.latitude,
+                             Emission.longitude, Emission.heading) \
+              .filter(of_vehicle(vehicleID))
+    if start is not None:
+        query = query.filter(Emission.timestamp >= min(
+            [start] + [segment.start for segment in segments[:1]]))
+    if end is not None:
+        query = query.filter(Emission.timestamp <= max(
+            [end] + [segment.end for segment in segments[-1:]]))
+    query = query.order_by(Emission.timestamp)
+
+    def generate():
+        for timestamp, latitude, longitude, heading, tolerance in \
+                trajectory.restore(query.yield_per(1000), segments, interval):
+            if (start is not None and timestamp < start) or \
+               (end is not None and timestamp >= end):
+                continue
+            yield json.dumps(dict(latitude=latitude, longitude=longitude,
+                                  heading=heading,
+                                  timestamp=timestamp.strftime('%d-%m-%Y %H:%M:%S'),
+                                  reconstructed=tolerance is not None,
+                                  tolerance=tolerance)) + '\n'
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson'), 200
+
+@api.route('/api/v1/rollups', methods=['GET'])
+def fleet_rollups():
+    """The API endpoint that serves fleet statistics from the hourly rollups
+    (see VehicleHour), without reading the emissions.
+    URL:
+    ::
+        /api/v1/rollups?from=<TIMESTAMP>&to=<TIMESTAMP>&period=<hour|day>
+
+    All parameters are optional, and timestamps are in the form DD-MM-YYYY hh:mm:ss:
+
+    - from/to: only the hours from (inclusive) and to (exclusive) those times
+    - period: hour (the default) or day, what the statistics are totalled by
+    - type: only the vehicles of that type
+    - vehicle_id: only that vehicle
+
+    Responses:
+
+    - Success [200]: JSON {"rollups": [...]} with one {"period", "type",
+      "emissions", "distance", "vehicles"} entry per period and vehicle type,
+      oldest first, where the period is the timestamp it starts at, the
+      distance is in kms, and vehicles is the number of vehicles that emitted
+      in the period
+    - Badly formatted values [400]: 'Invalid value(s) provided.'
+    - Vehicle type invalid [400]: 'Vehicle type is invalid.'
+    """
+    try:
+        args = request.args
+        start = datetime.strptime(args['from'], '%d-%m-%Y %H:%M:%S') \
+                if 'from' in args else None
+        end = datetime.strptime(args['to'], '%d-%m-%Y %H:%M:%S') \
+              if 'to' in args else None
+        period = args.get('period', 'hour')
+        if period not in ('hour', 'day'):
+            raise ValueError
+    except ValueError:
+        return 'Invalid value(s) provided.', 400
+    query = db.session.query(VehicleHour.hour, Vehicle.type, VehicleHour.vehicle_id,
+                             VehicleHour.emissions, VehicleHour.distance) \
+              .join(Vehicle, Vehicle.id == VehicleHour.vehicle_id)
+    if start is not None:
+        query = query.filter(VehicleHour.hour >= start)
+    if end is not None:
+        query = query.filter(VehicleHour.hour < end)
+    vehicle_type = args.get('type')
+    if vehicle_type is not None:
+        if vehicle_type.lower() not in valid_types:
+            return 'Vehicle type is invalid.', 400
+        query = query.filter(Vehicle.type == vehicle_type.lower())
+    if 'vehicle_id' in args:
+        query = query.filter(VehicleHour.vehicle_id == args['vehicle_id'])
+
+    totals = {}
+    for hour, vType, vID, emissions, distance in query.yield_per(10000):
+        key = (hour if period == 'hour' else hour.replace(hour=0), vType)
+        total = totals.setdefault(key, [0, 0.0, set()])
+        total[0] += emissions
+        total[1] += distance
+        total[2].add(vID)
+    return jsonify(rollups=[dict(
+        period=key[0].strftime('%d-%m-%Y %H:%M:%S'),
+        type=key[1],
+        emissions=total[0],
+        distance=total[1],
+        vehicles=len(total[2]),
+    ) for key, total in sorted(totals.items())]), 200
+
+tile_cache = LRUCache(settings.get('HEATMAP_CACHE_SIZE', 1000))
+"""Heatmap tiles this worker rendered, by (zoom, x, y, from, to), as (expires,
+etag, body), where expires is None for the tiles of closed time windows."""
+
+@api.route('/api/v1/heatmap/<int:zoom>/<int:x>/<int:y>', methods=['GET'])
+def heatmap_tile(zoom, x, y):
+    """The API endpoint that serves the tiles of the heatmap of emissions (see
+    snowdonia.heatmap).
+    URL:
+    ::
+        /api/v1/heatmap/<ZOOM>/<X>/<Y>?from=<TIMESTAMP>&to=<TIMESTAMP>
+
+    The zoom is between HEATMAP_MIN_ZOOM and HEATMAP_MAX_ZOOM, and x/y are the
+    tile's, as in any web map. Timestamps are optional, in the form DD-MM-YYYY
+    hh:mm:ss:
+
+    - from/to: only the emissions of the time buckets from the one from falls in
+      (inclusive) to the one to falls in (exclusive)
+
+    Tiles are cached by every worker, and served with an ETag: a request whose
+    If-None-Match has the tile's ETag gets a 304, without a body.
+
+    Responses:
+
+    - Success [200]: JSON {"zoom", "x", "y", "size", "max", "cells": [...]},
+      where every cell that had emissions is a [column, row, emissions] entry,
+      column and row being from 0 to size - 1 from the top left of the tile
+    - Not modified [304]
+    - Badly formatted values [400]: 'Invalid value(s) provided.'
+    - Tile out of range, or HEATMAP off [404]: 'Tile not found.'
+    """
+    try:
+        args = request.args
+        start = datetime.strptime(args['from'], '%d-%m-%Y %H:%M:%S') \
+                if 'from' in args else None
+        end = datetime.strptime(args['to'], '%d-%m-%Y %H:%M:%S') \
+              if 'to' in args else None
+    except ValueError:
+        return 'Invalid value(s) provided.', 400
+    heat_counter = current_heat_counter()
+    if heat_counter is None or not heatmap.valid_tile(zoom, x, y,
+            heat_counter.min_zoom, heat_counter.max_zoom):
+        return 'Tile not found.', 404
+    if start is not None:
+        start = heatmap.bucket_of(start, heat_counter.bucket)
+    if end is not None:
+        end = heatmap.bucket_of(end, heat_counter.bucket)
+
+    key = (zoom, x, y, start, end)
+    cached = tile_cache.get(key)
+    if cached is None or (cached[0] is not None and cached[0] < time.time()):
+        first_x, first_y, last_x, last_y = heatmap.tile_bounds(zoom, x, y)
+        query = db.session.query(HeatCell.x, HeatCell.y, func.sum(HeatCell.emissions)) \
+                  .filter(HeatCell.level == zoom + heatmap.CELL_BITS,
+                          HeatCell.x.between(first_x, last_x),
+                          HeatCell.y.between(first_y, last_y))
+        if start is not None:
+            query = query.filter(HeatCell.bucket >= start)
+        if end is not None:
+            query = query.filter(HeatCell.bucket < end)
+        cells = sorted([cell_x - first_x, cell_y - first_y, int(count)] for
+                       cell_x, cell_y, count in query.group_by(HeatCell.x, HeatCell.y))
+        body = json.dumps(dict(zoom=zoom, x=x, y=y, size=heatmap.CELLS,
+                               max=max([cell[2] for cell in cells] or [0]),
+                               cells=cells))
+        closed = end is not None and end + heatmap.CLOSED_AFTER < datetime.utcnow()
+        cached = (None if closed else time.time() + current_app.config.get('HEATMAP_CACHE_TTL', 60),
+                  hashlib.sha1(body.encode('utf-8')).hexdigest(), body)
+        tile_cache.set(key, cached)
+    response = Response(cached[2], mimetype='application/json')
+    response.set_etag(cached[1])
+    return response.make_conditional(request)
+
+@api.route('/api/v1/export', methods=['GET'])
+def export_emissions_endpoint():
+    """The API endpoint that exports emissions, joined with their vehicles' types,
+    for analysis.
+    URL:
+    ::
+        /api/v1/export?from=<TIMESTAMP>&to=<TIMESTAMP>&format=<FORMAT>
+
+    All parameters are optional, and timestamps are in the form DD-MM-YYYY hh:mm:ss:
+
+    - from/to: only emissions from (inclusive) and to (exclusive) those times
+    - format: csv (the default), parquet or arrow (an Arrow IPC stream). Parquet
+      and Arrow need pyarrow to be installed.
+
+    The file is streamed as it's written from a server-side cursor, one chunk
+    at a time (see snowdonia.export), so any time window can be exported.
+
+    Responses:
+
+    - Success [200]: the file, with the format's content type
+    - Badly formatted values [400]: 'Invalid value(s) provided.'
+    - Format unavailable [400]: 'Format unavailable.'
+    """
+    try:
+        args = request.args
+        start = datetime.strptime(args['from'], '%d-%m-%Y %H:%M:%S') \
+                if 'from' in args else None
+        end = datetime.strptime(args['to'], '%d-%m-%Y %H:%M:%S') \
+              if 'to' in args else None
+    except ValueError:
+        return 'Invalid value(s) provided.', 400
+    format = args.get('format', 'csv')
+    if not export.available(format):
+        return 'Format unavailable.', 400
+    filename = 'emissions.%s' % format
+    return Response(stream_with_context(export.WRITERS[format](
+                        export_rows(start, end))),
+                    mimetype=export.FORMATS[format],
+                    headers={'Content-Disposition':
+                             'attachment; filename=%s' % filename}), 200
+
+def warm_up(app):
+    """Gets this worker ready to serve its first emission as fast as the next
+    ones (with WARM_UP on): loads the registered vehicles (as many as fit in
+    known_vehicles), the vehicles that left the city and the positions of the
+    fleet, and runs the geofence once. Meant to run before gunicorn forks its
+    workers (with --preload), which then all start with what it loaded. The
+    connections it opened are closed, so that no worker shares them."""
+    global _warm_vehicle_cache
+    with app.app_context():
+        warm_vehicle_cache()
+        _warm_vehicle_cache = False
+        if app.config.get('EXITED_VEHICLES', True):
+            load_exited_vehicles()
+        load_vehicle_index()
+        valid_point(53.067723, -4.07495, 0)
+        valid_points([53.067723], [-4.07495], [0], city_boundary)
+        db.session.remove()
+        db.engine.dispose()
+
+def after_fork(app):
+    """Closes the connections of the app's engine in a forked process (e.g. a
+    gunicorn worker, with --preload), so that it opens its own instead of
+    sharing its parent's. It's called for every app (that's still alive) in
+    every forked process where Python has os.register_at_fork (3.7 and up).
+    With older Pythons, call it from gunicorn's post_fork hook."""
+    with app.app_context():
+        db.engine.dispose()
+
+apps = weakref.WeakSet()
+"""The apps created by create_app(), which after_fork() is called with."""
+
+def _after_fork():
+    for forked_app in list(apps):
+        after_fork(forked_app)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
+
+def create_app(config=None):
+    """Creates an app: with settings, then config (a dict) if given, the API
+    and the CLI commands. No database connection is opened until the app first
+    uses the database (Flask-SQLAlchemy 2 creates the engine then too, while
+    Flask-SQLAlchemy 3 creates it in init_app(), without connecting), and
+    connections are never shared with forked processes (see after_fork()).
+    With WARM_UP on, the worker is warmed up (see warm_up()), which does
+    connect, before the app is returned. How long it all took is served on
+    /metrics, as snowdonia_startup_seconds.
+
+    Every app has its own write-behind buffer (or writers' router) and heat
+    counter (see current_emission_buffer() and current_heat_counter()), so its
+    emissions and heatmap are written to its own database. Other settings that
+    shape the tables and the state of the worker are only read from settings
+    (see above), so config can't change them.
+    """
+    global startup_seconds
+    started = time.time()
+    app = Flask(__name__)
+    app.config.update(settings)
+    if config:
+        app.config.update(config)
+    db.init_app(app)
+    app.register_blueprint(api)
+    for cli_command in commands:
+        app.cli.add_command(cli_command)
+    if app.config.get('WRITERS'):
+        emission_buffer = ShardRouter(
+            app.config.get('WRITERS_SOCKET_DIR', '/tmp/snowdonia-writers'),
+            app.config['WRITERS'], write_emissions,
+            app.config.get('WRITERS_SEND_TIMEOUT', 1.0))
+    elif app.config.get('WRITE_BEHIND'):
+        emission_buffer = new_emission_buffer(app)
+    else:
+        emission_buffer = None
+    heat_counter = HeatmapCounter(app.config.get('HEATMAP_MIN_ZOOM', 8),
+                                  app.config.get('HEATMAP_MAX_ZOOM', 14),
+                                  app.config.get('HEATMAP_BUCKET', 3600)) \
+                   if app.config.get('HEATMAP', False) else None
+    app.extensions['snowdonia'] = dict(emission_buffer=emission_buffer,
+                                       heat_counter=heat_counter,
+                                       heatmap_flusher_pid=None)
+    apps.add(app)
+    if app.config.get('WARM_UP', False):
+        warm_up(app)
+    startup_seconds = time.time() - started
+    return app
+
+class LazyApp(object):
+    """Stands in for the app made by factory(), which it makes (once) the first
+    time it's used, so that importing snowdonia creates no app (nor engine). It
+    can be served like the app (it's a WSGI app too), and used like it."""
+    def __init__(self, factory):
+        self._factory = factory
+        self._app = None
+        self._lock = threading.Lock()
+
+    def _get_current_object(self):
+        """The app, made by factory() if it wasn't yet."""
+        if self._app is None:
+            with self._lock:
+                if self._app is None:
+                    self._app = self._factory()
+        return self._app
+
+    @property
+    def __class__(self):
+        return self._get_current_object().__class__ # for the flask command
+
+    def __getattr__(self, name):
+        return getattr(self._get_current_object(), name)
+
+    def __call__(self, environ, start_response):
+        return self._get_current_object()(environ, start_response)
+
+    def __repr__(self):
+        if self._app is None:
+            return '<LazyApp of %s (not made yet)>' % self._factory.__name__
+        return repr(self._app)
+
+app = LazyApp(create_app)
+"""The app served by gunicorn snowdonia:app (and run by FLASK_APP=snowdonia
+flask), created by create_app() when it's first used, or when snowdonia is
+imported with WARM_UP on (so that gunicorn --preload warms it up before forking
+its workers). Tests and tools can create apps of their own with create_app()."""
+
+if settings.get('WARM_UP', False):
+    app._get_current_object()
@@ -0,0 +1,145 @@
+"""
+Admission Control
+=================
+
+When the database slows down, every request that registers emissions waits on
+it, so requests pile up in the workers, and emitters (which retry) only make it
+worse. The emission endpoints are guarded by an AdmissionControl per worker
+(see config.py) that sheds load with 503 and a Retry-After header instead, so
+that emitters back off and the requests that are admitted stay fast:
+
+- At most ADMISSION_MAX_IN_FLIGHT requests are handled at a time (with threaded
+  or async workers). A request that doesn't get a slot within ADMISSION_WAIT
+  seconds is shed as busy, and told to retry in a second.
+- The time requests spend on the database (looking vehicles up, writing
+  emissions, committing) is averaged (an exponentially weighted moving
+  average). When the average goes over ADMISSION_LATENCY_THRESHOLD seconds, or
+  FAILURES database errors (e.g. connections refused or timing out) happen in a
+  row, the circuit opens: every request is shed for ADMISSION_OPEN_SECONDS
+  (its Retry-After). Then one request is let through as a probe: if it's fast,
+  the circuit closes, and if it's slow or fails, it opens again.
+
+Requests that are already in flight when the circuit opens aren't interrupted.
+A request whose database error isn't shed is answered with 503 (rather than 400)
+too. Every worker counts the requests it admitted and shed, and the times its
+circuit opened, which are served on /metrics (see snowdonia.metrics).
+"""
+import threading
+import time
+from math import ceil
+
+FAILURES = 3
+"""Database errors in a row that open the circuit."""
+DECAY = 0.2
+"""Weight of the latest latency in the moving average."""
+
+
+class AdmissionControl(object):
+    """Admission control of one worker: a bound on the requests in flight, and a
+    circuit breaker on the latency of the database. See the module's docs.
+
+    - admit() admits a request (or returns why it's shed), and release() ends it.
+    - observe(seconds) records the time a request spent on the database, and
+      failure() a database error.
+    - retry_after() is when shed requests should be retried, in seconds.
+
+    A max_in_flight of 0 doesn't bound the requests, and a latency_threshold of
+    0 (or None) turns the circuit breaker off.
+    """
+    def __init__(self, max_in_flight=0, wait=0, latency_threshold=None,
+                 open_seconds=5, clock=time.time):
+        self.max_in_flight = max_in_flight
+        self.wait = wait
+        self.latency_threshold = latency_threshold
+        self.open_seconds = open_seconds
+        self.clock = clock
+        self.in_flight = 0
+        self.latency = 0.0
+        self.failures = 0
+        self.opened_at = None
+        self.probe = None
+        self.counters = dict(admitted=0, shed_busy=0, shed_open=0, opened=0,
+                             db_failures=0)
+        self._slots = threading.Condition()
+
+    def admit(self):
+        """Admits a request: returns None if it's admitted (release() it when
+        it's done), or why it's shed: 'open' (the circuit is open) or 'busy'
+        (too many requests in flight)."""
+        with self._slots:
+            if self.opened_at is not None:
+                if self.clock() < self.opened_at + self.open_seconds or \
+                   self.probe is not None:
+                    self.counters['shed_open'] += 1
+                    return 'open'
+                self.probe = threading.current_thread().ident
+            if self.max_in_flight:
+                deadline = time.time() + self.wait
+                while self.in_flight >= self.max_in_flight:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        if self.probe == threading.current_thread().ident:
+                            self.probe = None
+                        self.counters['shed_busy'] += 1
+                        return 'busy'
+                    self._slots.wait(remaining)
+            self.in_flight += 1
+            self.counters['admitted'] += 1
+            return None
+
+    def release(self):
+        """Ends an admitted request. A probe that didn't touch the database
+        leaves the circuit half-open, for the next request to probe."""
+        with self._slots:
+            self.in_flight -= 1
+            if self.probe == threading.current_thread().ident:
+                self.probe = None
+            self._slots.notify()
+
+    def observe(self, seconds):
+        """Records that a request spent seconds on the database."""
+        if not self.latency_threshold:
+            return
+        with self._slots:
+            self.failures = 0
+            self.latency += DECAY * (seconds - self.latency)
+            if self.opened_at is None:
+                if self.latency > self.latency_threshold:
+                    self._open()
+            elif seconds > self.latency_threshold:
+                self._open()
+            elif self.clock() >= self.opened_at + self.open_seconds:
+                # The probe (or a request admitted before the circuit opened)
+                # was fast: the database is back
+                self.opened_at, self.probe, self.latency = None, None, seconds
+
+    def failure(self):
+        """Records a database error."""
+        with self._slots:
+            self.counters['db_failures'] += 1
+            self.failures += 1
+            if self.latency_threshold and (self.opened_at is not None or
+                                           self.failures >= FAILURES):
+                self._open()
+
+    def _open(self):
+        now = self.clock()
+        if self.opened_at is None or now >= self.opened_at + self.open_seconds:
+            self.counters['opened'] += 1
+        self.opened_at, self.probe, self.failures = now, None, 0
+
+    def retry_after(self):
+        """Seconds until shed requests should be retried: until the circuit is
+        half-open if it's open, or 1."""
+        if self.opened_at is None:
+            return 1
+        return max(1, int(ceil(self.opened_at + self.open_seconds - self.clock())))
+
+    def stats(self):
+        """Counters of the requests admitted and shed, the times the circuit
+        opened, and the database errors, plus the requests in flight, the
+        average database latency in seconds, and whether the circuit is open."""
+        with self._slots:
+            return dict(self.counters, in_flight=self.in_flight,
+                        db_latency=round(self.latency, 6),
+                        circuit_open=int(self.opened_at is not None))
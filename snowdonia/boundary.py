@@ -0,0 +1,208 @@
+"""
+Boundary
+========
+
+By default, Snowdonia is the circle of snowdonia_radius around snowdonia_center
+(see snowdonia.geo). With BOUNDARY set to the path of a GeoJSON file (see
+config.py), it's the area of the polygons in that file instead: Polygon and
+MultiPolygon geometries, on their own or in Features, FeatureCollections and
+GeometryCollections, with holes (every ring after the first one of a polygon),
+and as many vertices as the real borders take.
+
+Polygons are taken as GeoJSON defines them: their edges are straight lines in
+(longitude, latitude), and a point is in the boundary if it's inside an odd
+number of rings (so in a polygon, but not in one of its holes). Points exactly
+on an edge can go either way.
+
+Checking a point against every edge would cost as much as the boundary has
+vertices, so the boundary is indexed once, when it's loaded, on a grid over its
+bounding box (about twice as many cells per side as the square root of the
+number of edges):
+
+- Cells that no edge goes through are entirely in or out of the boundary, which
+  is all there is to know about the points in them. That's most of the cells,
+  and most of the points.
+- Cells that edges go through keep those edges, and whether their center is in
+  the boundary. A point in such a cell is in the boundary if its center is and
+  the segment between them crosses an even number of the cell's edges (or if it
+  isn't and the segment crosses an odd number), which only takes the cell's few
+  edges.
+
+So checking a point costs about the same whatever the number of vertices. See
+benchmarks/boundary.py.
+"""
+import json
+from bisect import bisect_left
+from math import ceil, sqrt
+
+MIN_CELLS = 16
+MAX_CELLS = 1024
+"""Bounds of the cells per side of the grid."""
+EDGES = 2
+"""State of the cells that edges go through (see Boundary.states)."""
+
+
+def polygons(geojson):
+    """The polygons of a GeoJSON object (a dict), as lists of rings, each a list
+    of (longitude, latitude) vertices. Raises ValueError if it holds no
+    polygons."""
+    found = []
+    _collect(geojson, found)
+    if not found:
+        raise ValueError('No polygons in the GeoJSON object.')
+    return found
+
+
+def _collect(geojson, found):
+    kind = geojson.get('type')
+    if kind == 'FeatureCollection':
+        for feature in geojson['features']:
+            _collect(feature, found)
+    elif kind == 'Feature':
+        if geojson.get('geometry'):
+            _collect(geojson['geometry'], found)
+    elif kind == 'GeometryCollection':
+        for geometry in geojson['geometries']:
+            _collect(geometry, found)
+    elif kind == 'Polygon':
+        found.append([[tuple(vertex[:2]) for vertex in ring]
+                      for ring in geojson['coordinates']])
+    elif kind == 'MultiPolygon':
+        for polygon in geojson['coordinates']:
+            found.append([[tuple(vertex[:2]) for vertex in ring] for ring in polygon])
+
+
+def load(path):
+    """The Boundary of the polygons in the GeoJSON file at path."""
+    with open(path) as f:
+        return Boundary(polygons(json.load(f)))
+
+
+def _orientation(ax, ay, bx, by, cx, cy):
+    """Which side of the line from a to b c is on: True on the left (or on the
+    line), False on the right."""
+    return (bx - ax) * (cy - ay) - (by - ay) * (cx - ax) >= 0
+
+
+def crosses(edge, x1, y1, x2, y2):
+    """Whether the segment from (x1, y1) to (x2, y2) crosses the edge, as
+    (x1, y1, x2, y2). Points on a line count as on its left, so that a segment
+    through a vertex crosses exactly one of the two edges of the vertex (or
+    neither of them, if it only touches it)."""
+    ax, ay, bx, by = edge
+    return _orientation(ax, ay, bx, by, x1, y1) != _orientation(ax, ay, bx, by, x2, y2) \
+       and _orientation(x1, y1, x2, y2, ax, ay) != _orientation(x1, y1, x2, y2, bx, by)
+
+
+def edges_of(polygons):
+    """The edges of all the rings of the polygons, as (x1, y1, x2, y2) tuples,
+    where x is the longitude and y the latitude. Rings don't have to be closed
+    (repeat their first vertex at their end)."""
+    edges = []
+    for polygon in polygons:
+        for ring in polygon:
+            for index, (x1, y1) in enumerate(ring):
+                x2, y2 = ring[(index + 1) % len(ring)]
+                if (x1, y1) != (x2, y2):
+                    edges.append((x1, y1, x2, y2))
+    return edges
+
+
+def crossings(edges, y):
+    """The sorted longitudes at which the edges cross the parallel at latitude
+    y. An edge crosses it if one end is above y and the other isn't."""
+    return sorted(x1 + (y - y1) * (x2 - x1) / (y2 - y1) for x1, y1, x2, y2 in edges
+                  if (y1 > y) != (y2 > y))
+
+
+class Boundary(object):
+    """The area of polygons (as returned by polygons()), indexed on a grid of
+    cells by cells (picked from the number of edges if not given) to check
+    points against it in about constant time. See the module's docs.
+
+    grid holds the cells row by row (see _index()), and states the state of
+    every cell, as a byte: 1 (in), 0 (out), or EDGES.
+    """
+    def __init__(self, polygons, cells=None):
+        self.edges = edges_of(polygons)
+        if not self.edges:
+            raise ValueError('The polygons have no edges.')
+        xs = [x for edge in self.edges for x in (edge[0], edge[2])]
+        ys = [y for edge in self.edges for y in (edge[1], edge[3])]
+        self.min_x, self.max_x = min(xs), max(xs)
+        self.min_y, self.max_y = min(ys), max(ys)
+        self.cells = cells or min(MAX_CELLS, max(MIN_CELLS,
+                                                 int(ceil(2 * sqrt(len(self.edges))))))
+        self.cell_width = (self.max_x - self.min_x) / self.cells or 1.0
+        self.cell_height = (self.max_y - self.min_y) / self.cells or 1.0
+        self.grid = self._index()
+        self.states = bytes(EDGES if isinstance(cell, tuple) else int(cell)
+                            for cell in self.grid)
+
+    def _index(self):
+        """The cells, row by row: True or False for cells entirely in or out of
+        the boundary, or (center_in_boundary, center_x, center_y, edges) for
+        cells that edges go through."""
+        edges_by_cell, edges_by_row = {}, {}
+        for edge in self.edges:
+            for row, column in self._cells_of(edge):
+                edges_by_cell.setdefault((row, column), []).append(edge)
+                edges_by_row.setdefault(row, set()).add(edge)
+        grid = []
+        for row in range(self.cells):
+            # Only the edges that go through the row can cross its middle
+            y = self.min_y + (row + 0.5) * self.cell_height
+            row_crossings = crossings(edges_by_row.get(row, ()), y)
+            for column in range(self.cells):
+                x = self.min_x + (column + 0.5) * self.cell_width
+                inside = bisect_left(row_crossings, x) % 2 == 1
+                edges = edges_by_cell.get((row, column))
+                grid.append((inside, x, y, tuple(edges)) if edges else inside)
+        return grid
+
+    def _cells_of(self, edge):
+        """The (row, column) of the cells the edge goes through."""
+        x1, y1, x2, y2 = edge
+        first, last = sorted((self._row(y1), self._row(y2)))
+        for row in range(first, last + 1):
+            # The part of the edge within the row
+            bottom = max(min(y1, y2), self.min_y + row * self.cell_height)
+            top = min(max(y1, y2), self.min_y + (row + 1) * self.cell_height)
+            if y1 == y2:
+                xs = (x1, x2)
+            else:
+                xs = [x1 + (y - y1) * (x2 - x1) / (y2 - y1) for y in (bottom, top)]
+            for column in range(self._column(min(xs)), self._column(max(xs)) + 1):
+                yield row, column
+
+    def _row(self, y):
+        return min(self.cells - 1, max(0, int((y - self.min_y) / self.cell_height)))
+
+    def _column(self, x):
+        return min(self.cells - 1, max(0, int((x - self.min_x) / self.cell_width)))
+
+    def cell(self, latitude, longitude):
+        """The cell the point is in (see _index()), or False if the point is
+        outside the bounding box."""
+        if not (self.min_x <= longitude <= self.max_x and
+                self.min_y <= latitude <= self.max_y):
+            return False
+        return self.grid[self._row(latitude) * self.cells + self._column(longitude)]
+
+    def contains(self, latitude, longitude):
+        """Whether the point (in degrees) is in the boundary."""
+        cell = self.cell(latitude, longitude)
+        if cell is True or cell is False:
+            return cell
+        return contains_in_cell(cell, latitude, longitude)
+
+
+def contains_in_cell(cell, latitude, longitude):
+    """Whether the point, in a cell that edges go through, is in the boundary:
+    its center's answer, flipped by every edge between the center and the
+    point."""
+    inside, x, y, edges = cell
+    for edge in edges:
+        if crosses(edge, x, y, longitude, latitude):
+            inside = not inside
+    return inside
@@ -0,0 +1,223 @@
+"""
+Write-behind Buffer
+===================
+
+When WRITE_BEHIND is on (see config.py), validated emissions are not committed by
+the request that received them. They are appended to an in-process, bounded buffer
+instead, and a background thread writes them to the database in batches: as soon as
+WRITE_BEHIND_BATCH_SIZE rows are waiting, or every WRITE_BEHIND_INTERVAL seconds,
+whichever comes first. Requests then return after validation, not after a commit.
+
+Every (gunicorn) worker process has its own buffer and its own flusher thread, which
+is started lazily by the first emission the worker receives, so it survives forking.
+The buffer is flushed one last time when the worker shuts down.
+
+A batch that can't be written (e.g. the database is down) is put back at the front
+of the buffer and retried, waiting twice as long after every failure, up to
+MAX_BACKOFF seconds. Meanwhile the buffer fills up, and once it's full requests
+write synchronously, so they fail (and emitters retry) instead of being answered
+with success. Emissions only count as registered (see recent_emissions) once
+they're committed.
+
+Please note that a worker that is killed (rather than shut down) loses the emissions
+that are still in its buffer, which is at most WRITE_BEHIND_INTERVAL seconds' worth,
+and so does a worker that shuts down while the database is down, after
+FINAL_ATTEMPTS attempts to write them.
+"""
+import atexit
+import os
+import threading
+import time
+
+MAX_BACKOFF = 30
+"""Longest wait (in seconds) before retrying a batch that couldn't be written."""
+FINAL_ATTEMPTS = 3
+"""Attempts to write what's left in the buffer when it's stopped."""
+
+
+class EmissionBuffer(object):
+    """Bounded buffer of emission rows (dicts of Emission column values) with a
+    background thread that flushes them in batches using multi-row INSERTs.
+
+    If the buffer is full (the database can't keep up), put() and extend() write
+    the rows synchronously in the calling thread instead (and raise if they
+    can't), so a slow database slows the requests down rather than losing their
+    emissions. Batches the flusher can't write are put back and retried.
+
+    Rows are written with table.insert(), or with write(connection, rows) if
+    given (e.g. one that skips rows that are already there), which returns the
+    rows it wrote. after_write(connection, rows), if given, is then called with
+    the rows written, in the same transaction, to keep what's derived from
+    emissions up to date. after_commit(rows), if given, is called with the rows
+    written once their transaction committed.
+    """
+    def __init__(self, app, db, table, batch_size=500, interval=0.2,
+                 max_size=10000, after_write=None, write=None, after_commit=None):
+        self.app = app
+        self.db = db
+        self.table = table
+        self.after_write = after_write
+        self.write = write
+        self.after_commit = after_commit
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_size = max_size
+        self._rows = []
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._backoff = 0
+        self.enqueued = 0
+        self.flushed = 0
+        self.failed = 0
+        self.retried = 0
+        self.written_synchronously = 0
+        self.flushes = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        atexit.register(self.stop)
+
+    def put(self, row):
+        """Queues one emission row to be written by the flusher."""
+        self.extend([row])
+
+    def extend(self, rows):
+        """Queues several emission rows to be written by the flusher."""
+        self._ensure_started()
+        with self._lock:
+            if len(self._rows) + len(rows) <= self.max_size:
+                self._rows.extend(rows)
+                self.enqueued += len(rows)
+                if len(self._rows) >= self.batch_size:
+                    self._ready.notify()
+                return
+            self.written_synchronously += len(rows)
+        try:
+            self._write(rows)
+        except Exception:
+            with self._lock:
+                self.failed += len(rows)
+            raise
+
+    def flush(self):
+        """Writes everything that is currently in the buffer. Returns False if a
+        batch couldn't be written, in which case it's put back, with the rest."""
+        with self._lock:
+            rows, self._rows = self._rows, []
+        for start in range(0, len(rows), self.batch_size):
+            if not self._write_or_requeue(rows[start:start + self.batch_size],
+                                          rows[start + self.batch_size:]):
+                return False
+        return True
+
+    def stop(self):
+        """Stops the flusher thread (if it's running) and flushes the buffer,
+        giving up on what's left after FINAL_ATTEMPTS attempts."""
+        with self._lock:
+            self._stopping = True
+            self._ready.notify()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join()
+        for attempt in range(FINAL_ATTEMPTS):
+            if self.flush():
+                return
+            time.sleep(min(MAX_BACKOFF, self.interval * 2 ** attempt))
+        with self._lock:
+            lost, self._rows = len(self._rows), []
+            self.failed += lost
+        self.app.logger.error('Gave up on %d emission(s)', lost)
+
+    def stats(self):
+        """Counters for the buffer of the current worker. Latencies are in ms."""
+        with self._lock:
+            depth = len(self._rows)
+        return dict(
+            depth=depth,
+            max_size=self.max_size,
+            enqueued=self.enqueued,
+            flushed=self.flushed,
+            failed=self.failed,
+            retried=self.retried,
+            written_synchronously=self.written_synchronously,
+            flushes=self.flushes,
+            last_flush_latency=self.last_flush_latency * 1000,
+            max_flush_latency=self.max_flush_latency * 1000,
+        )
+
+    def _ensure_started(self):
+        """Starts the flusher thread in this process if it isn't running yet.
+        Threads don't survive a fork, so a forked worker starts its own."""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run,
+                                            name='emission-buffer')
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        """Flusher loop: waits for a full batch or the interval (or, after a
+        failure, for the backoff), then writes."""
+        while True:
+            with self._lock:
+                if self._backoff:
+                    retry_at = time.time() + self._backoff
+                    while not self._stopping and time.time() < retry_at:
+                        self._ready.wait(retry_at - time.time())
+                elif len(self._rows) < self.batch_size and not self._stopping:
+                    self._ready.wait(self.interval)
+                if self._stopping:
+                    return
+                rows = self._rows[:self.batch_size]
+                del self._rows[:self.batch_size]
+            if rows:
+                self._write_or_requeue(rows)
+
+    def _write_or_requeue(self, rows, rest=()):
+        """Writes rows taken from the buffer. If they can't be written, puts them
+        (and rest, the rows taken after them) back at the front of the buffer,
+        and backs off. Returns whether they were written."""
+        try:
+            self._write(rows, flushing=True)
+        except Exception:
+            self.app.logger.exception('Could not write %d emission(s), will retry',
+                                      len(rows))
+            with self._lock:
+                self._rows[:0] = list(rows) + list(rest)
+                self.retried += len(rows)
+                self._backoff = min(MAX_BACKOFF, max(self.interval, 2 * self._backoff))
+            return False
+        with self._lock:
+            self._backoff = 0
+        return True
+
+    def _write(self, rows, flushing=False):
+        """Inserts the rows with one multi-row INSERT in its own transaction.
+        Raises if they couldn't be written."""
+        if not rows:
+            return
+        started = time.time()
+        with self.app.app_context():
+            with self.db.engine.begin() as connection:
+                if self.write is None:
+                    connection.execute(self.table.insert().values(rows))
+                    written = rows
+                else:
+                    written = self.write(connection, rows)
+                if self.after_write is not None and written:
+                    self.after_write(connection, written)
+            if self.after_commit is not None and written:
+                self.after_commit(written)
+        if flushing:
+            latency = time.time() - started
+            with self._lock:
+                self.flushed += len(rows)
+                self.flushes += 1
+                self.last_flush_latency = latency
+                self.max_flush_latency = max(self.max_flush_latency, latency)
@@ -0,0 +1,89 @@
+"""
+Caches
+======
+
+Small in-process caches used by the app. Every (gunicorn) worker process has its
+own copy of each cache, so they only hold things that never become wrong once
+they're true (e.g. a vehicle being registered), or that are cheap to miss.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Thread-safe mapping that holds at most max_size keys, evicting the least
+    recently used one when it's full. Used as a set, keys map to True.
+
+    hits and misses count the lookups (get() and `in`) that found/didn't find
+    their key.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """The value for key (marking it as recently used), or default."""
+        with self._lock:
+            try:
+                value = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value=True):
+        """Adds or replaces key, evicting the least recently used key if needed."""
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = value
+            if len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def discard(self, key):
+        """Removes key if it's there."""
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        """Removes all the keys."""
+        with self._lock:
+            self._items.clear()
+
+    def __contains__(self, key):
+        return self.get(key, _missing) is not _missing
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RecentKeys(object):
+    """Thread-safe set of the (at most max_size) keys added in the last window
+    seconds, e.g. to notice an emitter retrying something it already sent."""
+    def __init__(self, max_size, window):
+        self.window = window
+        self._added = LRUCache(max_size)
+
+    def add(self, key):
+        """Adds key (again), restarting its window."""
+        self._added.set(key, time.time())
+
+    def __contains__(self, key):
+        added = self._added.get(key)
+        if added is None:
+            return False
+        if time.time() - added > self.window:
+            self._added.discard(key)
+            return False
+        return True
+
+    def __len__(self):
+        return len(self._added)
+
+
+_missing = object()
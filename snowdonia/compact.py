@@ -0,0 +1,154 @@
+"""
+Compact Schema
+==============
+
+By default, vehicles are identified by their UUIDs as 32 characters of hex
+everywhere: in vehicles, in every emission, and in the (vehicle_id, timestamp)
+index of emissions, which is more than half as big as the emissions table.
+With COMPACT_SCHEMA on (see config.py), tables are created with smaller types:
+
+- vehicles.id is a native UUID (16 bytes on PostgreSQL, instead of 33), and
+  every vehicle gets a key, an integer (4 bytes) that is its primary key.
+- emissions reference their vehicle by key (vehicle_key, instead of
+  vehicle_id), and so does their unique (vehicle_key, timestamp) index.
+- vehicles.type is a smallint, the index of the type in snowdonia.valid_types
+  (so types can be added to the end of the list, but never reordered).
+- latitude and longitude of emissions are reals (4 bytes instead of 8), which
+  are accurate to about half a meter at Snowdonia's latitude, well within what
+  GPS receivers report.
+- heading of emissions is a smallint (2 bytes instead of 4).
+
+On PostgreSQL, an emission row then takes 60 bytes (with its line pointer)
+instead of 100, and its index row 28 bytes instead of 60. The API doesn't
+change: vehicles are still sent and served as UUID hex, and workers look the
+keys of vehicles up (once, then cache them) as they register their emissions.
+
+Existing tables are migrated on PostgreSQL by the compact command, run with
+COMPACT_SCHEMA on and the app stopped (emissions are copied to a new table, in
+one transaction, so it takes a while and twice the disk space of the emissions
+table):
+::
+    $ FLASK_APP=snowdonia flask compact
+
+Partitioned emissions tables (see snowdonia.partitions) have to be migrated by
+hand. To measure the sizes of both schemas with generated emissions, see
+benchmarks/storage.py.
+"""
+from uuid import UUID
+
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.types import TypeDecorator, SmallInteger, String
+
+
+class VehicleUUID(TypeDecorator):
+    """A vehicle's UUID: native on PostgreSQL, 32 characters of hex elsewhere,
+    and UUID hex (lowercase) in Python either way. Values that aren't UUIDs are
+    bound as NULL, so that looking one up finds nothing (rather than failing,
+    as PostgreSQL does on a malformed UUID)."""
+    impl = String(32)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=False))
+        return dialect.type_descriptor(String(32))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        try:
+            return UUID(hex=value).hex
+        except (TypeError, ValueError):
+            return None
+
+    def process_result_value(self, value, dialect):
+        return UUID(str(value)).hex if value is not None else None
+
+
+class VehicleType(TypeDecorator):
+    """A vehicle's type, stored as its index in types (a smallint). Unknown
+    types are bound as NULL."""
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, types):
+        super(VehicleType, self).__init__()
+        self.types = tuple(types)
+
+    def process_bind_param(self, value, dialect):
+        return self.types.index(value) if value in self.types else None
+
+    def process_result_value(self, value, dialect):
+        return self.types[value] if value is not None else None
+
+
+def migrated(connection):
+    """Whether the tables already are in the compact schema."""
+    return connection.execute(text(
+        "SELECT count(*) FROM information_schema.columns "
+        "WHERE table_name = 'vehicles' AND column_name = 'key'")).scalar() > 0
+
+
+def migrate(connection, emissions, types, tables):
+    """Migrates the tables from the default schema to the compact one, in the
+    connection's transaction (PostgreSQL only):
+
+    - vehicles get their keys (numbered as they come) and a UUID id, and their
+      types are converted to indexes in types.
+    - the vehicle_id of the tables (the names of the other tables that reference
+      vehicles) is converted to a UUID.
+    - emissions are copied, with the keys of their vehicles, to emissions (the
+      compact emissions Table), which replaces the old table.
+
+    Returns the number of emissions copied.
+    """
+    for table, name in connection.execute(text(
+            "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = 'vehicles'::regclass")).fetchall():
+        connection.execute(text('ALTER TABLE %s DROP CONSTRAINT %s' % (table, name)))
+    connection.execute(text('ALTER TABLE vehicles DROP CONSTRAINT vehicles_pkey'))
+    connection.execute(text('ALTER TABLE vehicles ADD COLUMN key serial PRIMARY KEY'))
+    connection.execute(text(
+        'ALTER TABLE vehicles ALTER COLUMN id TYPE uuid USING id::uuid, '
+        'ADD CONSTRAINT vehicles_id_key UNIQUE (id), '
+        'ALTER COLUMN type TYPE smallint USING CASE type %s END' % ' '.join(
+            "WHEN '%s' THEN %d" % (vType, index) for index, vType in enumerate(types))))
+    for table in tables:
+        connection.execute(text(
+            'ALTER TABLE %s ALTER COLUMN vehicle_id TYPE uuid USING vehicle_id::uuid, '
+            'ADD FOREIGN KEY (vehicle_id) REFERENCES vehicles (id)' % table))
+
+    old = emissions.name + '_wide'
+    connection.execute(text('ALTER TABLE %s RENAME TO %s' % (emissions.name, old)))
+    connection.execute(text('ALTER INDEX %s_pkey RENAME TO %s_pkey' % (emissions.name, old)))
+    connection.execute(text('ALTER SEQUENCE %s_id_seq RENAME TO %s_id_seq' % (
+        emissions.name, old)))
+    emissions.create(connection)
+    copied = connection.execute(text(
+        'INSERT INTO %s (id, vehicle_key, latitude, longitude, timestamp, heading) '
+        'SELECT e.id, v.key, e.latitude, e.longitude, e.timestamp, e.heading '
+        'FROM %s e JOIN vehicles v ON v.id = e.vehicle_id::uuid' % (
+            emissions.name, old))).rowcount
+    connection.execute(text(
+        "SELECT setval('%s_id_seq', (SELECT coalesce(max(id), 0) + 1 FROM %s), false)" % (
+            emissions.name, emissions.name)))
+    connection.execute(text('DROP TABLE %s' % old))
+    return copied
+
+
+def table_sizes(connection, table):
+    """The sizes of a (PostgreSQL) table: its rows, the average size of a row
+    (as stored, with its header), and the bytes the table and its indexes take
+    up on disk, in all and per row (including page headers, line pointers and
+    free space)."""
+    rows, row_bytes = connection.execute(text(
+        'SELECT count(*), coalesce(avg(pg_column_size(t.*)), 0) FROM %s t' % table
+        )).fetchone()
+    table_bytes, index_bytes = connection.execute(text(
+        'SELECT pg_relation_size(:table), pg_indexes_size(:table)'),
+        dict(table=table)).fetchone()
+    return dict(rows=rows, row_bytes=round(float(row_bytes), 1),
+                table_bytes=table_bytes, index_bytes=index_bytes,
+                table_bytes_per_row=round(table_bytes / float(rows), 1) if rows else None,
+                index_bytes_per_row=round(index_bytes / float(rows), 1) if rows else None)
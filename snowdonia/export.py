@@ -0,0 +1,131 @@
+"""
+Export
+======
+
+Writers that turn a stream of emission rows into CSV, Parquet or Arrow (IPC
+stream) files chunk by chunk, so that exporting hundreds of millions of rows
+never holds more than one chunk (a Parquet row group) in memory.
+
+Every writer takes an iterable of row tuples, in the order of COLUMNS, and yields
+the bytes of the file as they're ready, so the same writers serve both the export
+endpoint (as a streamed response) and the export command (written to a file).
+
+Parquet and Arrow need pyarrow, which is optional:
+::
+    $ pip install pyarrow
+"""
+import csv
+import io
+from itertools import islice
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+COLUMNS = ('id', 'vehicle_id', 'type', 'latitude', 'longitude', 'heading',
+           'timestamp')
+"""Columns of an export, in order."""
+
+FORMATS = dict(csv='text/csv',
+               parquet='application/vnd.apache.parquet',
+               arrow='application/vnd.apache.arrow.stream')
+"""Export formats, with their content types."""
+
+
+def chunks(rows, size):
+    """Splits rows into lists of (at most) size rows."""
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def write_csv(rows, chunk_size=10000):
+    """Yields a CSV file (with a header) of the rows, chunk_size rows at a time.
+    Timestamps are written as YYYY-MM-DD hh:mm:ss."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(COLUMNS)
+    for chunk in chunks(rows, chunk_size):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def write_parquet(rows, chunk_size=100000):
+    """Yields a Parquet file of the rows, one row group of chunk_size rows at a
+    time."""
+    sink = _Sink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema())
+    for chunk in chunks(rows, chunk_size):
+        writer.write_table(_table(chunk))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+def write_arrow(rows, chunk_size=100000):
+    """Yields an Arrow IPC stream of the rows, one record batch of chunk_size
+    rows at a time."""
+    sink = _Sink()
+    writer = pyarrow.RecordBatchStreamWriter(sink, schema())
+    for chunk in chunks(rows, chunk_size):
+        writer.write_table(_table(chunk))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = dict(csv=write_csv, parquet=write_parquet, arrow=write_arrow)
+"""Writers, by format."""
+
+
+def available(format):
+    """Whether the format can be written (Parquet and Arrow need pyarrow)."""
+    return format == 'csv' or (format in WRITERS and pyarrow is not None)
+
+
+def schema():
+    """Arrow schema of an export."""
+    return pyarrow.schema([
+        ('id', pyarrow.int64()),
+        ('vehicle_id', pyarrow.string()),
+        ('type', pyarrow.string()),
+        ('latitude', pyarrow.float64()),
+        ('longitude', pyarrow.float64()),
+        ('heading', pyarrow.int16()),
+        ('timestamp', pyarrow.timestamp('s')),
+    ])
+
+
+def _table(chunk):
+    """Arrow table of a chunk of rows."""
+    table_schema = schema()
+    return pyarrow.Table.from_arrays(
+        [pyarrow.array(column, type=field.type)
+         for column, field in zip(zip(*chunk), table_schema)], schema=table_schema)
+
+
+class _Sink(io.RawIOBase):
+    """Write-only file that keeps what's written until it's drained."""
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
@@ -0,0 +1,178 @@
+"""
+Geometry
+========
+
+Where Snowdonia is, and how far points are from its center.
+
+valid_point() only needs to know whether a point is within snowdonia_radius of the
+center, and for most points that doesn't take Vincenty's formula. in_range()
+checks points in tiers, from cheapest to most expensive, and stops at the first
+tier that can answer:
+
+1. Bounding box: points whose latitude or longitude is further from the center's
+   than the border could ever be are out of range.
+2. Haversine: points whose (spherical) distance is further from the border than
+   the Haversine formula's error (see HAVERSINE_MARGIN) are in or out of range
+   without a doubt.
+3. Vincenty: points in the thin band around the border get the exact answer, the
+   same one distance_from_center(latitude, longitude) <= snowdonia_radius gives.
+"""
+from math import radians, sqrt, sin, cos, asin, atan, tan, pi, atan2
+
+snowdonia_center = (radians(53.068889), radians(-4.075556))
+"""(lat, long) radian co-ordinates for the town center. Fun fact: This points
+to the Snowdonia region in Wales."""
+snowdonia_radius = 50
+"""Snowdonia's radius in kms."""
+
+wgs84_a = 6378137 # earth radius at equator in m
+wgs84_b = 6356752.3142 # earth smallest radius in m
+wgs84_f = 1/298.257223563  # flattening of the Earth - all WGS-84 ellipsiod
+
+center_U2 = atan((1 - wgs84_f) * tan(snowdonia_center[0]))
+"""Reduced latitude of the center (and its sin/cos below), used by Vincenty."""
+center_sin_U2 = sin(center_U2)
+center_cos_U2 = cos(center_U2)
+center_cos_lat = cos(snowdonia_center[0])
+
+HAVERSINE_RADIUS = 6371.0088
+"""Mean radius of the Earth in kms, used by the Haversine formula."""
+HAVERSINE_MARGIN = 0.01
+"""Relative error allowed for the Haversine formula: points whose Haversine
+distance is within 1% of the border are checked with Vincenty. Its worst-case
+error on the Earth is 0.55%."""
+
+max_lat_offset = radians(snowdonia_radius / 110.5 * 1.1)
+"""Latitude difference (in radians) beyond which a point can't be in range: no
+degree of latitude is shorter than 110.5 km (plus a 10% margin)."""
+max_long_offset = max_lat_offset / cos(snowdonia_center[0] + max_lat_offset) * 1.5
+"""Longitude difference (in radians) beyond which a point can't be in range: a
+degree of longitude is shortest at the far edge of the latitude band (plus a 50%
+margin, since geodesics bend towards the pole)."""
+
+on_vincenty = None
+"""If set, called with the number of iterations every time Vincenty's formula
+converges (see snowdonia.metrics)."""
+
+
+def distance_from_center(latitude, longitude): 
+    """Calculates the distance between the provided point and the town center
+    by using Vincenty's formula that calculates the distance between
+    two points on a spheroid, given:
+
+    - Radius of the Earth (min and max) as well as its flattening.
+    - Latitude and longitude of both the point & the center in radians.
+
+    Even though there exists the Haversine formula that calculates the distance
+    between two points on a sphere, and it is less computationally expensive
+    than Vincenty (no iterations), the Haversine formula, when calculating distances
+    on the Earth, can have an error up to 0.55%, though generally below 0.3%, 
+    so Vincenty provides greater accuracy that is actually needed in this situation,
+    where exactly where vehicles were is valuable data. (in_range() does use the
+    Haversine formula, but only to skip Vincenty for points that are far enough
+    from the border for its error not to matter.)
+
+    The center's part of the formula is the same for every point, so it's
+    precomputed once (see center_U2 and co).
+
+    Returns None if the formula fails to converge (nearly antipodal points).
+
+    More on how Vincenty's formula works:
+    https://en.wikipedia.org/wiki/Vincenty's_formulae
+    """
+    U1 = atan((1 - wgs84_f) * tan(radians(latitude)))
+    return vincenty(radians(longitude) - snowdonia_center[1],
+                    sin(U1), cos(U1), center_sin_U2, center_cos_U2)
+
+
+def distance_between(lat1, long1, lat2, long2):
+    """Calculates the distance (in kms) between two points, given in degrees,
+    using Vincenty's formula like distance_from_center() does. Returns None if
+    the formula fails to converge."""
+    U1 = atan((1 - wgs84_f) * tan(radians(lat1)))
+    U2 = atan((1 - wgs84_f) * tan(radians(lat2)))
+    return vincenty(radians(long1) - radians(long2),
+                    sin(U1), cos(U1), sin(U2), cos(U2))
+
+
+def vincenty(L, sin_U1, cos_U1, sin_U2, cos_U2):
+    """Vincenty's inverse formula, given the difference in longitude (L, in
+    radians) and the sin/cos of the reduced latitudes (U1, U2) of two points.
+    Returns their distance in kms, or None if it fails to converge."""
+    a, b, f = wgs84_a, wgs84_b, wgs84_f
+    lambda1 = L
+    lambdaP = 2*pi
+    iter_limit = 20
+
+    while abs(lambda1 - lambdaP) > 1e-12 and iter_limit > 0:
+        sin_lambda1 = sin(lambda1)
+        cos_lambda1 = cos(lambda1)
+        sin_sigma = sqrt((cos_U2 * sin_lambda1) * (cos_U2 * sin_lambda1) +\
+                    (cos_U1 * sin_U2 - sin_U1 * cos_U2 * cos_lambda1) *\
+                    (cos_U1 * sin_U2 - sin_U1 *cos_U2 * cos_lambda1))
+        if sin_sigma == 0:
+            return 0
+        cos_sigma = sin_U1 * sin_U2 + cos_U1 * cos_U2 * cos_lambda1
+        sigma = atan2(sin_sigma, cos_sigma)
+        sin_alpha = cos_U1 * cos_U2 * sin_lambda1 / sin_sigma
+        cos2_alpha = 1 - sin_alpha * sin_alpha
+        cos2_sigma_m = cos_sigma - 2 * sin_U1 * sin_U2 / cos2_alpha \
+                    if cos2_alpha != 0 else 0
+        C = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+        lambdaP = lambda1
+        lambda1 = L + (1 - C) * f * sin_alpha *\
+                (sigma +\
+                 C * sin_sigma *\
+                 (cos2_sigma_m + C * cos_sigma *\
+                 (-1 + 2 * cos2_sigma_m * cos2_sigma_m))\
+                )
+        iter_limit -= 1
+
+    if iter_limit==0:
+        return None # failed to converge
+    if on_vincenty is not None:
+        on_vincenty(20 - iter_limit)
+
+    u_2 = cos2_alpha * (a * a - b * b) / (b * b)
+    A = 1 + u_2 / 16384 *(4096 + u_2 * (-768 + u_2 * (320 - 175 * u_2)))
+    B = u_2 / 1024 * (256 + u_2 * (-128 + u_2 * (74 - 47 * u_2)))
+    delta_sigma = B * sin_sigma * (cos2_sigma_m + B / 4 *\
+                                  (cos_sigma * (-1 + 2 *\
+                                   cos2_sigma_m*cos2_sigma_m)-\
+                                   B / 6 * cos2_sigma_m *\
+                                   (-3 + 4 * sin_sigma * sin_sigma) *\
+                                   (-3+4*cos2_sigma_m*cos2_sigma_m))\
+                                  )
+    s = b*A*(sigma-delta_sigma)
+    return s/1000
+
+
+def haversine_from_center(latitude, longitude):
+    """Calculates the distance (in kms) between the provided point and the town
+    center on a sphere, using the Haversine formula. Cheap, but only accurate to
+    about 0.5%, see distance_from_center."""
+    lat_rad, long_rad = radians(latitude), radians(longitude)
+    sin_dlat = sin((lat_rad - snowdonia_center[0]) / 2)
+    sin_dlong = sin((long_rad - snowdonia_center[1]) / 2)
+    h = sin_dlat * sin_dlat + center_cos_lat * cos(lat_rad) * sin_dlong * sin_dlong
+    return 2 * HAVERSINE_RADIUS * asin(min(1, sqrt(h)))
+
+
+def in_range(latitude, longitude):
+    """Determins if distance from center is <= 50, Snowdonia's radius in kms.
+
+    Same result as distance_from_center(latitude, longitude) <= snowdonia_radius,
+    but only points close to the border pay for Vincenty's formula. See the
+    module's docs for the tiers.
+    """
+    lat_rad, long_rad = radians(latitude), radians(longitude)
+    if abs(lat_rad - snowdonia_center[0]) > max_lat_offset or \
+       abs(long_rad - snowdonia_center[1]) > max_long_offset:
+        return False
+    distance = haversine_from_center(latitude, longitude)
+    if distance <= snowdonia_radius * (1 - HAVERSINE_MARGIN):
+        return True
+    if distance >= snowdonia_radius * (1 + HAVERSINE_MARGIN):
+        return False
+    distance = distance_from_center(latitude, longitude)
+    return distance is not None and distance <= snowdonia_radius
@@ -0,0 +1,111 @@
+"""
+Heatmap
+=======
+
+Where the vehicles go, as the number of emissions in every cell of a grid, per
+time bucket (HEATMAP_BUCKET seconds, an hour by default), served as map tiles
+that dashboards can lay over a map:
+::
+    /api/v1/heatmap/<ZOOM>/<X>/<Y>?from=<TIMESTAMP>&to=<TIMESTAMP>
+
+Tiles are the usual web map tiles: at zoom z, the Web Mercator projection of the
+world is split into 2^z by 2^z tiles. Every tile is split into CELLS by CELLS
+cells, which are the tiles of zoom z + CELL_BITS, so the cells of a zoom are
+counted once and serve every tile of that zoom. Over Snowdonia, a tile is about
+90 km wide at zoom 8 and 1.4 km wide at zoom 14 (where a cell is about 45 m
+wide).
+
+Counts are kept incrementally, with HEATMAP on (it's off by default, see
+config.py): every worker counts the emissions it registers, once they're
+committed, for every zoom from HEATMAP_MIN_ZOOM to HEATMAP_MAX_ZOOM, in a
+HeatmapCounter, and a background thread adds its counts up to heat_cells (with
+one multi-row upsert on PostgreSQL) every HEATMAP_FLUSH_INTERVAL seconds, and
+when it shuts down. So a tile is at most that many seconds behind, and
+registering an emission only costs a few dict updates. A worker that is killed
+loses the counts it hadn't added yet, which the heatmap command rebuilds from
+the emissions:
+::
+    $ FLASK_APP=snowdonia flask heatmap --from "01-12-2016 00:00:00"
+
+Rendered tiles are cached by every worker (at most HEATMAP_CACHE_SIZE of them)
+for HEATMAP_CACHE_TTL seconds, or until evicted if their time window ended
+more than CLOSED_AFTER ago, and served with an ETag, so that a dashboard that
+reloads a tile it already has gets a 304 without the database being queried.
+"""
+import threading
+from datetime import datetime, timedelta
+from math import radians, log, tan, cos, pi
+
+CELL_BITS = 5
+CELLS = 1 << CELL_BITS
+"""Cells along either side of a tile."""
+CLOSED_AFTER = timedelta(days=1)
+"""How long after the end of a time window emissions are no longer expected for
+it (so that its tiles can be cached until they're evicted)."""
+EPOCH = datetime(1970, 1, 1)
+
+
+def tile_of(latitude, longitude, zoom):
+    """(x, y) of the tile of the zoom that the point is in."""
+    n = 1 << zoom
+    latitude = radians(max(-85.0511, min(85.0511, latitude)))
+    x = int((longitude + 180.0) / 360.0 * n)
+    y = int((1.0 - log(tan(latitude) + 1 / cos(latitude)) / pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def bucket_of(timestamp, seconds):
+    """The start of the time bucket (of the given length) that timestamp is in."""
+    offset = (timestamp - EPOCH).total_seconds()
+    return EPOCH + timedelta(seconds=offset - offset % seconds)
+
+
+def tile_bounds(zoom, x, y):
+    """The (first x, first y, last x, last y) of the cells of a tile, as tiles of
+    zoom + CELL_BITS."""
+    return (x << CELL_BITS, y << CELL_BITS,
+            ((x + 1) << CELL_BITS) - 1, ((y + 1) << CELL_BITS) - 1)
+
+
+def valid_tile(zoom, x, y, min_zoom, max_zoom):
+    """Checks that the tile exists, at a zoom that is counted."""
+    return min_zoom <= zoom <= max_zoom and 0 <= x < 1 << zoom and 0 <= y < 1 << zoom
+
+
+class HeatmapCounter(object):
+    """Thread-safe counts of emissions by (level, x, y, bucket), where level is
+    the zoom of the cells (zoom + CELL_BITS) and bucket the start of the time
+    bucket, for every zoom from min_zoom to max_zoom."""
+    def __init__(self, min_zoom=8, max_zoom=14, bucket=3600):
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.bucket = bucket
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def add(self, latitude, longitude, timestamp, count=1):
+        """Counts an emission in its cells (one per zoom)."""
+        top = self.max_zoom + CELL_BITS
+        x, y = tile_of(latitude, longitude, top)
+        bucket = bucket_of(timestamp, self.bucket)
+        with self._lock:
+            for zoom in range(self.min_zoom, self.max_zoom + 1):
+                shift = self.max_zoom - zoom
+                key = (zoom + CELL_BITS, x >> shift, y >> shift, bucket)
+                self._counts[key] = self._counts.get(key, 0) + count
+
+    def drain(self):
+        """Returns the counts, and starts counting from zero."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        return counts
+
+    def merge(self, counts):
+        """Adds counts (as returned by drain(), e.g. that couldn't be written)
+        back."""
+        with self._lock:
+            for key, count in counts.items():
+                self._counts[key] = self._counts.get(key, 0) + count
+
+    def __len__(self):
+        return len(self._counts)
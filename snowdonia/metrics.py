@@ -0,0 +1,264 @@
+"""
+Metrics
+=======
+
+With METRICS on (see config.py), the hot path of the API is timed stage by stage,
+and the metrics below are served in the Prometheus text format on /metrics:
+
+- snowdonia_stage_seconds{stage}: histogram of the time spent in every stage of
+  registering an emission: decode (reading the request's body), parse (reading
+  its fields), geofence (valid_point()), vehicle (looking up, and registering, the
+  vehicle) and write (the INSERT and commit, or queueing it when writing behind).
+  Batches are timed as a whole, in the batch_decode, batch_lookup,
+  batch_validate and batch_write stages.
+- snowdonia_emissions_total{result}: emissions by result (success, duplicate,
+  invalid_coordinates, invalid_vehicle, invalid_values, exited, unavailable,
+  error).
+- snowdonia_vincenty_iterations: histogram of the iterations Vincenty's formula
+  took to converge.
+- snowdonia_db_pool_*{pid}, snowdonia_buffer_*{pid} and
+  snowdonia_admission_*{pid}: the database connection pool, the write-behind
+  buffer and the admission control (see snowdonia.admission) of every worker.
+- snowdonia_startup_seconds{pid}: the time every worker took to create (and warm
+  up) its app.
+
+With METRICS off, nothing is recorded, and timing a stage costs a method call
+(a few hundred nanoseconds per stage).
+
+Every (gunicorn) worker process records its own metrics. With METRICS_DIR set to
+a directory the workers share (e.g. /tmp/snowdonia-metrics, emptied before
+starting the app), every worker writes its metrics to a file of its own there
+at most every METRICS_FLUSH_INTERVAL seconds, and /metrics adds up the metrics
+of all the workers, whichever worker serves it. Without METRICS_DIR, /metrics
+only shows the metrics of the worker that serves it.
+"""
+import atexit
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+STAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+"""Upper bounds (in seconds) of the buckets of the stage histograms."""
+ITERATION_BUCKETS = (1, 2, 3, 4, 5, 6, 8, 10, 15, 20)
+"""Upper bounds of the buckets of the Vincenty iterations histogram."""
+
+
+class Metrics(object):
+    """Counters and histograms of one worker process, identified by name and
+    labels (keyword arguments), plus gauges read from collectors when the
+    metrics are rendered (or written to METRICS_DIR).
+
+    - counter(name, help) and histogram(name, help, buckets) declare metrics.
+    - inc(name, value, **labels) and observe(name, value, **labels) record.
+    - stage(name) times a with block into snowdonia_stage_seconds.
+    - render() returns the Prometheus text of all the workers' metrics.
+    """
+    def __init__(self, enabled=False, directory=None, flush_interval=5):
+        self.enabled = enabled
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.collectors = []
+        self._help = {}
+        self._types = {}
+        self._buckets = {}
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._flushed = 0
+        self.histogram('snowdonia_stage_seconds',
+                       'Time spent in every stage of registering emissions.',
+                       STAGE_BUCKETS)
+        if enabled and directory:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            atexit.register(self.flush, final=True)
+            if hasattr(os, 'register_at_fork'):
+                os.register_at_fork(after_in_child=self.reset)
+
+    def counter(self, name, help):
+        """Declares a counter."""
+        self._help[name], self._types[name] = help, 'counter'
+
+    def gauge(self, name, help):
+        """Declares a gauge (whose values come from collectors)."""
+        self._help[name], self._types[name] = help, 'gauge'
+
+    def histogram(self, name, help, buckets):
+        """Declares a histogram with the given bucket upper bounds."""
+        self._help[name], self._types[name] = help, 'histogram'
+        self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        """Adds value to the counter."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+        self._maybe_flush()
+
+    def observe(self, name, value, **labels):
+        """Records value in the histogram."""
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        bucket = bisect_left(self._buckets[name], value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                # Count of every bucket (and +Inf), then the sum
+                histogram = self._histograms[key] = \
+                    [0] * (len(self._buckets[name]) + 1) + [0.0]
+            histogram[bucket] += 1
+            histogram[-1] += value
+        self._maybe_flush()
+
+    def stage(self, name):
+        """Context manager that times its block as the stage name."""
+        if not self.enabled:
+            return _NOT_TIMED
+        return _Timer(self, name)
+
+    def reset(self):
+        """Forgets everything recorded (e.g. by the parent of a forked worker)."""
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self._flushed = 0
+
+    def flush(self, final=False):
+        """Writes the metrics of this worker to its file in the directory. The
+        final flush (on exit) leaves the worker's gauges out. Metrics are never
+        worth failing a request for, so errors writing the file are ignored."""
+        if not self.directory:
+            return
+        self._flushed = time.time()
+        state = self._state(gauges=not final)
+        path = os.path.join(self.directory, '%d.json' % os.getpid())
+        try:
+            with open(path + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError):
+            pass
+
+    def render(self):
+        """The metrics of all the workers, in the Prometheus text format."""
+        counters, histograms, gauges = {}, {}, []
+        for state in self._states():
+            for name, labels, value in state['counters']:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, values in state['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.get(key)
+                histograms[key] = values if total is None else \
+                    [a + b for a, b in zip(total, values)]
+            gauges.extend(state['gauges'])
+        lines, declared = [], set()
+        for key, value in sorted(counters.items()):
+            self._declare(lines, declared, key[0])
+            lines.append('%s%s %s' % (key[0], _labels(key[1]), value))
+        for key, values in sorted(histograms.items()):
+            name, labels = key
+            self._declare(lines, declared, name)
+            cumulative = 0
+            for bound, count in zip(self._buckets[name] + ('+Inf',), values):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    name, _labels(labels + (('le', str(bound)),)), cumulative))
+            lines.append('%s_sum%s %r' % (name, _labels(labels), values[-1]))
+            lines.append('%s_count%s %d' % (name, _labels(labels), cumulative))
+        for name, labels, value in sorted(gauges, key=lambda g: (g[0], g[1])):
+            self._declare(lines, declared, name)
+            lines.append('%s%s %s' % (name, _labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def _declare(self, lines, declared, name):
+        if name not in declared:
+            declared.add(name)
+            lines.append('# HELP %s %s' % (name, self._help.get(name, name)))
+            lines.append('# TYPE %s %s' % (name, self._types.get(name, 'untyped')))
+
+    def _maybe_flush(self):
+        if self.directory and time.time() - self._flushed >= self.flush_interval:
+            self.flush()
+
+    def _state(self, gauges=True):
+        """The metrics of this worker, as written to its file."""
+        with self._lock:
+            state = dict(
+                counters=[(name, labels, value) for (name, labels), value
+                          in self._counters.items()],
+                histograms=[(name, labels, list(values)) for (name, labels), values
+                            in self._histograms.items()],
+                gauges=[])
+        if gauges:
+            pid = str(os.getpid())
+            for collect in self.collectors:
+                try:
+                    state['gauges'].extend(
+                        (name, [['pid', pid]] + sorted(labels.items()), value)
+                        for name, labels, value in collect())
+                except Exception:
+                    continue
+        return json.loads(json.dumps(state)) # labels as lists, like in files
+
+    def _states(self):
+        """The metrics of this worker, and those of the others in the directory."""
+        states = [self._state()]
+        if not self.directory:
+            return states
+        own = '%d.json' % os.getpid()
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return states
+        for filename in filenames:
+            if filename.endswith('.json') and filename != own:
+                try:
+                    with open(os.path.join(self.directory, filename)) as f:
+                        states.append(json.load(f))
+                except (IOError, ValueError):
+                    continue # being replaced, or not one of ours
+        return states
+
+
+class _Timer(object):
+    """Times a with block into the snowdonia_stage_seconds histogram."""
+    __slots__ = ('metrics', 'name', 'started')
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.metrics.observe('snowdonia_stage_seconds',
+                             time.perf_counter() - self.started, stage=self.name)
+
+
+class _NotTimed(object):
+    """Does nothing, for stages timed while metrics are off."""
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NOT_TIMED = _NotTimed()
+
+
+def _labels(labels):
+    """Prometheus text of a sequence of (label, value) pairs."""
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (label, str(value).replace('\\', '\\\\')
+                                                    .replace('"', '\\"'))
+                             for label, value in labels)
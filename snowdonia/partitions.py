@@ -0,0 +1,133 @@
+"""
+Partitions
+==========
+
+With EMISSIONS_PARTITION set to 'day' or 'week' (see config.py), the emissions
+table is created (by db.create_all()) as a PostgreSQL table partitioned by range
+of timestamp, with one partition per day/week:
+
+- Every partition is named after the day it starts on, e.g. emissions_p20161222.
+- The composite (vehicle_id, timestamp) index is created on the partitioned table,
+  so PostgreSQL creates it on every partition, including future ones.
+- A default partition (emissions_default) catches emissions whose timestamp has
+  no partition (e.g. emitters whose clocks are way off). When a partition is
+  created for a range the default partition already has emissions in, they're
+  moved to the new partition.
+- Queries filtering on timestamp only scan the partitions they need.
+
+Upcoming partitions have to exist before emissions for them arrive, so the
+maintenance command should run (at least) daily, e.g. from cron or Heroku's
+scheduler:
+::
+    $ FLASK_APP=snowdonia flask partitions
+
+It creates the next EMISSIONS_PARTITIONS_AHEAD partitions, and, if
+EMISSIONS_RETENTION_DAYS is set, drops the partitions that only hold emissions
+older than that: dropping a whole partition is instant, and leaves no dead rows
+to vacuum like a DELETE does. The (few) emissions older than that in the default
+partition are deleted.
+
+Please note that PostgreSQL 11 or later is needed, and that partitioning only
+applies to tables created by db.create_all(): an existing emissions table has to
+be migrated by hand (e.g. renamed, re-created, and attached as a partition).
+"""
+from datetime import datetime, timedelta
+
+from sqlalchemy import text
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.schema import CreateTable
+
+INTERVALS = dict(day=timedelta(days=1), week=timedelta(weeks=1))
+"""The partition intervals supported, by the name used in EMISSIONS_PARTITION."""
+
+
+@compiles(CreateTable, 'postgresql')
+def _create_table(element, compiler, **kw):
+    """Adds the PARTITION BY clause of tables that have one in their info."""
+    sql = compiler.visit_create_table(element, **kw)
+    partition_by = element.element.info.get('partition_by')
+    if partition_by:
+        sql = sql.rstrip() + ' PARTITION BY %s\n\n' % partition_by
+    return sql
+
+
+def partition_bounds(timestamp, interval):
+    """The (start, end) of the day/week partition that timestamp falls in.
+    Weeks start on Mondays."""
+    start = datetime(timestamp.year, timestamp.month, timestamp.day)
+    if interval == 'week':
+        start -= timedelta(days=start.weekday())
+    return start, start + INTERVALS[interval]
+
+
+def partition_name(table, start):
+    """Name of the partition of table that starts at start."""
+    return '%s_p%s' % (table, start.strftime('%Y%m%d'))
+
+
+def create_partitions(connection, table, interval, ahead, now=None):
+    """Creates the partitions of table for the current day/week and the next
+    ahead ones, as well as the default partition, unless they already exist.
+    Returns the names of the partitions."""
+    start, end = partition_bounds(now or datetime.utcnow(), interval)
+    connection.execute(text('CREATE TABLE IF NOT EXISTS %s_default '
+                            'PARTITION OF %s DEFAULT' % (table, table)))
+    existing = set(list_partitions(connection, table))
+    names = []
+    for _ in range(ahead + 1):
+        name = partition_name(table, start)
+        if name not in existing:
+            create_partition(connection, table, name, start, end)
+        names.append(name)
+        start, end = end, end + INTERVALS[interval]
+    return names
+
+
+def create_partition(connection, table, name, start, end):
+    """Creates the partition of table from start to end. PostgreSQL refuses to
+    create it if the default partition has rows in its range, so then the
+    default partition is detached, the partition created, the rows moved to
+    it, and the default partition attached again, in the connection's
+    transaction."""
+    default = '%s_default' % table
+    in_range = dict(start=start, end=end)
+    where = 'WHERE timestamp >= :start AND timestamp < :end'
+    create = text("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s "
+                  "FOR VALUES FROM ('%s') TO ('%s')" % (name, table, start, end))
+    if connection.execute(text('SELECT 1 FROM %s %s LIMIT 1' % (default, where)),
+                          in_range).first() is None:
+        connection.execute(create)
+        return
+    connection.execute(text('ALTER TABLE %s DETACH PARTITION %s' % (table, default)))
+    connection.execute(create)
+    connection.execute(text('INSERT INTO %s SELECT * FROM %s %s' % (name, default, where)),
+                       in_range)
+    connection.execute(text('DELETE FROM %s %s' % (default, where)), in_range)
+    connection.execute(text('ALTER TABLE %s ATTACH PARTITION %s DEFAULT' % (table, default)))
+
+
+def list_partitions(connection, table):
+    """Names of the day/week partitions of table (not the default one)."""
+    rows = connection.execute(text(
+        'SELECT child.relname FROM pg_inherits '
+        'JOIN pg_class child ON child.oid = pg_inherits.inhrelid '
+        'JOIN pg_class parent ON parent.oid = pg_inherits.inhparent '
+        'WHERE parent.relname = :table ORDER BY child.relname'), dict(table=table))
+    prefix = table + '_p'
+    return [row[0] for row in rows if row[0].startswith(prefix)]
+
+
+def drop_partitions(connection, table, interval, retention_days, now=None):
+    """Drops the partitions of table whose emissions are all older than
+    retention_days, and deletes the emissions older than that from the default
+    partition. Returns the names of the dropped partitions."""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    connection.execute(text('DELETE FROM %s_default WHERE timestamp < :cutoff' % table),
+                       dict(cutoff=cutoff))
+    dropped = []
+    for name in list_partitions(connection, table):
+        start = datetime.strptime(name[len(table) + 2:], '%Y%m%d')
+        if start + INTERVALS[interval] <= cutoff:
+            connection.execute(text('DROP TABLE %s' % name))
+            dropped.append(name)
+    return dropped
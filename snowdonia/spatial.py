@@ -0,0 +1,183 @@
+"""
+Spatial Index
+=============
+
+In-memory index of the current positions of vehicles, for "which vehicles are
+within 500m of this stop" queries at interactive latency.
+
+Positions are bucketed in a uniform grid of cells of (roughly) cell_size x
+cell_size kms. A query only looks at the cells that overlap the bounding box of
+its circle (or, for the k nearest vehicles, at rings of cells around the query
+point, until no unvisited cell can hold anything closer), and only the vehicles
+in those cells have their exact distance calculated with Vincenty's formula.
+
+Cells are laid out in degrees, with their width in degrees of longitude set so
+that they're cell_size kms wide at the town center. Cells far from the center's
+latitude are a bit narrower or wider than that, which queries account for.
+"""
+import threading
+from math import radians, cos, floor
+
+from .geo import snowdonia_center, distance_between
+
+KM_PER_DEGREE_LAT = 110.574
+"""Length of a degree of latitude in kms (at the equator, where it's shortest)."""
+KM_PER_DEGREE_LONG = 111.320
+"""Length of a degree of longitude in kms, at the equator."""
+
+
+class GridIndex(object):
+    """Thread-safe grid index of points, each with a key (e.g. a vehicle id) and
+    an optional value (e.g. the vehicle's type), that can be moved around.
+
+    - update(key, latitude, longitude, value) adds or moves a point.
+    - within(latitude, longitude, radius) finds the points within radius kms.
+    - nearest(latitude, longitude, k) finds the k nearest points.
+    """
+    def __init__(self, cell_size=1.0):
+        self.cell_size = cell_size
+        lat_center = snowdonia_center[0]
+        self.cell_lat = cell_size / KM_PER_DEGREE_LAT
+        self.cell_long = cell_size / (KM_PER_DEGREE_LONG * cos(lat_center))
+        self._points = {}
+        self._cells = {}
+        self._bounds = None # (top, left, bottom, right) of the cells ever used
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._points)
+
+    def __contains__(self, key):
+        return key in self._points
+
+    def cell(self, latitude, longitude):
+        """The (row, column) of the cell the point falls in."""
+        return (int(floor(latitude / self.cell_lat)),
+                int(floor(longitude / self.cell_long)))
+
+    def update(self, key, latitude, longitude, value=None):
+        """Adds the point, or moves it if it's already there."""
+        cell = self.cell(latitude, longitude)
+        with self._lock:
+            old = self._points.get(key)
+            if old is not None and old[3] != cell:
+                self._remove_from_cell(key, old[3])
+            self._points[key] = (latitude, longitude, value, cell)
+            self._cells.setdefault(cell, set()).add(key)
+            if self._bounds is None:
+                self._bounds = cell + cell
+            else:
+                top, left, bottom, right = self._bounds
+                self._bounds = (min(top, cell[0]), min(left, cell[1]),
+                                max(bottom, cell[0]), max(right, cell[1]))
+
+    def remove(self, key):
+        """Removes the point, if it's there."""
+        with self._lock:
+            old = self._points.pop(key, None)
+            if old is not None:
+                self._remove_from_cell(key, old[3])
+
+    def clear(self):
+        """Removes all the points."""
+        with self._lock:
+            self._points.clear()
+            self._cells.clear()
+            self._bounds = None
+
+    def get(self, key):
+        """The (latitude, longitude, value) of the point, or None."""
+        point = self._points.get(key)
+        return point[:3] if point is not None else None
+
+    def within(self, latitude, longitude, radius, where=None):
+        """The points within radius kms of the given point, as a list of (key,
+        distance, value) sorted by distance. Only points whose value passes
+        where(value) are included, if where is given."""
+        lat_offset = radius / KM_PER_DEGREE_LAT * 1.1
+        long_offset = radius / (KM_PER_DEGREE_LONG *
+                                cos(radians(min(abs(latitude) + lat_offset, 89))))
+        long_offset *= 1.1
+        top, left = self.cell(latitude - lat_offset, longitude - long_offset)
+        bottom, right = self.cell(latitude + lat_offset, longitude + long_offset)
+        with self._lock:
+            if self._bounds is None:
+                return []
+            # No need to look at cells beyond the ones ever used
+            top, left = max(top, self._bounds[0]), max(left, self._bounds[1])
+            bottom, right = min(bottom, self._bounds[2]), min(right, self._bounds[3])
+            candidates = [(key, self._points[key]) for row in range(top, bottom + 1)
+                          for column in range(left, right + 1)
+                          for key in self._cells.get((row, column), ())]
+        found = []
+        for key, (lat, long, value, _) in candidates:
+            if where is not None and not where(value):
+                continue
+            distance = distance_between(latitude, longitude, lat, long)
+            if distance is not None and distance <= radius:
+                found.append((key, distance, value))
+        return sorted(found, key=lambda point: point[1])
+
+    def nearest(self, latitude, longitude, k, where=None):
+        """The k points nearest to the given point, as a list of (key, distance,
+        value) sorted by distance. Only points whose value passes where(value)
+        are included, if where is given."""
+        row, column = self.cell(latitude, longitude)
+        # The narrowest a cell can be around here (with a 10% margin)
+        min_cell = 0.9 * min(self.cell_lat * KM_PER_DEGREE_LAT,
+                             self.cell_long * KM_PER_DEGREE_LONG *
+                             cos(radians(min(abs(latitude) + 1, 89))))
+        with self._lock:
+            if self._bounds is None:
+                return []
+            bounds = self._bounds
+        top, left, bottom, right = bounds
+        # Rings closer than the cells ever used are empty, and so are the parts
+        # of the next ones beyond them
+        first_ring = max(0, top - row, row - bottom, left - column, column - right)
+        last_ring = max(row - top, bottom - row, column - left, right - column)
+        found = []
+        for ring in range(first_ring, last_ring + 1):
+            with self._lock:
+                points = [(key, self._points[key])
+                          for r, c in _ring(row, column, ring, bounds)
+                          for key in self._cells.get((r, c), ())]
+            for key, (lat, long, value, _) in points:
+                if where is not None and not where(value):
+                    continue
+                distance = distance_between(latitude, longitude, lat, long)
+                if distance is not None:
+                    found.append((key, distance, value))
+            found.sort(key=lambda point: point[1])
+            del found[k:]
+            # Anything in the next rings is at least ring * min_cell kms away
+            if len(found) == k and found[-1][1] <= ring * min_cell:
+                break
+        return found
+
+    def _remove_from_cell(self, key, cell):
+        keys = self._cells.get(cell)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._cells[cell]
+
+
+def _ring(row, column, ring, bounds):
+    """The cells at (Chebyshev) distance ring from (row, column) that are within
+    bounds, as (top, left, bottom, right)."""
+    top, left, bottom, right = bounds
+    if ring == 0:
+        if top <= row <= bottom and left <= column <= right:
+            yield row, column
+        return
+    columns = range(max(column - ring, left), min(column + ring, right) + 1)
+    for r in (row - ring, row + ring):
+        if top <= r <= bottom:
+            for c in columns:
+                yield r, c
+    rows = range(max(row - ring + 1, top), min(row + ring - 1, bottom) + 1)
+    for c in (column - ring, column + ring):
+        if left <= c <= right:
+            for r in rows:
+                yield r, c
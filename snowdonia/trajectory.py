@@ -0,0 +1,203 @@
+"""
+Trajectory Compression
+======================
+
+Vehicles emit every 20 seconds, and most of their emissions are on straight runs
+where the next point could have been predicted from the last ones. With
+TRAJECTORY_COMPRESSION set (see config.py), the compress command drops those
+emissions once their stretch of the trajectory is closed (older than
+TRAJECTORY_COMPRESSION_AFTER seconds), keeping only the points needed to
+reconstruct every dropped one within TRAJECTORY_TOLERANCE meters:
+::
+    $ FLASK_APP=snowdonia flask compress
+
+Trajectories are compressed in segments, split wherever a vehicle went silent
+for more than TRAJECTORY_MAX_GAP seconds. The first and last points of every
+segment are always kept, and so are the points in between that either method
+can't predict within the tolerance:
+
+- dead_reckoning: a point is dropped if it's within the tolerance of where the
+  vehicle was expected to be, had it kept going from the last kept point along
+  that point's heading, at the speed it took between the last two kept points.
+- douglas_peucker: a point is dropped if it's within the tolerance of where the
+  vehicle was at its timestamp on the straight line between the kept points
+  around it, moving at a constant speed (the time-synchronized flavour of the
+  Douglas-Peucker algorithm, so the bound holds at every timestamp, not just
+  along the path).
+
+Either way, reconstructing a dropped point means doing the same prediction (see
+position()), so every emission that was dropped can be reconstructed within the
+tolerance. Distances are measured on a flat approximation of the Earth around
+the points (see offset()), which is accurate to well below a meter at the
+distances vehicles travel in between two emissions.
+
+Points are (timestamp, latitude, longitude, heading) tuples, sorted by timestamp.
+"""
+from datetime import timedelta
+from math import radians, degrees, sqrt, sin, cos
+
+from .geo import HAVERSINE_RADIUS
+
+METHODS = ('dead_reckoning', 'douglas_peucker')
+"""The compression methods, by the name used in TRAJECTORY_COMPRESSION."""
+EARTH_RADIUS = HAVERSINE_RADIUS * 1000
+"""Mean radius of the Earth in meters."""
+
+
+def offset(lat1, long1, lat2, long2):
+    """Distance in meters between two nearby points, on an equirectangular
+    projection centered between them."""
+    x = radians(long2 - long1) * cos(radians(lat1 + lat2) / 2)
+    y = radians(lat2 - lat1)
+    return sqrt(x * x + y * y) * EARTH_RADIUS
+
+
+def dead_reckon(previous, anchor, timestamp):
+    """The (latitude, longitude) the vehicle is expected at, at timestamp, had it
+    left the anchor point along its heading at the speed it took to get there
+    from the previous point. Without a previous point, the vehicle is expected
+    to stand still."""
+    _, latitude, longitude, heading = anchor
+    if previous is None or previous[0] >= anchor[0]:
+        return latitude, longitude
+    speed = offset(previous[1], previous[2], latitude, longitude) / \
+            (anchor[0] - previous[0]).total_seconds()
+    distance = speed * (timestamp - anchor[0]).total_seconds() / EARTH_RADIUS
+    heading = radians(heading)
+    return (latitude + degrees(distance * cos(heading)),
+            longitude + degrees(distance * sin(heading) / cos(radians(latitude))))
+
+
+def interpolate(start, end, timestamp):
+    """The (latitude, longitude) the vehicle was at, at timestamp, had it gone
+    from the start point to the end point in a straight line at a constant
+    speed."""
+    duration = (end[0] - start[0]).total_seconds()
+    fraction = (timestamp - start[0]).total_seconds() / duration if duration else 0
+    return (start[1] + (end[1] - start[1]) * fraction,
+            start[2] + (end[2] - start[2]) * fraction)
+
+
+def position(kept, index, timestamp, method):
+    """The reconstructed (latitude, longitude) at timestamp, which is in between
+    the kept points kept[index] and kept[index + 1] of a segment."""
+    if method == 'dead_reckoning':
+        return dead_reckon(kept[index - 1] if index > 0 else None, kept[index],
+                           timestamp)
+    return interpolate(kept[index], kept[index + 1], timestamp)
+
+
+def split(points, max_gap):
+    """Splits the points into segments wherever more than max_gap seconds pass
+    between two of them."""
+    segments, segment = [], []
+    for point in points:
+        if segment and (point[0] - segment[-1][0]).total_seconds() > max_gap:
+            segments.append(segment)
+            segment = []
+        segment.append(point)
+    if segment:
+        segments.append(segment)
+    return segments
+
+
+def compress(points, tolerance, method):
+    """The points of a segment that have to be kept for the method to
+    reconstruct all of them within tolerance meters."""
+    if method not in METHODS:
+        raise ValueError('Unknown compression method: %s' % method)
+    if len(points) <= 2:
+        return list(points)
+    if method == 'dead_reckoning':
+        return _dead_reckoning(points, tolerance)
+    return _douglas_peucker(points, tolerance)
+
+
+def _dead_reckoning(points, tolerance):
+    kept = [points[0]]
+    for point in points[1:-1]:
+        latitude, longitude = position(kept, len(kept) - 1, point[0],
+                                       'dead_reckoning')
+        if offset(latitude, longitude, point[1], point[2]) > tolerance:
+            kept.append(point)
+    kept.append(points[-1])
+    return kept
+
+
+def _douglas_peucker(points, tolerance):
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(points) - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        worst, split_at = tolerance, None
+        for index in range(first + 1, last):
+            point = points[index]
+            latitude, longitude = interpolate(points[first], points[last], point[0])
+            error = offset(latitude, longitude, point[1], point[2])
+            if error > worst:
+                worst, split_at = error, index
+        if split_at is not None:
+            keep[split_at] = True
+            ranges.extend(((first, split_at), (split_at, last)))
+    return [point for point, keep_it in zip(points, keep) if keep_it]
+
+
+def max_error(points, kept, method):
+    """The largest distance (in meters) between one of the points of a segment
+    and where it's reconstructed from the kept points."""
+    worst, index = 0.0, 0
+    for point in points:
+        while index + 1 < len(kept) and kept[index + 1][0] <= point[0]:
+            index += 1
+        if kept[index][0] == point[0]:
+            continue
+        latitude, longitude = position(kept, index, point[0], method)
+        worst = max(worst, offset(latitude, longitude, point[1], point[2]))
+    return worst
+
+
+def reconstruct(kept, method, interval):
+    """The trajectory of a segment from its kept points: every kept point, plus
+    a reconstructed one every interval seconds in between two of them, as
+    (timestamp, latitude, longitude, heading, reconstructed) tuples. A
+    reconstructed point gets the heading of the kept point before it."""
+    step = timedelta(seconds=interval)
+    for index, point in enumerate(kept):
+        yield point + (False,)
+        if index + 1 == len(kept):
+            break
+        timestamp = point[0] + step
+        while timestamp < kept[index + 1][0]:
+            latitude, longitude = position(kept, index, timestamp, method)
+            yield (timestamp, latitude, longitude, point[3], True)
+            timestamp += step
+
+
+def restore(points, segments, interval):
+    """The trajectory of a vehicle from its stored points (an iterable, e.g. a
+    query) and its compressed segments, as (start, end, method, tolerance)
+    tuples sorted by start: points outside of the segments as they are, and the
+    segments reconstructed (see reconstruct()). Yields (timestamp, latitude,
+    longitude, heading, tolerance) tuples, where tolerance is None for the
+    stored points and the segment's tolerance for the reconstructed ones."""
+    segments = iter(segments)
+    segment, kept = next(segments, None), []
+    for point in points:
+        while segment is not None and point[0] > segment[1]:
+            for restored in _restore_segment(kept, segment, interval):
+                yield restored
+            segment, kept = next(segments, None), []
+        if segment is not None and point[0] >= segment[0]:
+            kept.append(tuple(point))
+        else:
+            yield tuple(point) + (None,)
+    if segment is not None:
+        for restored in _restore_segment(kept, segment, interval):
+            yield restored
+
+
+def _restore_segment(kept, segment, interval):
+    _, _, method, tolerance = segment
+    for point in reconstruct(kept, method, interval):
+        yield point[:4] + (tolerance if point[4] else None,)
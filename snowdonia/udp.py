@@ -0,0 +1,157 @@
+"""
+UDP Ingestion
+=============
+
+A datagram server for emitters that can't afford an HTTP request per emission.
+It runs as its own process, next to the API's workers:
+::
+    $ FLASK_APP=snowdonia flask udp --host 0.0.0.0 --port 5005
+
+Every datagram carries one emission, with the same fields as a batch emission
+(see snowdonia.wire), in either binary format:
+
+- A 39 byte fixed-width batch record (the vehicle's UUID, then the emission).
+- A msgpack map, including the vehicle_id (a msgpack emission is always longer
+  than 39 bytes, which is how the two are told apart).
+
+Emissions are validated exactly like the API validates them (see
+snowdonia.accept_emission()), by a handler thread that the event loop queues
+datagrams for (at most UDP_QUEUE_SIZE of them, beyond which datagrams are
+dropped), and valid ones are queued in a write-behind buffer (see
+snowdonia.buffer) that writes them in batches.
+
+UDP is fire and forget: datagrams can be lost or reordered on the way, or
+dropped by the OS when bursts overflow the socket's receive buffer
+(UDP_RECEIVE_BUFFER bytes), and the server drops the ones it can't read. With UDP_ACK on (or --ack), every datagram
+that could be read is answered with an ack datagram of the form
+``<vehicle_id> <status> <message>``, e.g. ``6a0b...e2 200 Success!``, so that
+emitters that care can resend the emissions that weren't acked.
+"""
+import asyncio
+import queue
+import socket
+import threading
+
+from . import wire
+
+
+class EmissionProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol that queues every datagram it receives, for a handler
+    thread that decodes it into an emission and hands it to handle(vehicleID,
+    emission), which returns its (message, status).
+
+    The event loop only ever queues datagrams, so it keeps draining the socket
+    while the handler waits on the database (e.g. registering a new vehicle). If
+    the queue (of queue_size datagrams) is full, datagrams are dropped.
+
+    Counters (see stats()):
+
+    - received: datagrams received
+    - accepted: emissions handled with status 200
+    - invalid: datagrams that couldn't be decoded, or whose emission was handled
+      with another status (failed validation)
+    - dropped: datagrams dropped because the queue was full
+    - acks: ack datagrams sent
+    """
+    def __init__(self, handle, ack=False, queue_size=10000):
+        self.handle = handle
+        self.ack = ack
+        self.transport = None
+        self._loop = None
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.received = 0
+        self.accepted = 0
+        self.invalid = 0
+        self.dropped = 0
+        self.acks = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self._loop = asyncio.get_event_loop()
+        self._thread = threading.Thread(target=self._run, name='udp-handler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def datagram_received(self, data, addr):
+        try:
+            self._queue.put_nowait((data, addr))
+        except queue.Full:
+            with self._lock:
+                self.received += 1
+                self.dropped += 1
+            return
+        with self._lock:
+            self.received += 1
+
+    def stop(self):
+        """Handles the datagrams still in the queue, then stops the handler
+        thread."""
+        if self._thread is not None:
+            self._queue.put((None, None))
+            self._thread.join()
+            self._thread = None
+
+    def stats(self):
+        """Counters of the server."""
+        with self._lock:
+            return dict(received=self.received, accepted=self.accepted,
+                        invalid=self.invalid, dropped=self.dropped,
+                        acks=self.acks, queued=self._queue.qsize())
+
+    def _run(self):
+        """Handler loop: handles the queued datagrams one at a time."""
+        while True:
+            data, addr = self._queue.get()
+            if data is None:
+                return
+            try:
+                emission = decode_datagram(data)
+                vehicleID = emission['vehicle_id']
+                message, status = self.handle(vehicleID, emission)
+            except Exception:
+                with self._lock:
+                    self.invalid += 1
+                continue
+            with self._lock:
+                if status == 200:
+                    self.accepted += 1
+                else:
+                    self.invalid += 1
+            if self.ack:
+                self._send_ack(('%s %d %s' % (vehicleID, status, message))
+                               .encode('utf-8'), addr)
+
+    def _send_ack(self, data, addr):
+        """Sends an ack from the handler thread (transports aren't thread-safe,
+        so the loop sends it)."""
+        try:
+            self._loop.call_soon_threadsafe(self.transport.sendto, data, addr)
+        except RuntimeError: # the loop is closed
+            return
+        with self._lock:
+            self.acks += 1
+
+
+def decode_datagram(data):
+    """Decodes a datagram into a dict of the fields of its emission, including
+    the vehicle_id. Raises ValueError if it can't be decoded."""
+    if len(data) == wire.BATCH_EMISSION.size:
+        return wire.decode_emissions(wire.RECORD, data)[0]
+    return wire.decode_emission(wire.MSGPACK[0], data)
+
+
+def serve(handle, host='0.0.0.0', port=5005, ack=False, queue_size=10000,
+          receive_buffer=None, loop=None):
+    """Starts listening on (host, port) on the loop, with a socket receive
+    buffer of receive_buffer bytes if given (the OS may cap it, e.g. at
+    net.core.rmem_max on Linux). Returns the (transport, protocol); the loop has
+    to be run by the caller, and protocol.stop() called once it's done."""
+    loop = loop or asyncio.get_event_loop()
+    transport, protocol = loop.run_until_complete(loop.create_datagram_endpoint(
+        lambda: EmissionProtocol(handle, ack, queue_size), local_addr=(host, port)))
+    if receive_buffer:
+        transport.get_extra_info('socket').setsockopt(
+            socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+    return transport, protocol
@@ -0,0 +1,166 @@
+"""
+Vectorized Geometry
+===================
+
+NumPy counterparts of distance_from_center(), valid_point() and
+Boundary.contains(), for validating many points at once (batches of emissions,
+bulk imports, backfills) without a Python loop per point. Vincenty's
+iterations run over whole arrays, and every point stops iterating as soon as it
+converges.
+
+Distances match distance_from_center() to well within a millimetre.
+"""
+import numpy as np
+
+from .geo import snowdonia_center, snowdonia_radius, wgs84_a, wgs84_b, wgs84_f, \
+                 center_sin_U2, center_cos_U2, center_cos_lat, max_lat_offset, \
+                 max_long_offset, HAVERSINE_RADIUS, HAVERSINE_MARGIN
+from .boundary import EDGES, contains_in_cell
+
+
+def distances_from_center(latitudes, longitudes):
+    """Calculates the distances (in kms) between the provided points and the
+    town center, using Vincenty's formula like distance_from_center() does.
+
+    Takes arrays (or sequences) of latitudes and longitudes in degrees and
+    returns an array of distances. Points for which the formula fails to
+    converge (where distance_from_center() returns None) get NaN.
+    """
+    lat_rad = np.radians(np.asarray(latitudes, dtype=float))
+    long_rad = np.radians(np.asarray(longitudes, dtype=float))
+    a, b, f = wgs84_a, wgs84_b, wgs84_f
+    L = long_rad - snowdonia_center[1]
+    U1 = np.arctan((1 - f) * np.tan(lat_rad))
+    sin_U1 = np.sin(U1)
+    cos_U1 = np.cos(U1)
+    sin_U2 = center_sin_U2
+    cos_U2 = center_cos_U2
+    lambda1 = L.copy()
+    lambdaP = np.full(L.shape, 2 * np.pi)
+
+    # The state of the last iteration of every point
+    sin_sigma = np.zeros(L.shape)
+    cos_sigma = np.zeros(L.shape)
+    sigma = np.zeros(L.shape)
+    cos2_alpha = np.zeros(L.shape)
+    cos2_sigma_m = np.zeros(L.shape)
+    iterations = np.zeros(L.shape, dtype=int)
+    coincident = np.zeros(L.shape, dtype=bool)
+    active = np.ones(L.shape, dtype=bool)
+    iter_limit = 20
+
+    for _ in range(iter_limit):
+        active &= np.abs(lambda1 - lambdaP) > 1e-12
+        i = np.flatnonzero(active)
+        if i.size == 0:
+            break
+        sin_lambda1 = np.sin(lambda1[i])
+        cos_lambda1 = np.cos(lambda1[i])
+        x = cos_U1[i] * sin_U2 - sin_U1[i] * cos_U2 * cos_lambda1
+        s_sigma = np.sqrt((cos_U2 * sin_lambda1) * (cos_U2 * sin_lambda1) + x * x)
+
+        # Same point as the center: nothing to iterate
+        same = s_sigma == 0
+        if same.any():
+            coincident[i[same]] = True
+            active[i[same]] = False
+            i, s_sigma = i[~same], s_sigma[~same]
+            sin_lambda1, cos_lambda1 = sin_lambda1[~same], cos_lambda1[~same]
+
+        c_sigma = sin_U1[i] * sin_U2 + cos_U1[i] * cos_U2 * cos_lambda1
+        sig = np.arctan2(s_sigma, c_sigma)
+        s_alpha = cos_U1[i] * cos_U2 * sin_lambda1 / s_sigma
+        c2_alpha = 1 - s_alpha * s_alpha
+        nonzero = c2_alpha != 0
+        c2_sigma_m = np.zeros(i.shape)
+        c2_sigma_m[nonzero] = c_sigma[nonzero] - \
+            2 * sin_U1[i][nonzero] * sin_U2 / c2_alpha[nonzero]
+        C = f / 16 * c2_alpha * (4 + f * (4 - 3 * c2_alpha))
+        lambdaP[i] = lambda1[i]
+        lambda1[i] = L[i] + (1 - C) * f * s_alpha * \
+            (sig + C * s_sigma *
+             (c2_sigma_m + C * c_sigma * (-1 + 2 * c2_sigma_m * c2_sigma_m)))
+        sin_sigma[i], cos_sigma[i], sigma[i] = s_sigma, c_sigma, sig
+        cos2_alpha[i], cos2_sigma_m[i] = c2_alpha, c2_sigma_m
+        iterations[i] += 1
+
+    u_2 = cos2_alpha * (a * a - b * b) / (b * b)
+    A = 1 + u_2 / 16384 * (4096 + u_2 * (-768 + u_2 * (320 - 175 * u_2)))
+    B = u_2 / 1024 * (256 + u_2 * (-128 + u_2 * (74 - 47 * u_2)))
+    delta_sigma = B * sin_sigma * (cos2_sigma_m + B / 4 *
+                                   (cos_sigma * (-1 + 2 *
+                                    cos2_sigma_m * cos2_sigma_m) -
+                                    B / 6 * cos2_sigma_m *
+                                    (-3 + 4 * sin_sigma * sin_sigma) *
+                                    (-3 + 4 * cos2_sigma_m * cos2_sigma_m)))
+    s = b * A * (sigma - delta_sigma) / 1000
+    s[coincident] = 0
+    s[(iterations == iter_limit) & ~coincident] = np.nan # failed to converge
+    return s
+
+
+def haversines_from_center(latitudes, longitudes):
+    """Calculates the distances (in kms) between the provided points and the
+    town center on a sphere, like haversine_from_center() does."""
+    lat_rad = np.radians(np.asarray(latitudes, dtype=float))
+    long_rad = np.radians(np.asarray(longitudes, dtype=float))
+    sin_dlat = np.sin((lat_rad - snowdonia_center[0]) / 2)
+    sin_dlong = np.sin((long_rad - snowdonia_center[1]) / 2)
+    h = sin_dlat * sin_dlat + \
+        center_cos_lat * np.cos(lat_rad) * sin_dlong * sin_dlong
+    return 2 * HAVERSINE_RADIUS * np.arcsin(np.minimum(1, np.sqrt(h)))
+
+
+def within_boundary(boundary, latitudes, longitudes):
+    """Checks many points at once against a boundary (see snowdonia.boundary),
+    like its contains() does for one. Returns a boolean array. The points in
+    cells that no edge goes through are looked up all at once, and only the
+    others go through the edges of their cells."""
+    lat = np.asarray(latitudes, dtype=float)
+    long = np.asarray(longitudes, dtype=float)
+    inside = np.zeros(lat.shape, dtype=bool)
+    i = np.flatnonzero((long >= boundary.min_x) & (long <= boundary.max_x) &
+                       (lat >= boundary.min_y) & (lat <= boundary.max_y))
+    rows = np.clip(((lat[i] - boundary.min_y) / boundary.cell_height).astype(int),
+                   0, boundary.cells - 1)
+    columns = np.clip(((long[i] - boundary.min_x) / boundary.cell_width).astype(int),
+                      0, boundary.cells - 1)
+    cells = rows * boundary.cells + columns
+    states = np.frombuffer(boundary.states, dtype=np.uint8)[cells]
+    inside[i] = states == 1
+    for index, cell in zip(i[states == EDGES], cells[states == EDGES]):
+        inside[index] = contains_in_cell(boundary.grid[cell], lat[index], long[index])
+    return inside
+
+
+def valid_points(latitudes, longitudes, headings, boundary=None):
+    """Checks many points at once, like valid_point() does for one. Returns a
+    boolean array that is True where:
+
+    - Latitude is between -90 and 90
+    - Longitude is between -180 and 180
+    - Heading is between 0 and 359
+    - Point is within the town borders (less than 50km from town center, or in
+      the boundary, if one is given)
+
+    Points are checked in the same tiers as in_range() does (see snowdonia.geo),
+    so only the points close to the border run Vincenty's formula. Points it
+    can't converge for are rejected.
+    """
+    lat = np.asarray(latitudes, dtype=float)
+    long = np.asarray(longitudes, dtype=float)
+    heading = np.asarray(headings)
+    valid = (lat >= -90) & (lat <= 90) & (long >= -180) & (long <= 180) & \
+            (heading >= 0) & (heading <= 359)
+    if boundary is not None:
+        return valid & within_boundary(boundary, lat, long)
+    valid &= np.abs(np.radians(lat) - snowdonia_center[0]) <= max_lat_offset
+    valid &= np.abs(np.radians(long) - snowdonia_center[1]) <= max_long_offset
+    i = np.flatnonzero(valid)
+    distance = haversines_from_center(lat[i], long[i])
+    valid[i] = distance <= snowdonia_radius * (1 - HAVERSINE_MARGIN)
+    i = i[(distance > snowdonia_radius * (1 - HAVERSINE_MARGIN)) &
+          (distance < snowdonia_radius * (1 + HAVERSINE_MARGIN))]
+    with np.errstate(invalid='ignore'):
+        valid[i] = distances_from_center(lat[i], long[i]) <= snowdonia_radius
+    return valid
@@ -0,0 +1,140 @@
+"""
+Wire Formats
+============
+
+Besides form data, emitters can send their emissions in a compact binary body,
+picked by the request's Content-Type. Timestamps are sent as seconds since the
+epoch (UTC), so they're decoded without parsing a date string.
+
+**msgpack** (Content-Type: application/msgpack or application/x-msgpack): a map
+with the same fields as the form (latitude, longitude, type, heading), except
+for the timestamp, which is an integer (a DD-MM-YYYY hh:mm:ss string works too,
+but is slower). The batch endpoint takes an array of such maps, each with a
+vehicle_id too.
+
+**Fixed-width records** (Content-Type: application/vnd.snowdonia.emission): one
+little-endian record of 23 bytes per emission:
+
+=======  ======  ==========================================================
+Offset   Type    Field
+=======  ======  ==========================================================
+0        double  latitude
+8        double  longitude
+16       uint32  timestamp (seconds since the epoch)
+20       uint16  heading
+22       uint8   type: 0 if not sent, 1 taxi, 2 bus, 3 tram, 4 train
+=======  ======  ==========================================================
+
+The batch endpoint takes any number of 39 byte records, each starting with the
+16 bytes of the vehicle's UUID followed by the 23 bytes above.
+"""
+import struct
+from datetime import datetime, timedelta
+from uuid import UUID
+
+import msgpack
+
+MSGPACK = ('application/msgpack', 'application/x-msgpack')
+"""Content types of msgpack bodies."""
+RECORD = 'application/vnd.snowdonia.emission'
+"""Content type of fixed-width record bodies."""
+
+TYPES = ('', 'taxi', 'bus', 'tram', 'train')
+"""Vehicle types, by their code in fixed-width records."""
+
+EMISSION = struct.Struct('<ddIHB')
+"""Fixed-width record of an emission."""
+BATCH_EMISSION = struct.Struct('<16sddIHB')
+"""Fixed-width record of an emission in a batch (prefixed with the vehicle's UUID)."""
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def decodes(mimetype):
+    """Whether the content type is one of the binary formats."""
+    return mimetype in MSGPACK or mimetype == RECORD
+
+
+def decode_emission(mimetype, body):
+    """Decodes the body of a request to the single emission endpoint into a dict
+    of its fields, with the timestamp as a datetime.
+
+    Raises ValueError if the body can't be decoded.
+    """
+    if mimetype == RECORD:
+        if len(body) != EMISSION.size:
+            raise ValueError('Expected a %d byte record' % EMISSION.size)
+        return _record(EMISSION.unpack(body))
+    emission = _unpack(body)
+    if not isinstance(emission, dict):
+        raise ValueError('Expected a map')
+    return _timestamp(emission)
+
+
+def decode_emissions(mimetype, body):
+    """Decodes the body of a request to the batch endpoint into a list of dicts
+    of their fields (including the vehicle_id), with timestamps as datetimes.
+
+    Raises ValueError if the body can't be decoded.
+    """
+    if mimetype == RECORD:
+        if len(body) % BATCH_EMISSION.size:
+            raise ValueError('Expected %d byte records' % BATCH_EMISSION.size)
+        emissions = []
+        for fields in BATCH_EMISSION.iter_unpack(body):
+            emission = _record(fields[1:])
+            emission['vehicle_id'] = UUID(bytes=fields[0]).hex
+            emissions.append(emission)
+        return emissions
+    emissions = _unpack(body)
+    if not isinstance(emissions, list):
+        raise ValueError('Expected an array')
+    return [_timestamp(emission) if isinstance(emission, dict) else emission
+            for emission in emissions]
+
+
+def encode_emission(latitude, longitude, timestamp, heading, vType=None,
+                    vehicle_id=None):
+    """Encodes an emission as a fixed-width record (for emitters and tests).
+    With a vehicle_id (UUID hex), encodes it as a batch record."""
+    record = EMISSION.pack(latitude, longitude,
+                           int((timestamp - EPOCH).total_seconds()), heading,
+                           TYPES.index(vType or ''))
+    if vehicle_id is None:
+        return record
+    return UUID(hex=vehicle_id).bytes + record
+
+
+def _record(fields):
+    """Dict of the fields of a fixed-width record."""
+    latitude, longitude, seconds, heading, type_code = fields
+    emission = dict(latitude=latitude, longitude=longitude, heading=heading,
+                    timestamp=EPOCH + timedelta(seconds=seconds))
+    if type_code:
+        emission['type'] = TYPES[type_code] if type_code < len(TYPES) \
+                            else 'unknown'
+    return emission
+
+
+def _timestamp(emission):
+    """Converts the epoch timestamp of a msgpack emission to a datetime. Other
+    timestamps (and out of range ones) are left as they are, to be read (and
+    rejected) like the form's."""
+    seconds = emission.get('timestamp')
+    if isinstance(seconds, int) and not isinstance(seconds, bool):
+        try:
+            emission['timestamp'] = EPOCH + timedelta(seconds=seconds)
+        except OverflowError:
+            pass
+    return emission
+
+
+def _unpack(body):
+    """Unpacks a msgpack body, with strings as str."""
+    try:
+        try:
+            return msgpack.unpackb(body, raw=False)
+        except TypeError: # msgpack < 0.5.2 has no raw
+            return msgpack.unpackb(body, encoding='utf-8')
+    except Exception as ex:
+        raise ValueError('Invalid msgpack body: %s' % ex)
@@ -0,0 +1,192 @@
+"""
+Sharded Writers
+===============
+
+With WRITERS set to a number of processes (see config.py), the API's workers
+don't write emissions themselves. Once validated, an emission is sent to one of
+WRITERS writer processes, picked by a hash of its vehicle's UUID (its shard),
+which batches the emissions of its shard with a write-behind buffer (see
+snowdonia.buffer, configured by the WRITE_BEHIND_* settings). The writers run
+next to the API's workers:
+::
+    $ FLASK_APP=snowdonia flask writers &
+    $ gunicorn snowdonia:app -w 4
+
+- A burst of emissions becomes a few multi-row transactions per writer, instead
+  of a tiny transaction per emission per worker.
+- All the emissions of a vehicle are written by the same writer, in the order
+  it received them, so writers never wait on each other's locks (e.g. on the
+  vehicle's position and rollups).
+- Shards are independent, so write throughput grows with the number of writers
+  (up to what the database can take), one per core.
+
+Workers send emissions to the writers over Unix datagram sockets (one per
+writer, in WRITERS_SOCKET_DIR), packed with msgpack, at most MAX_ROWS emissions
+per datagram. If a writer isn't running, or doesn't take a datagram within
+WRITERS_SEND_TIMEOUT seconds (it's falling behind), the worker writes the
+emissions itself, so a slow or missing writer slows requests down rather than
+losing their emissions.
+
+As with write-behind, a successful response means the emission was validated and
+handed over, and a writer that is killed (rather than shut down) loses the
+emissions it hadn't written yet. A writer retries the batches it can't write,
+and when its buffer is full and it can't write the emissions it receives either,
+it holds on to them (and stops receiving, so that workers write the emissions
+themselves, or fail) until it can.
+"""
+import os
+import socket
+import threading
+import time
+import zlib
+from datetime import timedelta
+
+import msgpack
+
+from .wire import EPOCH
+
+MAX_ROWS = 1000
+"""Emissions per datagram (about 60 bytes each)."""
+MAX_DATAGRAM = 1 << 17
+
+
+def shard_of(vehicle_id, shards):
+    """The shard (from 0 to shards - 1) of a vehicle. The same in every process,
+    unlike hash()."""
+    return zlib.crc32(vehicle_id.encode('utf-8')) % shards
+
+
+def socket_path(directory, shard):
+    """The path of the socket of the writer of a shard."""
+    return os.path.join(directory, 'writer-%d.sock' % shard)
+
+
+def pack(rows):
+    """Packs emission rows (dicts of Emission column values) into a datagram."""
+    return msgpack.packb([[row['vehicle_id'], row['latitude'], row['longitude'],
+                           (row['timestamp'] - EPOCH).total_seconds(),
+                           row['heading']] for row in rows])
+
+
+def unpack(data):
+    """Unpacks the emission rows of a datagram. Raises ValueError if it isn't
+    one."""
+    try:
+        return [dict(vehicle_id=vehicle_id, latitude=latitude, longitude=longitude,
+                     timestamp=EPOCH + timedelta(seconds=timestamp), heading=heading)
+                for vehicle_id, latitude, longitude, timestamp, heading
+                in msgpack.unpackb(data, raw=False)]
+    except Exception as ex:
+        raise ValueError('Not a datagram of emissions: %s' % ex)
+
+
+class ShardRouter(object):
+    """Sends emission rows to the writers of their shards. It has the put(),
+    extend(), stats() and stop() of an EmissionBuffer, so it stands in for the
+    write-behind buffer of a worker.
+
+    write(rows) writes rows synchronously, in the calling process, when their
+    writer can't take them.
+    """
+    def __init__(self, directory, shards, write, timeout=1.0):
+        self.directory = directory
+        self.shards = shards
+        self.write = write
+        self.timeout = timeout
+        self.enqueued = 0
+        self.written_synchronously = 0
+        self._lock = threading.Lock()
+        self._socket = None
+        self._pid = None
+
+    def put(self, row):
+        """Sends one emission row to its writer."""
+        self.extend([row])
+
+    def extend(self, rows):
+        """Sends emission rows to their writers, one datagram per shard."""
+        shards = {}
+        for row in rows:
+            shards.setdefault(shard_of(row['vehicle_id'], self.shards), []).append(row)
+        sock = self._connect()
+        for shard, rows in sorted(shards.items()):
+            for start in range(0, len(rows), MAX_ROWS):
+                chunk = rows[start:start + MAX_ROWS]
+                try:
+                    sock.sendto(pack(chunk), socket_path(self.directory, shard))
+                except OSError: # not running (or falling behind)
+                    with self._lock:
+                        self.written_synchronously += len(chunk)
+                    self.write(chunk)
+                    continue
+                with self._lock:
+                    self.enqueued += len(chunk)
+
+    def stop(self):
+        """Nothing to do: emissions are never held by the workers."""
+
+    def stats(self):
+        """Counters of the worker: emissions sent to the writers, and written
+        synchronously."""
+        with self._lock:
+            return dict(writers=self.shards, enqueued=self.enqueued,
+                        written_synchronously=self.written_synchronously)
+
+    def _connect(self):
+        """The socket of this process (sockets aren't shared by forked workers)."""
+        if self._pid != os.getpid():
+            self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._socket.settimeout(self.timeout)
+            self._pid = os.getpid()
+        return self._socket
+
+
+def serve(path, buffer, running=lambda: True, idle=None, poll_interval=1.0):
+    """Receives datagrams of emissions on the Unix socket at path, and hands
+    their rows to buffer (an EmissionBuffer), for as long as running() is true,
+    calling idle() (if given) at least every poll_interval seconds. Once it
+    stops, it reads the datagrams that are left, then stops the buffer (which
+    writes what's left in it).
+
+    Rows the buffer can't take (it's full, and they can't be written) are
+    handed to it again every poll_interval seconds, as long as running() is
+    true."""
+    if os.path.exists(path):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    sock.settimeout(poll_interval)
+    try:
+        while running():
+            try:
+                _receive(sock, buffer, running, poll_interval)
+            except socket.timeout:
+                pass
+            if idle is not None:
+                idle()
+        sock.setblocking(False)
+        while True:
+            try:
+                _receive(sock, buffer, running, poll_interval)
+            except (BlockingIOError, socket.timeout):
+                break
+    finally:
+        sock.close()
+        os.unlink(path)
+        buffer.stop()
+
+
+def _receive(sock, buffer, running, poll_interval):
+    try:
+        rows = unpack(sock.recv(MAX_DATAGRAM))
+    except ValueError:
+        return # not ours
+    while True:
+        try:
+            buffer.extend(rows)
+            return
+        except Exception:
+            # The worker that sent them already answered with success
+            if not running():
+                raise
+            time.sleep(poll_interval)
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+"""
+Simulates vehicles emitting to the API over HTTP, like the locustfile does but
+without Locust, its web UI or a deployed app, and writes a machine-readable
+report, so that capacity can be measured (and compared) commit by commit.
+
+Start the app locally with gunicorn and run 1000 vehicles against it, all of
+them emitting at the same instant, 5 times, 1 second apart:
+::
+    $ python loadgen.py --start --workers 4 --vehicles 1000 --emissions 5 --interval 1
+
+Or run them against an app that's already running, at 500 emissions/sec:
+::
+    $ python loadgen.py --url http://127.0.0.1:8000 --vehicles 1000 --rate 500
+
+Every vehicle has a UUID4 and a type, and emits the same random points (within
+50km of the town center) as the locustfile's vehicles, over a connection of its
+own (kept alive if the server allows it). The report (load_report.json by
+default) holds the throughput, the latency percentiles (in ms), and the number
+of responses by status and message, plus connection errors.
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlencode, urlsplit
+
+from vehicles import req_data, vType
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+class Connection(object):
+    """HTTP/1.1 connection of one vehicle, reopened whenever the server closes
+    it."""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def put(self, path, form):
+        """PUTs the form to path. Returns the (status, body) of the response."""
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        body = urlencode(form).encode('ascii')
+        self.writer.write(('PUT %s HTTP/1.1\r\nHost: %s:%d\r\n'
+                           'Content-Type: application/x-www-form-urlencoded\r\n'
+                           'Content-Length: %d\r\n\r\n' % (
+                               path, self.host, self.port, len(body))
+                           ).encode('ascii') + body)
+        try:
+            status_line = await self.reader.readline()
+            if not status_line:
+                raise ConnectionError('Connection closed by the server')
+            headers = {}
+            while True:
+                line = await self.reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            body = await self.reader.readexactly(
+                int(headers.get('content-length', 0)))
+        except Exception:
+            self.close()
+            raise
+        if headers.get('connection', '').lower() == 'close' or \
+           status_line.startswith(b'HTTP/1.0'):
+            self.close()
+        return int(status_line.split()[1]), body.decode('utf-8', 'replace')
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+async def vehicle(index, args, host, port, start, latencies, responses):
+    """Sends the emissions of one vehicle at their scheduled times: all vehicles
+    at once every interval seconds, or spread out at rate emissions/sec."""
+    vehicleID, vehicle_type = uuid.uuid4().hex, vType()
+    connection = Connection(host, port)
+    loop = asyncio.get_event_loop()
+    for k in range(args.emissions):
+        if args.rate:
+            at = start + (k * args.vehicles + index) / args.rate
+        else:
+            at = start + k * args.interval
+        await asyncio.sleep(max(0, at - loop.time()))
+        sent = time.perf_counter()
+        try:
+            status, message = await connection.put(
+                '/api/v1/emission/' + vehicleID, req_data(vehicle_type))
+        except Exception as ex:
+            responses['connection error: %s' % type(ex).__name__] += 1
+            continue
+        latencies.append(time.perf_counter() - sent)
+        responses['%d %s' % (status, message.strip())] += 1
+    connection.close()
+
+
+def percentile(values, p):
+    """The p-th percentile of sorted values (nearest rank)."""
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+async def simulate(args, host, port):
+    latencies, responses = [], Counter()
+    loop = asyncio.get_event_loop()
+    start = loop.time() + 1 # time for every vehicle to get ready
+    await asyncio.gather(*[vehicle(i, args, host, port, start, latencies, responses)
+                           for i in range(args.vehicles)])
+    elapsed = loop.time() - start
+    latencies.sort()
+    sent = args.vehicles * args.emissions
+    report = dict(vehicles=args.vehicles, emissions=sent,
+                  rate=args.rate or None, interval=None if args.rate else args.interval,
+                  seconds=round(elapsed, 3),
+                  responses_per_second=round(len(latencies) / elapsed, 1),
+                  responses=dict(responses),
+                  errors=sent - sum(count for response, count in responses.items()
+                                    if response.startswith('200 ')))
+    if latencies:
+        report['latency_ms'] = dict(
+            (name, round(percentile(latencies, p) * 1000, 2))
+            for name, p in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100)))
+    return report
+
+
+def start_app(port, workers):
+    """Starts the app with gunicorn on port, and waits until it accepts
+    connections."""
+    server = subprocess.Popen(['gunicorn', 'snowdonia:app', '-w', str(workers),
+                               '-b', '127.0.0.1:%d' % port], cwd=ROOT)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server
+        except OSError:
+            if server.poll() is not None:
+                break
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit('The app did not start.')
+
+
+def commit():
+    """The commit the app is at, if it's a git checkout."""
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates vehicles emitting over HTTP.')
+    parser.add_argument('--url', default='http://127.0.0.1:8000',
+                        help='the app to load (default: http://127.0.0.1:8000)')
+    parser.add_argument('--start', action='store_true',
+                        help='start the app with gunicorn first (on --url\'s port)')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='gunicorn workers, with --start')
+    parser.add_argument('--vehicles', type=int, default=1000)
+    parser.add_argument('--emissions', type=int, default=1,
+                        help='emissions per vehicle')
+    parser.add_argument('--interval', type=float, default=20.0,
+                        help='seconds between the emissions of a vehicle, when '
+                             'all the vehicles emit at once')
+    parser.add_argument('--rate', type=float, default=0,
+                        help='emissions/sec over all vehicles (default: all at once)')
+    parser.add_argument('--report', default='load_report.json',
+                        help='file to write the report to')
+    args = parser.parse_args()
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+
+    server = start_app(port, args.workers) if args.start else None
+    try:
+        loop = asyncio.new_event_loop()
+        report = loop.run_until_complete(simulate(args, host, port))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+    report.update(commit=commit(), url=args.url,
+                  workers=args.workers if args.start else None)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print(json.dumps(report, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
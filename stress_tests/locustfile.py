@@ -1,42 +1,13 @@
 #!/usr/bin/env python
 import uuid
-from datetime import datetime
-from math import radians, degrees, sqrt, pi, cos, sin
-from random import random, randint
 from locust import HttpLocust, TaskSet, task
+from vehicles import req_data, vType
 
-snowdonia_center = (53.068889, -4.075556)
-types = ['taxi', 'tram', 'bus', 'train']
 numbers = dict(taxi=0, tram=0, bus=0, train=0)
 
-def req_data(vType):
-    pt = generate_point()
-    heading = randint(0, 359)
-    return {
-        'type': vType,
-        'latitude': pt['latitude'],
-        'longitude': pt['longitude'],
-        'heading': heading,
-        'timestamp': datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-    }
-
 def url(vID):
     return '/api/v1/emission/' + vID
 
-def vType():
-    return types[randint(0,3)]
-
-def generate_point():
-    r = 50000/111300
-    u, v = random(), random()
-    y0, x0 = snowdonia_center
-    w = r * sqrt(u)
-    t = 2 * pi * v
-    x = w * cos(t)
-    y = w * sin(t)
-    x1 = x / cos(y0)
-    return dict(longitude=x1+x0, latitude=y+y0)
-
 
 class Emission(TaskSet): 
     def on_start(self):
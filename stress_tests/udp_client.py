@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Simulates vehicles emitting over UDP (see snowdonia.udp), e.g. 1000 vehicles
+sending 10 emissions each, one per second, to a local server:
+::
+    $ FLASK_APP=snowdonia flask udp --ack &
+    $ python udp_client.py --vehicles 1000 --emissions 10 --interval 1 --ack
+
+Every vehicle has a UUID4 and a type, and emits random points within 50km of the
+town center (like the locustfile's vehicles), one second apart. With --ack, the
+client waits for the server's acks and counts them by status; datagrams still
+unacked --timeout seconds after the last one was sent are counted as lost.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta
+from random import randint
+
+import msgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from snowdonia import wire
+from vehicles import vType, generate_point
+
+
+class AckCounter(asyncio.DatagramProtocol):
+    """Counts the acks the server sends back, by status."""
+    def __init__(self):
+        self.statuses = Counter()
+
+    def datagram_received(self, data, addr):
+        vehicleID, status, message = data.decode('utf-8').split(' ', 2)
+        self.statuses[status] += 1
+
+
+def datagram(vehicleID, vehicle_type, timestamp, format):
+    """One emission of the vehicle, as a datagram of the given format."""
+    point = generate_point()
+    heading = randint(0, 359)
+    if format == 'record':
+        return wire.encode_emission(point['latitude'], point['longitude'],
+                                    timestamp, heading, vehicle_type, vehicleID)
+    return msgpack.packb(dict(
+        vehicle_id=vehicleID, type=vehicle_type, latitude=point['latitude'],
+        longitude=point['longitude'], heading=heading,
+        timestamp=int((timestamp - wire.EPOCH).total_seconds())))
+
+
+async def vehicle(transport, emissions, interval, format, start):
+    """Sends the emissions of one vehicle, interval seconds apart."""
+    vehicleID, vehicle_type = uuid.uuid4().hex, vType()
+    for i in range(emissions):
+        transport.sendto(datagram(vehicleID, vehicle_type,
+                                  start + timedelta(seconds=i), format))
+        await asyncio.sleep(interval)
+
+
+async def simulate(args):
+    loop = asyncio.get_event_loop()
+    transport, acks = await loop.create_datagram_endpoint(
+        AckCounter, remote_addr=(args.host, args.port))
+    start = datetime.utcnow().replace(microsecond=0)
+    started = time.time()
+    await asyncio.gather(*[vehicle(transport, args.emissions, args.interval,
+                                   args.format, start)
+                           for _ in range(args.vehicles)])
+    elapsed = time.time() - started
+    sent = args.vehicles * args.emissions
+    if args.ack:
+        deadline = time.time() + args.timeout
+        while sum(acks.statuses.values()) < sent and time.time() < deadline:
+            await asyncio.sleep(0.05)
+    transport.close()
+    report = dict(vehicles=args.vehicles, sent=sent, seconds=round(elapsed, 3),
+                  sent_per_second=round(sent / elapsed, 1))
+    if args.ack:
+        report.update(acks=dict(acks.statuses),
+                      lost=sent - sum(acks.statuses.values()))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulates vehicles emitting over UDP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5005)
+    parser.add_argument('--vehicles', type=int, default=1000)
+    parser.add_argument('--emissions', type=int, default=10,
+                        help='emissions per vehicle')
+    parser.add_argument('--interval', type=float, default=1.0,
+                        help='seconds between the emissions of a vehicle')
+    parser.add_argument('--format', choices=['msgpack', 'record'], default='msgpack')
+    parser.add_argument('--ack', action='store_true',
+                        help='wait for (and count) the acks of the server')
+    parser.add_argument('--timeout', type=float, default=5.0,
+                        help='seconds to wait for the last acks')
+    args = parser.parse_args()
+    loop = asyncio.new_event_loop()
+    print(json.dumps(loop.run_until_complete(simulate(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
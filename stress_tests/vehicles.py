@@ -0,0 +1,32 @@
+"""Simulated vehicles and their emissions, shared by the load tests."""
+from datetime import datetime
+from math import sqrt, pi, cos, sin
+from random import random, randint
+
+snowdonia_center = (53.068889, -4.075556)
+types = ['taxi', 'tram', 'bus', 'train']
+
+def req_data(vType):
+    pt = generate_point()
+    heading = randint(0, 359)
+    return {
+        'type': vType,
+        'latitude': pt['latitude'],
+        'longitude': pt['longitude'],
+        'heading': heading,
+        'timestamp': datetime.now().strftime('%d-%m-%Y %H:%M:%S')
+    }
+
+def vType():
+    return types[randint(0,3)]
+
+def generate_point():
+    r = 50000/111300
+    u, v = random(), random()
+    y0, x0 = snowdonia_center
+    w = r * sqrt(u)
+    t = 2 * pi * v
+    x = w * cos(t)
+    y = w * sin(t)
+    x1 = x / cos(y0)
+    return dict(longitude=x1+x0, latitude=y+y0)
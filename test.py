@@ -5,8 +5,23 @@ Unit Tests
 """
 
 import snowdonia
+import sqlalchemy
 import unittest
+import asyncio
+import io
+import os
+import json
+import msgpack
+import random
+import socket
+import threading
+import tempfile
 import time
+from datetime import datetime, timedelta
+from math import sin, cos
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateTable
+from unittest import mock
 import uuid
 
 class TestCase(unittest.TestCase):
@@ -26,6 +41,22 @@ class TestCase(unittest.TestCase):
 				heading = heading
 			))
 
+	def emit_batch(self, emissions):
+		"""Simulate a batch of emissions sent by a gateway."""
+		return self.app.put('/api/v1/emissions', data=json.dumps(emissions),
+				content_type='application/json')
+
+	def batch_item(self, vID, type_val, lat_val, long_val, timestamp, heading):
+		"""One emission of a batch."""
+		return dict(
+				vehicle_id = vID,
+				type = type_val,
+				latitude = lat_val,
+				longitude = long_val,
+				timestamp = timestamp,
+				heading = heading
+			)
+
 	def test_valid_emit(self):
 		"""Tests a valid emission that should pass."""
 		vID = uuid.uuid4().hex
@@ -58,6 +89,30 @@ class TestCase(unittest.TestCase):
 		rv = self.emit(vID, 'taxi', 31.2319326, 29.9492453, '22-12-2016 00:01:12', 1)
 		assert b'Co-ordinates/heading invalid' in rv.data
 
+	def test_exited_vehicle(self):
+		"""Tests that a vehicle's emissions are rejected once it left the city,
+		one by one and in batches, until it's re-admitted."""
+		vID, other = uuid.uuid4().hex, uuid.uuid4().hex
+		self.emit(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		rv = self.emit(vID, 'taxi', 31.2319326, 29.9492453, '22-12-2016 00:01:32', 1)
+		assert rv.status_code == 400
+		rv = self.emit(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:52', 1)
+		assert rv.status_code == 403 and b'Vehicle has left the city' in rv.data
+		rv = self.emit_batch([
+				self.batch_item(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:02:12', 1),
+				self.batch_item(other, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:12', 1),
+				self.batch_item(other, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:52', 1),
+				self.batch_item(other, 'bus', 31.2319326, 29.9492453, '22-12-2016 00:01:32', 1)
+			])
+		results = json.loads(rv.data.decode())['results']
+		assert [r['status'] for r in results] == [403, 200, 403, 400]
+		with snowdonia.app.app_context():
+			assert snowdonia.ExitedVehicle.query.count() >= 2
+			assert snowdonia.readmit([vID]) == 1
+		assert other in snowdonia.exited_vehicles and vID not in snowdonia.exited_vehicles
+		rv = self.emit(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:02:32', 1)
+		assert rv.data == b'Success!'
+
 	def test_invalid_timestamp(self):
 		"""Tests an invalid timestamp format."""
 		vID = uuid.uuid4().hex
@@ -70,6 +125,814 @@ class TestCase(unittest.TestCase):
 		rv = self.emit(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 360)
 		assert b'Co-ordinates/heading invalid' in rv.data
 
+	def test_positions(self):
+		"""Tests that a vehicle's position only moves to newer emissions, and is
+		served filtered by type."""
+		vID = uuid.uuid4().hex
+		self.emit(vID, 'tram', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		self.emit(vID, 'tram', 53.1, -4.1, '22-12-2016 00:01:32', 2)
+		self.emit(vID, 'tram', 53.0, -4.0, '22-12-2016 00:00:52', 3)
+		rv = self.app.get('/api/v1/positions?type=tram')
+		positions = [p for p in json.loads(rv.data.decode())['positions']
+				if p['vehicle_id'] == vID]
+		assert len(positions) == 1
+		assert positions[0]['heading'] == 2 and positions[0]['timestamp'] == '22-12-2016 00:01:32'
+		rv = self.app.get('/api/v1/positions?type=bus')
+		assert vID not in [p['vehicle_id'] for p in json.loads(rv.data.decode())['positions']]
+
+	def test_position_after_failed_commit(self):
+		"""Tests that a position whose commit failed isn't remembered as written, so
+		that the retry of its emission moves the vehicle."""
+		vID = uuid.uuid4().hex
+		self.emit(vID, 'tram', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		admission_control = snowdonia.admission_control
+		snowdonia.admission_control = snowdonia.AdmissionControl()
+		error = sqlalchemy.exc.OperationalError('COMMIT', {}, Exception('unreachable'))
+		try:
+			with mock.patch.object(snowdonia.db.session, 'commit', side_effect=error):
+				rv = self.emit(vID, 'tram', 53.1, -4.1, '22-12-2016 00:01:32', 2)
+				assert rv.status_code == 503
+		finally:
+			snowdonia.admission_control = admission_control
+		rv = self.emit(vID, 'tram', 53.1, -4.1, '22-12-2016 00:01:32', 2)
+		assert rv.data == b'Success!'
+		with snowdonia.app.app_context():
+			position = snowdonia.VehiclePosition.query.filter_by(vehicle_id=vID).first()
+			assert position.heading == 2 and position.latitude == 53.1
+
+	def test_batch_positions(self):
+		"""Tests that a batch moves its vehicles to their newest emission, even when
+		another worker has already written a newer one."""
+		vID = uuid.uuid4().hex
+		self.emit_batch([
+				self.batch_item(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:32', 2),
+				self.batch_item(vID, 'bus', 53.067823, -4.07485, '22-12-2016 00:01:12', 1)
+			])
+		snowdonia.latest_positions.clear()
+		self.emit(vID, 'bus', 53.0, -4.0, '22-12-2016 00:00:52', 3)
+		with snowdonia.app.app_context():
+			position = snowdonia.VehiclePosition.query.filter_by(vehicle_id=vID).first()
+			assert position.heading == 2
+
+	def test_grid_index(self):
+		"""Tests that the spatial index finds the same vehicles as checking them all."""
+		rand = random.Random(20161222)
+		index = snowdonia.GridIndex(0.5)
+		points = {}
+		for i in range(2000):
+			points[i] = (53.068889 + rand.uniform(-0.4, 0.4), -4.075556 + rand.uniform(-0.6, 0.6))
+			index.update(i, points[i][0], points[i][1], 'bus' if i % 2 else 'taxi')
+		for i in range(0, 2000, 3):
+			points[i] = (points[i][0] + 0.01, points[i][1])
+			index.update(i, points[i][0], points[i][1], 'bus' if i % 2 else 'taxi')
+		for i in range(50):
+			lat_val, long_val = 53.068889 + rand.uniform(-0.4, 0.4), -4.075556 + rand.uniform(-0.6, 0.6)
+			by_distance = sorted(points, key=lambda key: snowdonia.geo.distance_between(
+					lat_val, long_val, *points[key]))
+			radius = rand.choice([0.5, 2, 10])
+			expected = [key for key in by_distance if snowdonia.geo.distance_between(
+					lat_val, long_val, *points[key]) <= radius]
+			assert [p[0] for p in index.within(lat_val, long_val, radius)] == expected
+			assert [p[0] for p in index.nearest(lat_val, long_val, 5)] == by_distance[:5]
+			buses = [p[0] for p in index.nearest(lat_val, long_val, 5, where=lambda v: v == 'bus')]
+			assert buses == [key for key in by_distance if key % 2][:5]
+		far = [p[0] for p in index.nearest(40.0, -4.0, 3)]
+		assert far == sorted(points, key=lambda key: snowdonia.geo.distance_between(
+				40.0, -4.0, *points[key]))[:3]
+
+	def test_nearby_vehicles(self):
+		"""Tests finding the vehicles closest to a point."""
+		vID = uuid.uuid4().hex
+		self.emit(vID, 'train', 53.2, -3.9, '22-12-2016 00:01:12', 1)
+		rv = self.app.get('/api/v1/positions/nearby?latitude=53.2&longitude=-3.9001&radius=0.5')
+		positions = json.loads(rv.data.decode())['positions']
+		assert vID in [p['vehicle_id'] for p in positions]
+		rv = self.app.get('/api/v1/positions/nearby?latitude=53.2&longitude=-3.9001&k=1&type=train')
+		positions = json.loads(rv.data.decode())['positions']
+		assert positions[0]['vehicle_id'] == vID and positions[0]['type'] == 'train'
+		rv = self.app.get('/api/v1/positions/nearby?latitude=53.2&longitude=-3.9001')
+		assert b'Invalid value(s) provided' in rv.data
+		rv = self.app.get('/api/v1/positions/nearby?latitude=40.0&longitude=-4.0&k=1')
+		assert rv.status_code == 400 and b'Co-ordinates invalid' in rv.data
+
+	def test_vehicle_emissions(self):
+		"""Tests streaming a vehicle's emissions, page by page."""
+		vID = uuid.uuid4().hex
+		for second in [32, 12, 52]:
+			self.emit(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:%d' % second, second)
+		url = '/api/v1/vehicles/' + vID + '/emissions'
+		rv = self.app.get(url + '?limit=2')
+		page = [json.loads(line) for line in rv.data.decode().splitlines()]
+		assert [e['heading'] for e in page] == [12, 32]
+		rv = self.app.get(url, query_string=dict(limit=2, after_timestamp=page[-1]['timestamp'],
+				after_id=page[-1]['id']))
+		page = [json.loads(line) for line in rv.data.decode().splitlines()]
+		assert [e['heading'] for e in page] == [52]
+		rv = self.app.get(url, query_string={'from': '22-12-2016 00:01:20', 'to': '22-12-2016 00:01:40'})
+		assert [json.loads(line)['heading'] for line in rv.data.decode().splitlines()] == [32]
+		assert self.app.get('/api/v1/vehicles/' + uuid.uuid4().hex + '/emissions').status_code == 404
+
+	def test_compress_trajectory(self):
+		"""Tests that both compression methods drop the emissions of straight runs,
+		and reconstruct every emission within the tolerance."""
+		start = datetime(2016, 12, 22)
+		points = [(start + timedelta(seconds=20 * i), 53.0 + 0.001 * i, -4.0, 0)
+				for i in range(10)]
+		points += [(start + timedelta(seconds=20 * i), 53.009, -4.0 + 0.0015 * (i - 9), 90)
+				for i in range(10, 20)]
+		for method in snowdonia.trajectory.METHODS:
+			kept = snowdonia.trajectory.compress(points, 5, method)
+			assert len(kept) <= 5 and kept[0] == points[0] and kept[-1] == points[-1]
+			assert snowdonia.trajectory.max_error(points, kept, method) <= 5
+		assert len(snowdonia.trajectory.split(points[:3] + points[10:], 120)) == 2
+
+	def test_vehicle_trajectory(self):
+		"""Tests compressing a vehicle's emissions, then reconstructing its
+		trajectory."""
+		vID = uuid.uuid4().hex
+		for i in range(6):
+			self.emit(vID, 'bus', 53.0 + 0.001 * i, -4.0, '24-12-2016 10:0%d:00' % i, 0)
+		with snowdonia.app.app_context():
+			snowdonia.compress_trajectories(datetime(2016, 12, 24, 11), 'douglas_peucker', 5, 120)
+			assert snowdonia.Vehicle.query.filter_by(id=vID).first().emissions.count() == 2
+		url = '/api/v1/vehicles/' + vID + '/trajectory'
+		rv = self.app.get(url + '?interval=60')
+		points = [json.loads(line) for line in rv.data.decode().splitlines()]
+		assert [p['reconstructed'] for p in points] == [False, True, True, True, True, False]
+		assert abs(points[3]['latitude'] - 53.003) < 1e-9 and points[3]['tolerance'] == 5
+		rv = self.app.get(url, query_string={'from': '24-12-2016 10:01:30',
+				'to': '24-12-2016 10:03:00', 'interval': 30})
+		points = [json.loads(line) for line in rv.data.decode().splitlines()]
+		assert [p['timestamp'][-8:] for p in points] == ['10:01:30', '10:02:00', '10:02:30']
+		assert self.app.get(url + '?interval=0').status_code == 400
+
+	def test_rollups(self):
+		"""Tests that emissions are rolled up by vehicle and hour as they're
+		registered (out of order too), and that rebuilding the rollups measures
+		the late emission exactly."""
+		vID = uuid.uuid4().hex
+		rollups = snowdonia.app.config.get('ROLLUPS')
+		snowdonia.app.config['ROLLUPS'] = True
+		try:
+			self.emit(vID, 'taxi', 53.0, -4.0, '25-12-2016 10:59:40', 0)
+			self.emit(vID, 'taxi', 53.01, -4.0, '25-12-2016 11:00:00', 0)
+			self.emit_batch([
+					self.batch_item(vID, 'taxi', 53.02, -4.0, '25-12-2016 11:00:20', 0),
+					self.batch_item(vID, 'taxi', 53.005, -4.0, '25-12-2016 10:59:50', 0)
+				])
+		finally:
+			snowdonia.app.config['ROLLUPS'] = rollups
+		url = '/api/v1/rollups?vehicle_id=' + vID
+		rollups = json.loads(self.app.get(url).data.decode())['rollups']
+		assert [r['emissions'] for r in rollups] == [2, 2]
+		assert rollups[0]['distance'] == 0 and abs(rollups[1]['distance'] - 2.226) < 0.001
+		with snowdonia.app.app_context():
+			snowdonia.roll_up(datetime(2016, 12, 25, 10), datetime(2016, 12, 25, 12))
+		rollups = json.loads(self.app.get(url).data.decode())['rollups']
+		assert [r['emissions'] for r in rollups] == [2, 2]
+		assert abs(rollups[0]['distance'] - 0.556) < 0.001
+		assert abs(rollups[1]['distance'] - 1.669) < 0.001
+		rv = self.app.get('/api/v1/rollups', query_string={'period': 'day', 'type': 'taxi',
+				'from': '25-12-2016 00:00:00', 'to': '26-12-2016 00:00:00'})
+		rollups = json.loads(rv.data.decode())['rollups']
+		assert len(rollups) == 1 and rollups[0]['vehicles'] >= 1 and rollups[0]['emissions'] >= 4
+		assert self.app.get('/api/v1/rollups?period=week').status_code == 400
+
+	@mock.patch.dict(snowdonia.app.extensions['snowdonia'],
+			heat_counter=snowdonia.HeatmapCounter(8, 14, 3600))
+	@mock.patch.object(snowdonia, 'start_heatmap_flusher', lambda app: None)
+	def test_heatmap(self):
+		"""Tests counting emissions in the cells of every zoom, and serving their
+		tiles with an ETag."""
+		counter = snowdonia.heatmap.HeatmapCounter(8, 9, 3600)
+		counter.add(53.067723, -4.07495, datetime(2016, 12, 26, 10, 30))
+		counts = counter.drain()
+		assert len(counts) == 2 and len(counter) == 0
+		level, x, y, bucket = max(counts)
+		assert level == 14 and bucket == datetime(2016, 12, 26, 10)
+		assert snowdonia.heatmap.tile_of(53.067723, -4.07495, 9) == (x >> 5, y >> 5)
+
+		vID = uuid.uuid4().hex
+		self.emit(vID, 'bus', 53.067723, -4.07495, '26-12-2016 10:30:00', 0)
+		self.emit(vID, 'bus', 53.067723, -4.07495, '26-12-2016 10:30:20', 0)
+		with snowdonia.app.app_context():
+			snowdonia.flush_heatmap()
+		url = '/api/v1/heatmap/12/%d/%d' % snowdonia.heatmap.tile_of(53.067723, -4.07495, 12)
+		query = {'from': '26-12-2016 10:00:00', 'to': '26-12-2016 11:00:00'}
+		rv = self.app.get(url, query_string=query)
+		tile = json.loads(rv.data.decode())
+		assert tile['size'] == 32 and tile['max'] >= 2
+		rv = self.app.get(url, query_string=query, headers={'If-None-Match': rv.headers['ETag']})
+		assert rv.status_code == 304 and rv.data == b''
+		with snowdonia.app.app_context():
+			assert snowdonia.rebuild_heat_cells(datetime(2016, 12, 26, 10),
+					datetime(2016, 12, 26, 11)) >= 2
+		tile = json.loads(self.app.get(url, query_string=query).data.decode())
+		assert tile['max'] >= 2
+		tile = json.loads(self.app.get(url, query_string={'from': '26-12-2016 10:45:00',
+				'to': '26-12-2016 11:15:00'}).data.decode())
+		assert tile['max'] >= 2
+		tile = json.loads(self.app.get(url, query_string={'from': '26-12-2016 09:00:00',
+				'to': '26-12-2016 10:30:00'}).data.decode())
+		assert tile['max'] == 0 and tile['cells'] == []
+		assert self.app.get('/api/v1/heatmap/3/0/0').status_code == 404
+
+		# An emission whose commit failed is only counted once it's retried
+		admission_control = snowdonia.admission_control
+		snowdonia.admission_control = snowdonia.AdmissionControl()
+		error = sqlalchemy.exc.OperationalError('COMMIT', {}, Exception('unreachable'))
+		try:
+			with mock.patch.object(snowdonia.db.session, 'commit', side_effect=error):
+				rv = self.emit(vID, 'bus', 53.067723, -4.07495, '26-12-2016 10:30:40', 0)
+				assert rv.status_code == 503
+		finally:
+			snowdonia.admission_control = admission_control
+		heat_counter = snowdonia.app.extensions['snowdonia']['heat_counter']
+		assert len(heat_counter) == 0
+		self.emit(vID, 'bus', 53.067723, -4.07495, '26-12-2016 10:30:40', 0)
+		assert set(heat_counter.drain().values()) == {1}
+
+	def test_export(self):
+		"""Tests exporting a time window of emissions as CSV."""
+		vID = uuid.uuid4().hex
+		self.emit(vID, 'tram', 53.067723, -4.07495, '23-12-2016 05:01:12', 7)
+		rv = self.app.get('/api/v1/export', query_string={'from': '23-12-2016 05:00:00',
+				'to': '23-12-2016 05:02:00'})
+		lines = rv.data.decode().splitlines()
+		assert lines[0] == ','.join(snowdonia.export.COLUMNS)
+		assert [line for line in lines if vID in line][0].endswith(',tram,53.067723,-4.07495,7,2016-12-23 05:01:12')
+		assert self.app.get('/api/v1/export?format=unicorn').status_code == 400
+
+	def test_export_chunks(self):
+		"""Tests that exports are written chunk by chunk."""
+		rows = [(i, uuid.uuid4().hex, 'bus', 53.0, -4.0, i % 360, datetime(2016, 12, 22))
+				for i in range(25)]
+		assert len(list(snowdonia.export.write_csv(rows, chunk_size=10))) == 3
+		if snowdonia.export.available('parquet'):
+			data = b''.join(snowdonia.export.write_parquet(rows, chunk_size=10))
+			table = snowdonia.export.pyarrow.parquet.read_table(io.BytesIO(data))
+			assert table.num_rows == 25
+			assert snowdonia.export.pyarrow.parquet.ParquetFile(io.BytesIO(data)).num_row_groups == 3
+
+	def test_in_range_equivalence(self):
+		"""Tests that the tiered in_range gives the same answer as Vincenty for
+		random points anywhere, around the city and right at its border."""
+		rand = random.Random(20161222)
+		lat_center, long_center = 53.068889, -4.075556
+		points = [(rand.uniform(-90, 90), rand.uniform(-180, 180)) for i in range(5000)]
+		points += [(lat_center + rand.uniform(-0.6, 0.6), long_center + rand.uniform(-1, 1))
+				for i in range(5000)]
+		for i in range(5000):
+			t = rand.uniform(0, 6.2832)
+			r = rand.uniform(49.3, 50.7) / 111.2
+			points.append((lat_center + r * sin(t),
+					long_center + r * cos(t) / 0.6))
+		for lat_val, long_val in points:
+			distance = snowdonia.distance_from_center(lat_val, long_val)
+			if distance is not None:
+				assert snowdonia.in_range(lat_val, long_val) == (distance <= 50)
+
+	def test_boundary(self):
+		"""Tests that points are in polygon borders (with holes, and several
+		polygons) as ray casting over every edge says, one by one and with
+		NumPy, and that valid_points() checks them."""
+		rand = random.Random(20161222)
+		def ring(lat_val, long_val, radius, vertices):
+			return [[long_val + radius * rand.uniform(0.7, 1) * cos(6.2832 * i / vertices),
+					lat_val + radius * rand.uniform(0.7, 1) * sin(6.2832 * i / vertices)]
+					for i in range(vertices)]
+		geojson = dict(type='FeatureCollection', features=[
+				dict(type='Feature', properties={}, geometry=dict(type='Polygon',
+					coordinates=[ring(53.07, -4.08, 0.4, 500), ring(53.07, -4.08, 0.1, 40)])),
+				dict(type='Feature', properties={}, geometry=dict(type='MultiPolygon',
+					coordinates=[[ring(53.6, -3.5, 0.1, 30)],
+						[[[-3.9, 52.6], [-3.7, 52.6], [-3.7, 52.7], [-3.9, 52.7], [-3.9, 52.6]]]]))])
+		polygons = snowdonia.boundary.polygons(geojson)
+		assert len(polygons) == 3
+		boundary = snowdonia.boundary.Boundary(polygons)
+		def ray_casting(lat_val, long_val):
+			inside = False
+			for x1, y1, x2, y2 in boundary.edges:
+				if (y1 > lat_val) != (y2 > lat_val) and \
+						long_val < x1 + (lat_val - y1) * (x2 - x1) / (y2 - y1):
+					inside = not inside
+			return inside
+		latitudes = [rand.uniform(52.4, 53.8) for i in range(5000)]
+		longitudes = [rand.uniform(-4.6, -3.3) for i in range(5000)]
+		expected = [ray_casting(*p) for p in zip(latitudes, longitudes)]
+		assert any(expected) and not all(expected)
+		assert [boundary.contains(*p) for p in zip(latitudes, longitudes)] == expected
+		assert list(snowdonia.vectorized.within_boundary(boundary, latitudes, longitudes)) == expected
+		assert boundary.contains(52.65, -3.8) and not boundary.contains(53.07, -4.08)
+		headings = [rand.randint(-10, 370) for i in latitudes]
+		valid = snowdonia.valid_points(latitudes, longitudes, headings, boundary)
+		assert list(valid) == [inside and 0 <= heading <= 359
+				for inside, heading in zip(expected, headings)]
+
+	def test_partition_bounds(self):
+		"""Tests the day and week (starting on Monday) a timestamp's partition covers."""
+		timestamp = datetime(2016, 12, 22, 0, 1, 12)
+		day = snowdonia.partitions.partition_bounds(timestamp, 'day')
+		week = snowdonia.partitions.partition_bounds(timestamp, 'week')
+		assert day == (datetime(2016, 12, 22), datetime(2016, 12, 23))
+		assert week == (datetime(2016, 12, 19), datetime(2016, 12, 26))
+		assert snowdonia.partitions.partition_name('emissions', week[0]) == 'emissions_p20161219'
+
+	def test_partitioned_ddl(self):
+		"""Tests that partitioned tables are created with their PARTITION BY clause."""
+		table = sqlalchemy.Table('partitioned', sqlalchemy.MetaData(),
+				sqlalchemy.Column('timestamp', sqlalchemy.DateTime, primary_key=True),
+				info=dict(partition_by='RANGE (timestamp)'))
+		ddl = str(CreateTable(table).compile(dialect=postgresql.dialect()))
+		assert ddl.strip().endswith(') PARTITION BY RANGE (timestamp)')
+
+	def test_partitions_default_rows(self):
+		"""Tests that the emissions the default partition has in the range of a new
+		partition are moved to it, and that old ones are deleted from it."""
+		class Connection(object):
+			def __init__(self):
+				self.statements = []
+			def execute(self, statement, params=None):
+				sql = ' '.join(str(statement).split())
+				self.statements.append(sql)
+				rows = []
+				if sql.startswith('SELECT child.relname'):
+					rows = [('emissions_p20161222',)]
+				elif sql.startswith('SELECT 1') and params['start'] == datetime(2016, 12, 23):
+					rows = [(1,)]
+				return Result(rows)
+		class Result(list):
+			def first(self):
+				return self[0] if self else None
+		connection = Connection()
+		names = snowdonia.partitions.create_partitions(connection, 'emissions', 'day', 2,
+				now=datetime(2016, 12, 22, 10))
+		assert names == ['emissions_p20161222', 'emissions_p20161223', 'emissions_p20161224']
+		changes = [sql for sql in connection.statements if not sql.startswith('SELECT')]
+		where = 'WHERE timestamp >= :start AND timestamp < :end'
+		assert changes == [
+			'CREATE TABLE IF NOT EXISTS emissions_default PARTITION OF emissions DEFAULT',
+			'ALTER TABLE emissions DETACH PARTITION emissions_default',
+			"CREATE TABLE IF NOT EXISTS emissions_p20161223 PARTITION OF emissions "
+			"FOR VALUES FROM ('2016-12-23 00:00:00') TO ('2016-12-24 00:00:00')",
+			'INSERT INTO emissions_p20161223 SELECT * FROM emissions_default ' + where,
+			'DELETE FROM emissions_default ' + where,
+			'ALTER TABLE emissions ATTACH PARTITION emissions_default DEFAULT',
+			"CREATE TABLE IF NOT EXISTS emissions_p20161224 PARTITION OF emissions "
+			"FOR VALUES FROM ('2016-12-24 00:00:00') TO ('2016-12-25 00:00:00')"]
+		connection = Connection()
+		dropped = snowdonia.partitions.drop_partitions(connection, 'emissions', 'day', 1,
+				now=datetime(2016, 12, 24, 10))
+		assert dropped == ['emissions_p20161222']
+		assert connection.statements[0] == 'DELETE FROM emissions_default WHERE timestamp < :cutoff'
+
+	def test_valid_batch(self):
+		"""Tests a batch with several emissions of new and repeated vehicles."""
+		vID, otherID = uuid.uuid4().hex, uuid.uuid4().hex
+		rv = self.emit_batch([
+				self.batch_item(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:12', 1),
+				self.batch_item(vID, 'bus', 53.067823, -4.07485, '22-12-2016 00:01:32', 2),
+				self.batch_item(otherID, 'tram', 53.1, -4.1, '22-12-2016 00:01:12', 90)
+			])
+		assert rv.status_code == 200
+		results = json.loads(rv.data.decode())['results']
+		assert [r['status'] for r in results] == [200, 200, 200]
+		with snowdonia.app.app_context():
+			vehicle = snowdonia.Vehicle.query.filter_by(id=vID).first()
+			assert vehicle.emissions.count() == 2
+
+	def test_batch_item_status(self):
+		"""Tests that every emission in a batch gets its own status."""
+		vID = uuid.uuid4().hex
+		rv = self.emit_batch([
+				self.batch_item(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 1),
+				self.batch_item(vID, 'taxi', 31.2319326, 29.9492453, '22-12-2016 00:01:12', 1),
+				self.batch_item('12notaUUID', 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 1),
+				self.batch_item(vID, 'taxi', 53.067723, -4.07495, '00:01:12', 1),
+				dict(notSomethingWeWant = 0),
+				self.batch_item([], 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+			])
+		results = json.loads(rv.data.decode())['results']
+		assert results[0]['message'] == 'Success!'
+		assert 'Co-ordinates/heading invalid' in results[1]['message']
+		assert 'Vehicle ID or vehicle type is invalid' in results[2]['message']
+		assert 'Invalid value(s) provided' in results[3]['message']
+		assert 'Error!' in results[4]['message'] and 'Error!' in results[5]['message']
+
+	def test_binary_emit(self):
+		"""Tests emissions sent as msgpack and as fixed-width records."""
+		vID = uuid.uuid4().hex
+		rv = self.app.put('/api/v1/emission/' + vID, data=msgpack.packb(dict(
+				type = 'bus', latitude = 53.067723, longitude = -4.07495,
+				timestamp = 1482364872, heading = 1)),
+			content_type='application/msgpack')
+		assert b'Success!' in rv.data
+		record = snowdonia.wire.encode_emission(53.067823, -4.07485,
+				datetime(2016, 12, 22, 0, 1, 32), 2)
+		rv = self.app.put('/api/v1/emission/' + vID, data=record,
+			content_type=snowdonia.wire.RECORD)
+		assert b'Success!' in rv.data
+		with snowdonia.app.app_context():
+			position = snowdonia.VehiclePosition.query.filter_by(vehicle_id=vID).first()
+			assert position.heading == 2
+			assert position.timestamp == datetime(2016, 12, 22, 0, 1, 32)
+		rv = self.app.put('/api/v1/emission/' + vID, data=record[:-1],
+			content_type=snowdonia.wire.RECORD)
+		assert b'Invalid value(s) provided' in rv.data
+
+	def test_udp(self):
+		"""Tests emissions sent over UDP: acks, validation and counters."""
+		def handle(vehicleID, emission):
+			with snowdonia.app.app_context():
+				return snowdonia.accept_emission(vehicleID, emission)
+		loop = asyncio.new_event_loop()
+		transport, protocol = snowdonia.udp.serve(handle, '127.0.0.1', 0, ack=True,
+				loop=loop)
+		thread = threading.Thread(target=loop.run_forever)
+		thread.start()
+		client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		client.settimeout(5)
+		try:
+			address = transport.get_extra_info('sockname')
+			vID = uuid.uuid4().hex
+			client.sendto(b'not an emission', address)
+			client.sendto(snowdonia.wire.encode_emission(53.067723, -4.07495,
+					datetime(2016, 12, 22, 0, 1, 12), 1, 'tram', vID), address)
+			client.sendto(msgpack.packb(dict(vehicle_id = vID, latitude = 31.2319326,
+					longitude = 29.9492453, timestamp = 1482364872, heading = 1)), address)
+			acks = sorted(client.recv(1024).decode() for _ in range(2))
+		finally:
+			client.close()
+			loop.call_soon_threadsafe(loop.stop)
+			thread.join()
+			protocol.stop()
+			transport.close()
+			loop.close()
+		assert acks == [vID + ' 200 Success!', vID + ' 400 Co-ordinates/heading invalid.']
+		stats = protocol.stats()
+		assert (stats['received'], stats['accepted'], stats['invalid']) == (3, 1, 2)
+
+	def test_metrics(self):
+		"""Tests that emissions are counted by result and timed by stage on
+		/metrics, and that it's off unless METRICS is on."""
+		metrics = snowdonia.worker_metrics
+		enabled, metrics.enabled = metrics.enabled, False
+		assert self.app.get('/metrics').status_code == 404
+		metrics.enabled = True
+		try:
+			metrics.reset()
+			vID = uuid.uuid4().hex
+			self.emit(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+			self.emit(vID, 'taxi', 31.2319326, 29.9492453, '22-12-2016 00:01:12', 1)
+			self.emit_batch([self.batch_item(vID, 'taxi', 53.0, -4.0, 'noon', 1)])
+			rv = self.app.get('/metrics')
+		finally:
+			metrics.enabled = enabled
+		text = rv.data.decode()
+		assert 'snowdonia_emissions_total{result="success"} 1' in text
+		assert 'snowdonia_emissions_total{result="invalid_coordinates"} 1' in text
+		assert 'snowdonia_emissions_total{result="invalid_values"} 1' in text
+		assert 'snowdonia_stage_seconds_count{stage="geofence"} 2' in text
+		assert 'snowdonia_stage_seconds_count{stage="write"} 1' in text
+		assert 'snowdonia_stage_seconds_bucket{stage="batch_validate",le="+Inf"} 1' in text
+
+	def test_metrics_workers(self):
+		"""Tests that the metrics of every worker in METRICS_DIR are added up."""
+		directory = tempfile.mkdtemp()
+		metrics = snowdonia.metrics.Metrics(True, directory, flush_interval=0)
+		metrics.counter('requests', 'Requests.')
+		metrics.inc('requests', path='/')
+		metrics.observe('snowdonia_stage_seconds', 0.002, stage='parse')
+		os.rename(os.path.join(directory, '%d.json' % os.getpid()),
+				os.path.join(directory, 'other-worker.json'))
+		metrics.reset()
+		metrics.inc('requests', 2, path='/')
+		text = metrics.render()
+		assert '# TYPE requests counter\nrequests{path="/"} 3\n' in text
+		assert 'snowdonia_stage_seconds_bucket{stage="parse",le="0.001"} 0' in text
+		assert 'snowdonia_stage_seconds_bucket{stage="parse",le="0.0025"} 1' in text
+		assert 'snowdonia_stage_seconds_sum{stage="parse"} 0.002' in text
+
+	def test_admission(self):
+		"""Tests that requests are shed when too many are in flight, and while
+		the database is slow or failing (with 503 and Retry-After), until a
+		probe finds it fast again."""
+		now = [0.0]
+		control = snowdonia.AdmissionControl(1, 0, 0.5, 5, lambda: now[0])
+		assert control.admit() is None and control.admit() == 'busy'
+		control.observe(5)
+		control.release()
+		assert control.admit() == 'open' and control.retry_after() == 5
+		now[0] = 5
+		assert control.admit() is None
+		assert control.admit() == 'open'
+		control.observe(0.01)
+		control.release()
+		assert control.admit() is None
+		control.release()
+		stats = control.stats()
+		assert (stats['admitted'], stats['shed_busy'], stats['shed_open'],
+				stats['opened'], stats['circuit_open']) == (3, 1, 2, 1, 0)
+		admission_control = snowdonia.admission_control
+		snowdonia.admission_control = snowdonia.AdmissionControl(1, 0, 0.5, 5)
+		try:
+			for i in range(snowdonia.admission.FAILURES):
+				snowdonia.admission_control.failure()
+			rv = self.emit(uuid.uuid4().hex, 'taxi', 53.067723, -4.07495,
+				'22-12-2016 00:01:12', 1)
+			assert rv.status_code == 503 and rv.headers['Retry-After'] == '5'
+			assert self.emit_batch([]).status_code == 503
+		finally:
+			snowdonia.admission_control = admission_control
+
+	def test_database_outage(self):
+		"""Tests that emissions are shed with 503 and Retry-After, and that the
+		admission control counts the failures, when the database is unreachable
+		before they're even validated (looking up vehicles and exits)."""
+		admission_control = snowdonia.admission_control
+		snowdonia.admission_control = snowdonia.AdmissionControl(0, 0, 0.5, 5)
+		error = sqlalchemy.exc.OperationalError('SELECT', {}, Exception('unreachable'))
+		exits = snowdonia.app.config.get('EXITED_VEHICLES')
+		try:
+			with mock.patch.object(snowdonia.db.session, 'query', side_effect=error):
+				snowdonia._exited_vehicles_loaded = 0
+				rv = self.emit(uuid.uuid4().hex, 'taxi', 53.067723, -4.07495,
+					'22-12-2016 00:01:12', 1)
+				assert rv.status_code == 503 and 'Retry-After' in rv.headers
+				snowdonia._exited_vehicles_loaded = 0
+				rv = self.emit_batch([self.batch_item(uuid.uuid4().hex, 'taxi',
+					53.067723, -4.07495, '22-12-2016 00:01:12', 1)])
+				assert rv.status_code == 503 and 'Retry-After' in rv.headers
+				snowdonia.app.config['EXITED_VEHICLES'] = False
+				rv = self.emit_batch([self.batch_item(uuid.uuid4().hex, 'taxi',
+					53.067723, -4.07495, '22-12-2016 00:01:12', 1)])
+				assert rv.status_code == 503
+			assert snowdonia.admission_control.stats()['db_failures'] == 3
+			assert snowdonia.admission_control.stats()['circuit_open'] == 1
+		finally:
+			snowdonia.app.config['EXITED_VEHICLES'] = exits
+			snowdonia.admission_control = admission_control
+			snowdonia._exited_vehicles_loaded = 0
+
+	def test_duplicate_emission(self):
+		"""Tests that an emission sent twice is only registered once, whether this
+		worker remembers it or not, and that the retry is answered with success."""
+		vID = uuid.uuid4().hex
+		rv = self.emit(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		assert rv.data == b'Success!'
+		rv = self.emit(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		assert rv.status_code == 200 and b'duplicate' in rv.data
+		recent_emissions = snowdonia.recent_emissions
+		snowdonia.recent_emissions = snowdonia.RecentKeys(10, 60)
+		try:
+			rv = self.emit(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+			assert rv.status_code == 200 and b'duplicate' in rv.data
+			snowdonia.recent_emissions = snowdonia.RecentKeys(10, 60)
+			rv = self.emit_batch([
+					self.batch_item(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:12', 1),
+					self.batch_item(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:32', 1),
+					self.batch_item(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:32', 1)
+				])
+		finally:
+			snowdonia.recent_emissions = recent_emissions
+		results = [item['message'] for item in json.loads(rv.data.decode())['results']]
+		assert 'duplicate' in results[0] and 'duplicate' in results[2]
+		assert results[1] == 'Success!'
+		with snowdonia.app.app_context():
+			vehicle = snowdonia.Vehicle.query.filter_by(id=vID).first()
+			assert vehicle.emissions.count() == 2
+			rows = self.buffered_rows(vID, 1) * 2
+			with snowdonia.db.engine.begin() as connection:
+				assert len(snowdonia.insert_emissions(connection, rows)) == 1
+
+	def test_recent_keys(self):
+		"""Tests that recent keys are forgotten once their window is over."""
+		keys = snowdonia.RecentKeys(10, 60)
+		keys.add('a')
+		assert 'a' in keys and 'b' not in keys
+		keys.window = 0
+		time.sleep(0.01)
+		assert 'a' not in keys and len(keys) == 0
+
+	def test_binary_batch(self):
+		"""Tests a batch of fixed-width records, and one that can't be decoded."""
+		vID = uuid.uuid4().hex
+		timestamp = datetime(2016, 12, 22, 0, 1, 12)
+		rv = self.app.put('/api/v1/emissions', data=
+				snowdonia.wire.encode_emission(53.067723, -4.07495, timestamp, 1,
+					'taxi', vID) +
+				snowdonia.wire.encode_emission(31.2319326, 29.9492453, timestamp, 1,
+					'taxi', vID),
+			content_type=snowdonia.wire.RECORD)
+		results = json.loads(rv.data.decode())['results']
+		assert results[0]['message'] == 'Success!'
+		assert 'Co-ordinates/heading invalid' in results[1]['message']
+		rv = self.app.put('/api/v1/emissions', data=b'\xc1',
+			content_type='application/msgpack')
+		assert rv.status_code == 400
+
+	def test_vectorized_batch(self):
+		"""Tests that a batch validated with NumPy gets the same statuses."""
+		threshold = snowdonia.app.config['VECTORIZED_BATCH_SIZE']
+		snowdonia.app.config['VECTORIZED_BATCH_SIZE'] = 1
+		try:
+			self.test_batch_item_status()
+		finally:
+			snowdonia.app.config['VECTORIZED_BATCH_SIZE'] = threshold
+
+	def test_vectorized_distances(self):
+		"""Tests that vectorized distances match distance_from_center within 1mm,
+		and are NaN where it fails to converge."""
+		rand = random.Random(20161222)
+		latitudes = [rand.uniform(-90, 90) for i in range(5000)] + [53.068889, -53.068889]
+		longitudes = [rand.uniform(-180, 180) for i in range(5000)] + [-4.075556, 175.924444]
+		distances = snowdonia.vectorized.distances_from_center(latitudes, longitudes)
+		for lat_val, long_val, distance in zip(latitudes, longitudes, distances):
+			expected = snowdonia.distance_from_center(lat_val, long_val)
+			if expected is None:
+				assert distance != distance
+			else:
+				assert abs(distance - expected) < 1e-6
+		headings = [rand.randint(-10, 370) for i in latitudes]
+		valid = snowdonia.valid_points(latitudes, longitudes, headings)
+		assert list(valid) == [snowdonia.valid_point(*p) for p in
+				zip(latitudes, longitudes, headings)]
+
+	def test_invalid_batch(self):
+		"""Tests a batch whose body is not an array of emissions."""
+		rv = self.emit_batch(dict(notSomethingWeWant = 0))
+		assert rv.status_code == 400
+
+	def buffered_rows(self, vID, count):
+		"""Emission rows for an already registered vehicle, for the write-behind buffer."""
+		self.emit(vID, 'bus', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		return [dict(vehicle_id = vID, latitude = 53.067723, longitude = -4.07495,
+				timestamp = datetime(2016, 12, 22, 0, 1, 13 + i), heading = 1)
+				for i in range(count)]
+
+	def test_compact_types(self):
+		"""Tests the column types of the compact schema: UUIDs are native on
+		PostgreSQL and hex in Python, types are smallints, and values that
+		aren't valid are bound as NULL."""
+		dialect = postgresql.dialect()
+		vID = uuid.uuid4().hex
+		vehicle_uuid = snowdonia.compact.VehicleUUID()
+		assert isinstance(vehicle_uuid.load_dialect_impl(dialect), postgresql.UUID)
+		assert vehicle_uuid.process_bind_param(vID.upper(), dialect) == vID
+		assert vehicle_uuid.process_bind_param('not a uuid', dialect) is None
+		assert vehicle_uuid.process_result_value(str(uuid.UUID(vID)), dialect) == vID
+		vehicle_type = snowdonia.compact.VehicleType(snowdonia.valid_types)
+		assert vehicle_type.process_bind_param('tram', dialect) == 2
+		assert vehicle_type.process_bind_param('boat', dialect) is None
+		assert vehicle_type.process_result_value(2, dialect) == 'tram'
+
+	def test_emission_model(self):
+		"""Tests creating a vehicle and its emission in the same session."""
+		vID = uuid.uuid4().hex
+		with snowdonia.app.app_context():
+			snowdonia.db.session.add(snowdonia.Vehicle(vID, 'bus'))
+			snowdonia.db.session.add(snowdonia.Emission(vID, 53.067723, -4.07495,
+					datetime(2016, 12, 22, 0, 1, 12), 1))
+			snowdonia.db.session.commit()
+			vehicle = snowdonia.Vehicle.query.filter_by(id=vID).first()
+			assert vehicle.emissions.count() == 1
+			if snowdonia.compact_schema:
+				with self.assertRaises(ValueError):
+					snowdonia.Emission(uuid.uuid4().hex, 53.067723, -4.07495,
+							datetime(2016, 12, 22, 0, 1, 12), 1)
+
+	def test_buffer_flush(self):
+		"""Tests that the write-behind buffer writes everything it was given."""
+		vID = uuid.uuid4().hex
+		buffer = snowdonia.EmissionBuffer(snowdonia.app, snowdonia.db,
+				snowdonia.Emission.__table__, batch_size=2, interval=0.05)
+		buffer.extend(self.buffered_rows(vID, 5))
+		buffer.stop()
+		stats = buffer.stats()
+		assert stats['depth'] == 0 and stats['flushed'] == 5 and stats['failed'] == 0
+		with snowdonia.app.app_context():
+			vehicle = snowdonia.Vehicle.query.filter_by(id=vID).first()
+			assert vehicle.emissions.count() == 6
+
+	def test_buffer_full(self):
+		"""Tests that a full write-behind buffer writes synchronously instead."""
+		vID = uuid.uuid4().hex
+		buffer = snowdonia.EmissionBuffer(snowdonia.app, snowdonia.db,
+				snowdonia.Emission.__table__, batch_size=10, interval=10, max_size=1)
+		rows = self.buffered_rows(vID, 2)
+		buffer.put(rows[0])
+		buffer.put(rows[1])
+		stats = buffer.stats()
+		assert stats['depth'] == 1 and stats['written_synchronously'] == 1
+		buffer.stop()
+		assert buffer.stats()['flushed'] == 1
+
+	def test_buffer_retry(self):
+		"""Tests that a batch the write-behind buffer couldn't write is retried, and
+		only counts as committed once it is."""
+		vID = uuid.uuid4().hex
+		attempts, committed = [], []
+		def write(connection, rows):
+			attempts.append(len(rows))
+			if len(attempts) == 1:
+				raise RuntimeError('database down')
+			return snowdonia.insert_emissions(connection, rows)
+		buffer = snowdonia.EmissionBuffer(snowdonia.app, snowdonia.db,
+				snowdonia.Emission.__table__, batch_size=3, interval=0.01,
+				write=write, after_commit=committed.extend)
+		rows = self.buffered_rows(vID, 3)
+		buffer.extend(rows)
+		deadline = time.time() + 5
+		while buffer.stats()['flushed'] < 3 and time.time() < deadline:
+			time.sleep(0.01)
+		buffer.stop()
+		stats = buffer.stats()
+		assert attempts == [3, 3] and committed == rows
+		assert stats['retried'] == 3 and stats['flushed'] == 3 and stats['failed'] == 0
+		with snowdonia.app.app_context():
+			vehicle = snowdonia.Vehicle.query.filter_by(id=vID).first()
+			assert vehicle.emissions.count() == 4
+
+	def test_sharded_writers(self):
+		"""Tests that emissions are sent to the writer of their vehicle's shard,
+		which writes them, and that they're written synchronously if their
+		writer isn't running."""
+		directory = tempfile.mkdtemp()
+		vIDs = {}
+		while len(vIDs) < 2:
+			vID = uuid.uuid4().hex
+			vIDs.setdefault(snowdonia.writers.shard_of(vID, 2), vID)
+		rows = self.buffered_rows(vIDs[0], 3) + self.buffered_rows(vIDs[1], 2)
+		running = threading.Event()
+		running.set()
+		path = snowdonia.writers.socket_path(directory, 0)
+		writer = threading.Thread(target=snowdonia.writers.serve, args=(path,
+				snowdonia.new_emission_buffer(snowdonia.app)), kwargs=dict(running=running.is_set,
+				poll_interval=0.05))
+		writer.start()
+		while not os.path.exists(path):
+			time.sleep(0.01)
+		router = snowdonia.writers.ShardRouter(directory, 2, snowdonia.write_emissions)
+		with snowdonia.app.app_context():
+			router.extend(rows)
+		running.clear()
+		writer.join()
+		assert router.stats() == dict(writers=2, enqueued=3, written_synchronously=2)
+		with snowdonia.app.app_context():
+			for vID, count in [(vIDs[0], 4), (vIDs[1], 3)]:
+				vehicle = snowdonia.Vehicle.query.filter_by(id=vID).first()
+				assert vehicle.emissions.count() == count
+
+	def test_known_vehicle_cache(self):
+		"""Tests that registered vehicles are remembered, and the least recently
+		used one is evicted first."""
+		vID = uuid.uuid4().hex
+		self.emit(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		assert vID in snowdonia.known_vehicles
+		cache = snowdonia.LRUCache(2)
+		cache.set('a')
+		cache.set('b')
+		assert 'a' in cache
+		cache.set('c')
+		assert 'a' in cache and 'b' not in cache and 'c' in cache
+
+	def test_concurrent_registration(self):
+		"""Tests that registering a vehicle that another worker just registered
+		doesn't fail."""
+		vID = uuid.uuid4().hex
+		self.emit(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		with snowdonia.app.app_context():
+			snowdonia.db.session.execute(snowdonia.insert_ignore(
+					snowdonia.Vehicle.__table__).values(id=vID, type='bus'))
+			snowdonia.db.session.commit()
+			assert snowdonia.Vehicle.query.filter_by(id=vID).first().type == 'taxi'
+
+	def test_create_app(self):
+		"""Tests that an app of its own gets its own settings, warms the worker
+		up, and serves the API."""
+		vID = uuid.uuid4().hex
+		self.emit(vID, 'taxi', 53.067723, -4.07495, '22-12-2016 00:01:12', 1)
+		snowdonia.known_vehicles.discard(vID)
+		app = snowdonia.create_app(dict(TESTING=True, WARM_UP=True, MAX_BATCH_SIZE=1))
+		assert vID in snowdonia.known_vehicles and snowdonia.startup_seconds > 0
+		assert snowdonia.app.config['MAX_BATCH_SIZE'] != 1
+		assert app in snowdonia.apps and snowdonia.app._get_current_object() in snowdonia.apps
+		rv = app.test_client().put('/api/v1/emissions', data=json.dumps([{}, {}]),
+				content_type='application/json')
+		assert rv.status_code == 413
+
+		# Its emissions are counted in its own heatmap, and written with it
+		app = snowdonia.create_app(dict(TESTING=True, HEATMAP=True))
+		heat_counter = app.extensions['snowdonia']['heat_counter']
+		assert heat_counter is not snowdonia.app.extensions['snowdonia']['heat_counter']
+		with mock.patch.object(snowdonia, 'start_heatmap_flusher', lambda app: None):
+			rv = app.test_client().put('/api/v1/emission/%s' % vID, data=dict(
+					latitude=53.067723, longitude=-4.07495,
+					timestamp='22-12-2016 00:01:20', heading=1))
+		assert rv.status_code == 200 and len(heat_counter) > 0
+		snowdonia.flush_heatmap(app)
+		assert len(heat_counter) == 0
+
 
 
 if __name__ == '__main__':